@@ -1,23 +1,56 @@
-from flask import Flask, request, jsonify, redirect, render_template_string
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 執行模式：dev（Flask 開發伺服器）或 gevent（協程模式，單一行程同時處理大量
+# 等待資料庫與 OAuth 提供者回應的請求）。協程模式必須在載入其他模組前修補
+# 標準函式庫，讓 PyMySQL 與 requests 的 socket I/O 改為非阻塞
+SERVER_MODE = os.getenv('SERVER_MODE', 'dev')
+if SERVER_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, request, jsonify, redirect, render_template, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import pymysql
-import os
+import sys
 import base64
 import io
 import random
 import string
 import time
 import requests
+import requests.adapters
+import http.cookiejar
 import json
+import re
+import gzip
+import threading
+import signal
+import struct
+import zlib
+import heapq
+import hashlib
+import bisect
+import hmac
+import math
+import secrets
+import multiprocessing
+import atexit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import deque, OrderedDict
 from datetime import timedelta, datetime
-from dotenv import load_dotenv
 from PIL import Image, ImageDraw, ImageFont
+import numpy as np
 import jwt as pyjwt
 from urllib.parse import quote
-
-load_dotenv()
+from functools import wraps, lru_cache
+from dataclasses import dataclass
 
 app = Flask(__name__)
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
@@ -27,7 +60,97 @@ app.config['JWT_ALGORITHM'] = 'HS256'
 CAPTCHA_SECRET_KEY = os.getenv('CAPTCHA_SECRET_KEY', 'captcha-secret-key-change-in-production')
 
 CORS(app, origins=['http://localhost:5173', 'http://localhost:3000'])
-jwt = JWTManager(app)
+
+# 前方受信任的反向代理層數（負載平衡器 / Nginx）；>0 時以 X-Forwarded-For 解析真實客戶端 IP，
+# 0 表示直接對外，忽略 X-Forwarded-* 以免被偽造
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', '0'))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
+
+JWT_VERIFY_CACHE_SIZE = int(os.getenv('JWT_VERIFY_CACHE_SIZE', '10000'))  # 0 表示停用
+
+class VerifiedTokenCache:
+    """
+    已驗證 JWT 的 LRU 快取
+
+    以原始 token 的摘要為 key，保存解碼後的 claims 到 token 的 exp（含 leeway）
+    為止；同一個 token 重複請求時不必再驗證簽章與解析 JSON。只快取解碼結果，
+    撤銷檢查（token_in_blocklist_loader）每次請求仍會執行。
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # digest -> (claims, valid_until)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _key(encoded_token):
+        return hashlib.blake2b(encoded_token.encode('ascii', 'replace'), digest_size=16).digest()
+
+    def get(self, encoded_token):
+        key = self._key(encoded_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def set(self, encoded_token, claims, leeway=0):
+        if 'exp' not in claims:
+            return
+        key = self._key(encoded_token)
+        with self._lock:
+            self._entries[key] = (claims, claims['exp'] + leeway)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['size'] = len(self._entries)
+        return snapshot
+
+verified_token_cache = VerifiedTokenCache(JWT_VERIFY_CACHE_SIZE)
+
+class CachingJWTManager(JWTManager):
+    """解碼結果經 VerifiedTokenCache 快取的 JWTManager（覆寫 Flask-JWT-Extended 4.6 的內部解碼方法）"""
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        if allow_expired or csrf_value is not None or verified_token_cache.max_entries <= 0:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+        claims = verified_token_cache.get(encoded_token)
+        if claims is None:
+            claims = super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+            leeway = app.config.get('JWT_DECODE_LEEWAY', 0)
+            verified_token_cache.set(encoded_token, claims, leeway.total_seconds() if isinstance(leeway, timedelta) else leeway)
+        # 回傳副本，避免處理函數修改到快取內容
+        return dict(claims)
+
+jwt = CachingJWTManager(app)
+
+# 協程模式的監聽位址與單一行程最多同時處理的連線數
+SERVER_HOST = os.getenv('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '5000'))
+SERVER_MAX_CONNECTIONS = int(os.getenv('SERVER_MAX_CONNECTIONS', '1000'))
+
+def cooperative_mode():
+    """是否在 gevent 協程模式下執行（SERVER_MODE=gevent 或 gunicorn -k gevent）"""
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    return gevent_monkey is not None and gevent_monkey.is_module_patched('socket')
+
+def run_cpu_bound(func, *args):
+    """執行 CPU 密集工作；協程模式下交給原生執行緒池，避免阻塞事件迴圈"""
+    if cooperative_mode():
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
 
 # 資料庫配置
 DB_CONFIG = {
@@ -50,249 +173,1971 @@ GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET', '')
 GOOGLE_REDIRECT_URI = os.getenv('GOOGLE_REDIRECT_URI', 'http://localhost:5000/api/callback/google')
 GOOGLE_LINK_REDIRECT_URI = os.getenv('GOOGLE_LINK_REDIRECT_URI', 'http://localhost:5000/api/callback/link/google')
 
+# OAuth 提供者端點（可覆寫為本機假伺服器以便測試）
+LINE_TOKEN_URL = os.getenv('LINE_TOKEN_URL', 'https://api.line.me/oauth2/v2.1/token')
+LINE_PROFILE_URL = os.getenv('LINE_PROFILE_URL', 'https://api.line.me/v2/profile')
+GOOGLE_TOKEN_URL = os.getenv('GOOGLE_TOKEN_URL', 'https://oauth2.googleapis.com/token')
+GOOGLE_USERINFO_URL = os.getenv('GOOGLE_USERINFO_URL', 'https://www.googleapis.com/oauth2/v2/userinfo')
+
+# ==================== 請求指標 ====================
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # 設定後 /api/metrics 需帶 Bearer token
+METRICS_SHARDS = int(os.getenv('METRICS_SHARDS', '16'))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+METRIC_HELP = {
+    'http_request_duration_seconds': ('histogram', '請求處理時間'),
+    'http_requests_total': ('counter', '請求數（依狀態碼）'),
+    'http_requests_in_flight': ('gauge', '處理中的請求數'),
+    'db_queries_per_request': ('histogram', '每個請求的資料庫查詢次數'),
+    'db_query_seconds_per_request': ('histogram', '每個請求的資料庫查詢總時間'),
+    'oauth_request_duration_seconds': ('histogram', 'OAuth 提供者 HTTP 請求時間'),
+    'captcha_render_seconds': ('histogram', '驗證碼繪製時間'),
+    'password_hash_seconds': ('histogram', '密碼雜湊 / 驗證時間（依操作與演算法）'),
+    'db_slow_queries': ('histogram', '慢查詢耗時'),
+    'db_repeated_statements_total': ('counter', '同一請求重複執行相同語句（疑似 N+1）的次數'),
+}
+
+class MetricsRegistry:
+    """
+    行程內指標（Prometheus 文字格式輸出）
+
+    記錄時依執行緒 ID 分散到多個分片，每個分片有自己的鎖，執行緒之間
+    幾乎不會競爭；抓取時才合併所有分片。分片數固定，不會因為每個請求
+    一條執行緒（或協程）而無限增加。
+    """
+
+    def __init__(self, shards=16):
+        self._shards = [({}, {}, threading.Lock()) for _ in range(max(1, shards))]  # (histograms, counters, lock)
+        self._collectors = []
+
+    def _shard(self):
+        return self._shards[threading.get_ident() % len(self._shards)]
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        """記錄一筆 histogram 觀測值，labels 為 ((名稱, 值), ...)"""
+        histograms, _, lock = self._shard()
+        index = bisect.bisect_left(buckets, value)
+        with lock:
+            entry = histograms.get((name, labels))
+            if entry is None:
+                entry = histograms[(name, labels)] = [buckets, [0] * (len(buckets) + 1), 0.0]
+            entry[1][index] += 1
+            entry[2] += value
+
+    def inc(self, name, labels, amount=1):
+        """累加 counter / gauge"""
+        _, counters, lock = self._shard()
+        with lock:
+            counters[(name, labels)] = counters.get((name, labels), 0) + amount
+
+    def register_collector(self, collect):
+        """註冊抓取時呼叫的函數，回傳 [(名稱, labels, 值), ...] 的 gauge"""
+        self._collectors.append(collect)
+
+    def _merge(self):
+        histograms, counters = {}, {}
+        for shard_histograms, shard_counters, lock in self._shards:
+            with lock:
+                for key, (buckets, counts, total) in shard_histograms.items():
+                    merged = histograms.get(key)
+                    if merged is None:
+                        histograms[key] = [buckets, list(counts), total]
+                    else:
+                        merged[1] = [a + b for a, b in zip(merged[1], counts)]
+                        merged[2] += total
+                for key, value in shard_counters.items():
+                    counters[key] = counters.get(key, 0) + value
+        return histograms, counters
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        """輸出 Prometheus text exposition format"""
+        histograms, counters = self._merge()
+        gauges = {}
+        for collect in self._collectors:
+            try:
+                for name, labels, value in collect():
+                    gauges[(name, labels)] = value
+            except Exception:
+                continue
+
+        lines = []
+        declared = set()
+
+        def declare(name, metric_type):
+            if name not in declared:
+                declared.add(name)
+                help_text = METRIC_HELP.get(name, (metric_type, name))[1]
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+
+        for (name, labels), (buckets, counts, total) in sorted(histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._labels(labels, (("le", repr(float(bound))),))} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{name}_bucket{self._labels(labels, (("le", "+Inf"),))} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, METRIC_HELP.get(name, ('counter',))[0])
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), value in sorted(gauges.items()):
+            declare(name, 'gauge')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry(METRICS_SHARDS)
+
+def observe_metric(name, labels, value, buckets=LATENCY_BUCKETS):
+    """記錄 histogram（停用指標時不做任何事）"""
+    if METRICS_ENABLED:
+        metrics.observe(name, labels, value, buckets)
+
+@app.before_request
+def start_request_metrics():
+    if not METRICS_ENABLED:
+        return None
+    g._metrics_started = time.perf_counter()
+    g._metrics_endpoint = request.endpoint or 'unmatched'
+    metrics.inc('http_requests_in_flight', (('endpoint', g._metrics_endpoint),))
+    return None
+
+@app.after_request
+def record_request_metrics(response):
+    """記錄請求時間、狀態碼與資料庫使用量（最先註冊，因此在所有 after_request 之後執行）"""
+    started = g.get('_metrics_started')
+    if started is None:
+        return response
+    endpoint = g._metrics_endpoint
+    labels = (('endpoint', endpoint), ('method', request.method))
+    metrics.inc('http_requests_in_flight', (('endpoint', endpoint),), -1)
+    metrics.inc('http_requests_total', labels + (('status', str(response.status_code)),))
+    metrics.observe('http_request_duration_seconds', labels, time.perf_counter() - started)
+    metrics.observe('db_queries_per_request', (('endpoint', endpoint),), g.get('_db_query_count', 0), QUERY_COUNT_BUCKETS)
+    metrics.observe('db_query_seconds_per_request', (('endpoint', endpoint),), g.get('_db_query_seconds', 0.0))
+    g._metrics_started = None
+    return response
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers['X-Request-ID'] = get_request_id()
+    return response
+
 # ==================== 資料庫連接管理 ====================
 
-# 資料庫欄位快取（避免重複檢查）
-_db_columns_cache = {}
+# 連接池配置
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))  # 最大連接數
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))  # 等待可用連接的秒數
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', '300'))  # 閒置超過此秒數即回收
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '3600'))  # 連接最長存活秒數
+
+class PoolExhaustedError(Exception):
+    """連接池在等待逾時後仍無可用連接"""
+
+class PooledConnection:
+    """
+    連接池中的連接代理
+
+    除 close() 外的操作都轉交給底層 pymysql 連接；
+    close() 不會真的斷線，而是把連接歸還連接池。
+    """
+
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self.created_at = created_at
+        self.last_used = time.monotonic()
+        self._checked_out = False  # 由連接池在借出 / 歸還時切換（持有連接池的鎖）
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def close(self):
+        """歸還連接（重複呼叫無副作用，只有第一次會真的歸還）"""
+        self._pool.release(self)
+
+class ConnectionPool:
+    """
+    有上限、執行緒安全的 MySQL 連接池
+
+    借出時檢查連接是否存活，並依閒置時間與存活時間回收舊連接；
+    連接全數借出時最多等待 timeout 秒，逾時則拋出 PoolExhaustedError。
+    """
+
+    def __init__(self, config, max_size=10, timeout=5.0, max_idle=300.0, max_lifetime=3600.0):
+        self._config = config
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self._idle = deque()
+        self._size = 0  # 已建立（閒置 + 借出）的連接數
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,      # 成功借出次數
+            'waits': 0,          # 需要等待才借到的次數
+            'exhausted': 0,      # 等待逾時次數
+            'created': 0,        # 新建連接數
+            'recycled': 0,       # 因閒置/存活時間回收的連接數
+            'ping_failures': 0,  # 借出時存活檢查失敗數
+        }
+
+    def _is_expired(self, conn, now):
+        if self.max_lifetime and now - conn.created_at > self.max_lifetime:
+            return True
+        if self.max_idle and now - conn.last_used > self.max_idle:
+            return True
+        return False
+
+    def _discard(self, conn):
+        """關閉底層連接並釋放名額（呼叫端不可持有鎖）"""
+        raw, conn._raw = conn._raw, None
+        try:
+            if raw is not None:
+                raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def acquire(self, timeout=None):
+        """借出一個可用連接；timeout 未指定時使用連接池預設值"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None
+        waited = False
+        while True:
+            conn = None
+            create = False
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    if deadline is None:
+                        deadline = time.monotonic() + timeout
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['exhausted'] += 1
+                        raise PoolExhaustedError('資料庫連接池已滿，請稍後再試')
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if create:
+                try:
+                    raw = pymysql.connect(**self._config)
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                conn = PooledConnection(self, raw, time.monotonic())
+                with self._cond:
+                    self._stats['created'] += 1
+            else:
+                if self._is_expired(conn, time.monotonic()):
+                    with self._cond:
+                        self._stats['recycled'] += 1
+                    self._discard(conn)
+                    continue
+                try:
+                    conn._raw.ping(reconnect=False)
+                except Exception:
+                    with self._cond:
+                        self._stats['ping_failures'] += 1
+                    self._discard(conn)
+                    continue
+
+            with self._cond:
+                conn._checked_out = True
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['waits'] += 1
+            return conn
+
+    def release(self, conn):
+        """歸還連接，未提交的交易一律回滾；同一次借出只會歸還一次，避免同一連接重複進入閒置佇列"""
+        with self._cond:
+            if not conn._checked_out or conn._raw is None:
+                return
+            conn._checked_out = False
+        try:
+            conn._raw.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        conn.last_used = time.monotonic()
+        if self._is_expired(conn, conn.last_used):
+            with self._cond:
+                self._stats['recycled'] += 1
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def stats(self):
+        """取得連接池計數器快照"""
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot['size'] = self._size
+            snapshot['idle'] = len(self._idle)
+            snapshot['in_use'] = self._size - len(self._idle)
+            snapshot['max_size'] = self.max_size
+        return snapshot
+
+db_pool = ConnectionPool(
+    DB_CONFIG,
+    max_size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    max_idle=DB_POOL_MAX_IDLE,
+    max_lifetime=DB_POOL_MAX_LIFETIME
+)
+
+QUERY_SLOW_MS = float(os.getenv('QUERY_SLOW_MS', '200'))  # 超過此毫秒數寫入慢查詢日誌
+QUERY_EXPLAIN = os.getenv('QUERY_EXPLAIN', 'false').lower() == 'true'  # 慢查詢是否自動附上 EXPLAIN
+QUERY_REPEAT_THRESHOLD = int(os.getenv('QUERY_REPEAT_THRESHOLD', '5'))  # 同一請求相同語句超過此次數即警告（N+1）
+QUERY_TRACE_LIMIT = int(os.getenv('QUERY_TRACE_LIMIT', '100'))  # 每個請求保留的查詢紀錄筆數
+
+sql_logger = app.logger.getChild('sql')
+
+_SQL_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_SQL_NUMBER_LITERAL = re.compile(r'\b\d+\b')
+_SQL_WHITESPACE = re.compile(r'\s+')
+
+@lru_cache(maxsize=1024)
+def normalize_sql(query):
+    """將 SQL 正規化（合併空白、字面值換成 ?），相同語句只計算一次"""
+    normalized = _SQL_STRING_LITERAL.sub('?', query)
+    normalized = _SQL_NUMBER_LITERAL.sub('?', normalized)
+    return _SQL_WHITESPACE.sub(' ', normalized).strip()
+
+def get_request_id():
+    """取得目前請求的 ID（沿用客戶端的 X-Request-ID，否則自動產生）"""
+    request_id = g.get('_request_id')
+    if request_id is None:
+        request_id = request.headers.get('X-Request-ID', '')[:64] or secrets.token_hex(8)
+        g._request_id = request_id
+    return request_id
+
+class TracingCursor:
+    """
+    記錄請求內查詢的 cursor 代理
+
+    每個語句記錄正規化文字、耗時與影響筆數（標上請求 ID），並累計查詢次數與
+    時間供指標與測試使用。超過 QUERY_SLOW_MS 的語句寫入慢查詢日誌
+    （可選擇附上 EXPLAIN）；同一請求重複執行相同語句超過 QUERY_REPEAT_THRESHOLD
+    次時發出 N+1 警告。
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, query, args=None):
+        g._db_query_count = g.get('_db_query_count', 0) + 1
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, args)
+        finally:
+            elapsed = time.perf_counter() - started
+            g._db_query_seconds = g.get('_db_query_seconds', 0.0) + elapsed
+            self._trace(query, args, elapsed)
+
+    def _trace(self, query, args, elapsed):
+        statement = normalize_sql(query)
+        rowcount = self._cursor.rowcount
+        request_id = get_request_id()
+
+        trace = g.get('_query_trace')
+        if trace is None:
+            trace = g._query_trace = []
+        if len(trace) < QUERY_TRACE_LIMIT:
+            trace.append({'statement': statement, 'ms': round(elapsed * 1000, 3), 'rows': rowcount})
+        sql_logger.debug('[%s] %.2fms rows=%s %s', request_id, elapsed * 1000, rowcount, statement)
+
+        if elapsed * 1000 >= QUERY_SLOW_MS:
+            observe_metric('db_slow_queries', (('endpoint', request.endpoint or 'unmatched'),), elapsed)
+            plan = self._explain(query, args) if QUERY_EXPLAIN else None
+            sql_logger.warning('[%s] 慢查詢 %.2fms rows=%s %s%s', request_id, elapsed * 1000, rowcount,
+                               statement, f' EXPLAIN={plan}' if plan else '')
+
+        repeats = g.get('_query_repeats')
+        if repeats is None:
+            repeats = g._query_repeats = {}
+        repeats[statement] = repeats.get(statement, 0) + 1
+        if repeats[statement] == QUERY_REPEAT_THRESHOLD + 1:
+            if METRICS_ENABLED:
+                metrics.inc('db_repeated_statements_total', (('endpoint', request.endpoint or 'unmatched'),))
+            sql_logger.warning('[%s] 可能的 N+1 查詢：%s 在同一請求執行超過 %d 次', request_id,
+                               statement, QUERY_REPEAT_THRESHOLD)
+
+    def _explain(self, query, args):
+        """以同一條連接執行 EXPLAIN（只針對 SELECT，且不計入查詢次數）"""
+        if not query.lstrip().upper().startswith('SELECT'):
+            return None
+        try:
+            cursor = self._cursor.connection.cursor()
+            cursor.execute(f'EXPLAIN {query}', args)
+            return cursor.fetchall()
+        except Exception:
+            return None
+
+class RequestConnection:
+    """
+    請求範圍的連接
+
+    同一個請求內多次 get_db_connection() 共用同一條池化連接，
+    close() 只是標記，實際歸還在請求結束時（teardown）進行。
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return TracingCursor(self._conn.cursor(*args, **kwargs))
+
+    def close(self):
+        pass
 
 def get_db_connection():
-    """取得資料庫連接"""
-    return pymysql.connect(**DB_CONFIG)
+    """取得資料庫連接（請求內共用同一條池化連接）"""
+    if not has_request_context():
+        return db_pool.acquire()
+
+    conn = g.get('_db_conn')
+    if conn is None:
+        conn = RequestConnection(db_pool.acquire())
+        g._db_conn = conn
+    return conn
+
+def release_request_connection():
+    """
+    提前把請求連接歸還連接池
+
+    用於密碼雜湊等不需要資料庫的耗時步驟之前，避免並行登入數被連接池大小限制；
+    之後的 get_db_connection() 會重新借出連接。呼叫前須已 commit（未提交的交易會回滾），
+    之前取得的 cursor 也不可再使用。
+    """
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        conn._conn.close()
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    """請求結束時將連接歸還連接池"""
+    release_request_connection()
+
+# ==================== 資料表結構能力 ====================
+
+@dataclass(frozen=True)
+class SchemaCapabilities:
+    """
+    啟動時偵測的資料表結構（不可變）
+
+    各處理函數依此挑選預先組好的 SQL，不再於每個請求執行 SHOW COLUMNS。
+    """
+    columns: frozenset = frozenset()  # 'table.column' 集合
+    has_role: bool = False
+    has_failed_attempts: bool = False
+    has_lockout: bool = False
+    has_merchants: bool = False
+    has_token_version: bool = False
+    has_refresh_tokens: bool = False
+
+_schema = None
+_schema_lock = threading.Lock()
+
+def load_schema_capabilities():
+    """以單一查詢讀取 users / merchants / refresh_tokens 的欄位並建立能力物件"""
+    conn = db_pool.acquire()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name
+               FROM information_schema.COLUMNS
+               WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ('users', 'merchants', 'refresh_tokens')"""
+        )
+        columns = frozenset(f"{row['table_name']}.{row['column_name']}" for row in cursor.fetchall())
+    finally:
+        conn.close()
+
+    return SchemaCapabilities(
+        columns=columns,
+        has_role='users.role' in columns,
+        has_failed_attempts='users.failed_attempts' in columns,
+        has_lockout='users.lockout_until' in columns,
+        has_merchants='merchants.user_id' in columns,
+        has_token_version='users.token_version' in columns,
+        has_refresh_tokens='refresh_tokens.family_id' in columns
+    )
+
+def refresh_schema_capabilities():
+    """重新偵測資料表結構（執行資料庫遷移後呼叫）"""
+    global _schema
+    schema = load_schema_capabilities()
+    with _schema_lock:
+        _schema = schema
+    return schema
+
+def get_schema():
+    """
+    取得資料表結構能力
+
+    第一次呼叫時偵測並快取；資料庫無法連線時回傳全部為 False 的能力物件
+    且不快取，待下次請求再重試。
+    """
+    schema = _schema
+    if schema is not None:
+        return schema
+    with _schema_lock:
+        if _schema is not None:
+            return _schema
+    try:
+        return refresh_schema_capabilities()
+    except Exception:
+        return SchemaCapabilities()
+
+# 依資料表結構預先組好的 SQL
+USER_INSERT_SQL = {
+    # (has_role, has_failed_attempts)
+    (True, True): '''INSERT INTO users (username, role, password, display_name, email, phone, failed_attempts)
+                     VALUES (%s, %s, %s, %s, %s, %s, 0)''',
+    (True, False): '''INSERT INTO users (username, role, password, display_name, email, phone)
+                      VALUES (%s, %s, %s, %s, %s, %s)''',
+    (False, True): 'INSERT INTO users (username, password, failed_attempts) VALUES (%s, %s, 0)',
+    (False, False): 'INSERT INTO users (username, password) VALUES (%s, %s)',
+}
+
+@lru_cache(maxsize=4)
+def build_login_sql(schema):
+    """
+    組出登入用的單一查詢
+
+    一次取得用戶、失敗次數 / 鎖定時間與商家資料（LEFT JOIN），
+    登入流程只需要一次資料庫往返。
+    """
+    columns = ['u.id', 'u.username', 'u.email', 'u.password', 'u.display_name', 'u.line_id', 'u.google_id']
+    if schema.has_role:
+        columns += ['u.role', 'u.phone']
+    if schema.has_failed_attempts:
+        columns.append('u.failed_attempts')
+    if schema.has_lockout:
+        columns.append('u.lockout_until')
+    if schema.has_token_version:
+        columns.append('u.token_version')
+
+    joins = ''
+    if schema.has_role and schema.has_merchants:
+        columns += [
+            'm.id AS merchant_id', 'm.business_name AS merchant_business_name',
+            'm.business_type AS merchant_business_type', 'm.address AS merchant_address',
+            'm.logo_url AS merchant_logo_url', 'm.is_verified AS merchant_is_verified',
+            'm.rating AS merchant_rating'
+        ]
+        joins = ' LEFT JOIN merchants m ON m.user_id = u.id'
+
+    return f"SELECT {', '.join(columns)} FROM users u{joins} WHERE u.username = %s"
+
+PROFILE_USER_SQL = {
+    # has_role
+    True: 'SELECT id, username, email, display_name, role, phone, line_id, google_id FROM users WHERE id = %s',
+    False: 'SELECT id, username, email, display_name, line_id, google_id FROM users WHERE id = %s',
+}
+
+CHANGE_PASSWORD_SELECT_SQL = {
+    # has_token_version
+    True: 'SELECT password, token_version FROM users WHERE id = %s',
+    False: 'SELECT password FROM users WHERE id = %s',
+}
+
+CHANGE_PASSWORD_UPDATE_SQL = {
+    # has_token_version
+    True: 'UPDATE users SET password = %s, token_version = token_version + 1 WHERE id = %s',
+    False: 'UPDATE users SET password = %s WHERE id = %s',
+}
+
+RESET_FAILED_ATTEMPTS_SQL = {
+    # has_lockout
+    True: 'UPDATE users SET failed_attempts = 0, lockout_until = NULL WHERE username = %s',
+    False: 'UPDATE users SET failed_attempts = 0 WHERE username = %s',
+}
+
+def execute_with_connection(func):
+    """資料庫連接裝飾器，自動管理連接的借出和歸還"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        conn = get_db_connection()
+        try:
+            result = func(conn, *args, **kwargs)
+            return result
+        finally:
+            conn.close()
+    return wrapper
+
+# ==================== 驗證碼生成器 ====================
+
+CAPTCHA_CHARSET = string.ascii_uppercase + string.digits
+CAPTCHA_FONT_SIZE = 36
+
+# 字體搜尋路徑（依序嘗試），可用 CAPTCHA_FONT_PATH 指定
+CAPTCHA_FONT_PATHS = [
+    os.getenv('CAPTCHA_FONT_PATH', ''),
+    'C:/Windows/Fonts/arial.ttf',
+    'C:/Windows/Fonts/calibri.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/TTF/DejaVuSans.ttf',
+    '/Library/Fonts/Arial.ttf',
+    '/System/Library/Fonts/Supplemental/Arial.ttf',
+]
+
+def load_captcha_font():
+    """載入驗證碼字體，全部失敗時使用默認字體"""
+    for font_path in CAPTCHA_FONT_PATHS:
+        if font_path and os.path.exists(font_path):
+            try:
+                return ImageFont.truetype(font_path, CAPTCHA_FONT_SIZE)
+            except OSError:
+                continue
+    return ImageFont.load_default()
+
+class GlyphAtlas:
+    """
+    驗證碼字元圖集
+
+    字體只載入一次，並預先把每個字元渲染成灰階遮罩（numpy 陣列），
+    產生驗證碼時直接以遮罩混色，不再逐字呼叫 textbbox / draw.text。
+    """
+
+    def __init__(self, font, charset):
+        self.glyphs = {}
+        for char in charset:
+            left, top, right, bottom = font.getbbox(char)
+            mask = Image.new('L', (max(right - left, 1), max(bottom - top, 1)), 0)
+            ImageDraw.Draw(mask).text((-left, -top), char, fill=255, font=font)
+            self.glyphs[char] = {
+                'mask': np.asarray(mask, dtype=np.float32) / 255.0,
+                'left': left,
+                'top': top,
+                'bottom': bottom,
+                'width': right - left,  # 與 textbbox 寬度相同
+            }
+
+    def get(self, char):
+        return self.glyphs[char]
+
+_glyph_atlas = None
+_glyph_atlas_lock = threading.Lock()
+
+def get_glyph_atlas():
+    """取得（必要時建立）共用的字元圖集"""
+    global _glyph_atlas
+    if _glyph_atlas is None:
+        with _glyph_atlas_lock:
+            if _glyph_atlas is None:
+                _glyph_atlas = GlyphAtlas(load_captcha_font(), CAPTCHA_CHARSET)
+    return _glyph_atlas
+
+def _line_pixels(coords, width, height, thickness):
+    """
+    以向量方式一次計算多條直線涵蓋的像素座標
+
+    Args:
+        coords: (count, 4) 陣列，每列為 x0, y0, x1, y1
+    """
+    count = len(coords)
+    starts, ends = coords[:, None, :2], coords[:, None, 2:]
+    delta = np.abs(ends - starts)
+    # 所有線共用同一組取樣點，取樣數以最長的線為準
+    steps = int(delta.max()) + 1
+    t = (np.arange(steps, dtype=np.float32) / max(steps - 1, 1))[None, :, None]
+    points = (starts + (ends - starts) * t + 0.5).astype(np.intp)  # (count, steps, 2)
+
+    # 線寬：沿較短軸方向加粗
+    horizontal = delta[..., 0] >= delta[..., 1]
+    shift = np.stack([~horizontal, horizontal], axis=-1).astype(np.intp)  # (count, 1, 2)
+    offsets = np.arange(thickness)[None, :, None, None] * shift[:, None]
+    thick = points[:, None] + offsets  # (count, thickness, steps, 2)
+
+    xs, ys = thick[..., 0].ravel(), thick[..., 1].ravel()
+    owners = np.repeat(np.arange(count), thickness * steps)
+    inside = (xs < width) & (ys < height)
+    return ys[inside], xs[inside], owners[inside]
+
+def encode_png(pixels, level=1):
+    """
+    將 RGB 陣列直接編碼為 PNG
+
+    每列使用 None 濾波再交給 zlib，比 Pillow 的自適應濾波快數倍，
+    且對驗證碼這種大面積白底的圖片體積相近。
+    """
+    height, width, _ = pixels.shape
+    return _png_file(width, height, 2, pixels.reshape(height, -1), level)
+
+def encode_png8(pixels, level=1):
+    """
+    將 RGB 陣列直接編碼為調色盤 PNG，色數超過 256 時回傳 None
+
+    驗證碼只有白底、4 種字色的反鋸齒邊緣、干擾線與干擾點，每個色版取高 5 位元後
+    通常只剩 100～250 色，可直接作為調色盤，不需要 Pillow 的八元樹量化；
+    超過 256 色時改取高 4 位元。
+    """
+    height, width, _ = pixels.shape
+    for bits in (5, 4):
+        q = pixels >> (8 - bits)
+        index = ((q[..., 0].astype(np.uint16) << (2 * bits))
+                 | (q[..., 1].astype(np.uint16) << bits) | q[..., 2]).ravel()
+        # uint16 排序比以整張對照表標記出現過的顏色快
+        ordered = np.sort(index)
+        colors = ordered[np.concatenate(([True], ordered[1:] != ordered[:-1]))].astype(np.intp)
+        if len(colors) <= 256:
+            break
+    else:
+        return None
+
+    lut = np.zeros(1 << (3 * bits), dtype=np.uint8)
+    lut[colors] = np.arange(len(colors), dtype=np.uint8)
+    mask = (1 << bits) - 1
+    channels = np.stack(((colors >> (2 * bits)) & mask, (colors >> bits) & mask, colors & mask), axis=1)
+    # 把 bits 位元的值展開回 0～255（例如 5 位元的 31 -> 255），白底保持純白
+    palette = (channels << (8 - bits)) | (channels >> (2 * bits - 8))
+    return _png_file(width, height, 3, np.take(lut, index).reshape(height, width), level,
+                     palette.astype(np.uint8).tobytes())
+
+def _png_file(width, height, color_type, rows, level, palette=None):
+    """組出 PNG 檔案（8 位元深度，每列使用 None 濾波）"""
+    raw = np.empty((height, rows.shape[1] + 1), dtype=np.uint8)
+    raw[:, 0] = 0
+    raw[:, 1:] = rows
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)),
+        chunk(b'PLTE', palette) if palette is not None else b'',
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), level)),
+        chunk(b'IEND', b''),
+    ))
+
+@lru_cache(maxsize=8)
+def _captcha_random_spans(count, width, height):
+    """每張驗證碼所需亂數的上限（不含），依序為字色 + 偏移、干擾線、干擾點"""
+    return np.array(
+        [101, 101, 101, 11] * count
+        + [width + 1, height + 1, width + 1, height + 1, 106, 106, 106] * 3
+        + [height, width, 256, 256, 256] * 50,
+        dtype=np.float64
+    )
+
+CAPTCHA_IMAGE_FORMAT = os.getenv('CAPTCHA_IMAGE_FORMAT', 'png')  # png（最快）/ png8（調色盤 PNG，體積較小）/ webp
+CAPTCHA_MIMETYPES = {'png': 'image/png', 'png8': 'image/png', 'webp': 'image/webp'}
+
+def encode_captcha_image(pixels, image_format='png'):
+    """
+    依格式編碼驗證碼圖片
+
+    png8 輸出調色盤 PNG，體積約少四分之一但編碼較慢；色數過多時才交給 Pillow 量化為 64 色。
+    webp 為有損壓縮，體積更小但需要瀏覽器支援。
+    """
+    if image_format == 'png':
+        return encode_png(pixels)
+    if image_format == 'png8':
+        encoded = encode_png8(pixels)
+        if encoded is not None:
+            return encoded
+
+    image = Image.fromarray(pixels, 'RGB')
+    output = io.BytesIO()
+    if image_format == 'png8':
+        image.quantize(64, method=Image.Quantize.FASTOCTREE).save(output, format='PNG')
+    elif image_format == 'webp':
+        image.save(output, format='WEBP', quality=60, method=0)
+    else:
+        raise ValueError(f'不支援的驗證碼圖片格式：{image_format}')
+    return output.getvalue()
+
+def generate_captcha_image(text, width=200, height=80, image_format='png'):
+    """生成驗證碼圖片"""
+    atlas = get_glyph_atlas()
+    pixels = np.full((height, width, 3), 255, dtype=np.uint8)
+    count = len(text)
+
+    # 一次取出本張圖片需要的所有亂數（字色 + 偏移、干擾線、干擾點）
+    spans = _captcha_random_spans(count, width, height)
+    rand = (np.random.random(len(spans)) * spans).astype(np.intp)
+    char_rand = rand[:4 * count].reshape(count, 4)
+    line_rand = rand[4 * count:4 * count + 21].reshape(3, 7)
+    noise = rand[4 * count + 21:].reshape(50, 5)
+
+    # 計算文字位置（與逐字 textbbox 的排版相同）
+    glyphs = [atlas.get(char) for char in text]
+    text_width = sum(glyph['width'] for glyph in glyphs)
+    text_height = max(glyph['bottom'] for glyph in glyphs) - min(glyph['top'] for glyph in glyphs)
+    x = (width - text_width) / 2
+    y = (height - text_height) / 2
+
+    # 繪製每個字符，添加隨機偏移和顏色
+    colors = char_rand[:, :3].astype(np.float32)
+    offsets = (char_rand[:, 3] - 5).tolist()
+    char_x = x
+    for glyph, color, offset_y in zip(glyphs, colors, offsets):
+        mask = glyph['mask']
+        gx = int(char_x) + glyph['left']
+        gy = int(y + offset_y) + glyph['top']
+        # 裁切超出畫布的部分
+        x0, y0 = max(gx, 0), max(gy, 0)
+        x1 = min(gx + mask.shape[1], width)
+        y1 = min(gy + mask.shape[0], height)
+        if x1 > x0 and y1 > y0:
+            alpha = mask[y0 - gy:y1 - gy, x0 - gx:x1 - gx, None]
+            region = pixels[y0:y1, x0:x1]
+            region[:] = region + (color - region) * alpha
+        char_x += glyph['width'] + 5
+
+    # 添加干擾線
+    line_ys, line_xs, owners = _line_pixels(line_rand[:, :4].astype(np.float32), width, height, thickness=2)
+    pixels[line_ys, line_xs] = line_rand[owners, 4:] + 150
+
+    # 添加干擾點
+    pixels[noise[:, 0], noise[:, 1]] = noise[:, 2:]
+
+    # 轉換為 BytesIO
+    return io.BytesIO(encode_captcha_image(pixels, image_format))
+
+# ==================== 驗證碼預先產生池 ====================
+
+CAPTCHA_POOL_LOW = int(os.getenv('CAPTCHA_POOL_LOW', '20'))  # 低於此數量時開始補充
+CAPTCHA_POOL_HIGH = int(os.getenv('CAPTCHA_POOL_HIGH', '100'))  # 補充到此數量後暫停
 
-def check_column_exists(table, column):
-    """檢查資料表欄位是否存在（帶快取）"""
-    cache_key = f"{table}.{column}"
-    if cache_key in _db_columns_cache:
-        return _db_columns_cache[cache_key]
+def generate_captcha_text():
+    """生成隨機驗證碼文字（4 個字符）"""
+    return ''.join(random.choices(CAPTCHA_CHARSET, k=4))
+
+def render_captcha():
+    """產生一組 (驗證碼文字, 圖片 bytes)，格式由 CAPTCHA_IMAGE_FORMAT 決定"""
+    captcha_text = generate_captcha_text()
+    started = time.perf_counter()
+    image_bytes = generate_captcha_image(captcha_text, image_format=CAPTCHA_IMAGE_FORMAT).getvalue()
+    observe_metric('captcha_render_seconds', (('format', CAPTCHA_IMAGE_FORMAT),), time.perf_counter() - started)
+    return captcha_text, image_bytes
+
+class CaptchaPool:
+    """
+    預先產生的驗證碼環形緩衝區
+
+    背景執行緒在數量低於 low 時補充到 high，請求只需取出一組現成的驗證碼；
+    緩衝區為空時回傳 None，由呼叫端改為即時產生。
+    """
+
+    def __init__(self, render, low=20, high=100):
+        self._render = render
+        self.low = low
+        self.high = max(high, low)
+        self._items = deque(maxlen=self.high)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stats = {
+            'hits': 0,        # 直接從池中取得
+            'misses': 0,      # 池為空，改為即時產生
+            'produced': 0,    # 背景執行緒產生總數
+            'refills': 0,     # 補充輪數
+            'errors': 0,      # 背景產生失敗次數
+        }
+        self._last_refill_rate = 0.0  # 最近一輪補充速度（張/秒）
+
+    def _ensure_worker(self):
+        # 延遲到第一次使用才啟動，避免 fork 前建立的執行緒在子行程中失效
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='captcha-pool', daemon=True)
+            self._thread.start()
+
+    def pop(self):
+        """取出一組 (驗證碼文字, 圖片 bytes)，池為空時回傳 None"""
+        with self._cond:
+            self._ensure_worker()
+            if self._items:
+                item = self._items.popleft()
+                self._stats['hits'] += 1
+            else:
+                item = None
+                self._stats['misses'] += 1
+            if len(self._items) < self.low:
+                self._cond.notify()
+        return item
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._items) >= self.low:
+                    self._cond.wait()
+                self._stats['refills'] += 1
+
+            started = time.monotonic()
+            produced = 0
+            while True:
+                with self._cond:
+                    if len(self._items) >= self.high:
+                        break
+                try:
+                    item = run_cpu_bound(self._render)
+                except Exception:
+                    with self._cond:
+                        self._stats['errors'] += 1
+                    time.sleep(1)
+                    break
+                with self._cond:
+                    self._items.append(item)
+                    self._stats['produced'] += 1
+                produced += 1
+
+            elapsed = time.monotonic() - started
+            if produced and elapsed > 0:
+                with self._cond:
+                    self._last_refill_rate = produced / elapsed
+
+    def stats(self):
+        """取得池深度與補充速度等指標"""
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot['depth'] = len(self._items)
+            snapshot['low'] = self.low
+            snapshot['high'] = self.high
+            snapshot['refill_rate'] = round(self._last_refill_rate, 2)
+            snapshot['worker_alive'] = self._thread is not None and self._thread.is_alive()
+        return snapshot
+
+captcha_pool = CaptchaPool(render_captcha, low=CAPTCHA_POOL_LOW, high=CAPTCHA_POOL_HIGH)
+
+# ==================== 驗證碼存儲 ====================
+
+CAPTCHA_TTL = 300  # 驗證碼 5 分鐘過期
+CAPTCHA_STORE_BACKEND = os.getenv('CAPTCHA_STORE', 'memory')  # memory 或 redis
+CAPTCHA_STORE_URL = os.getenv('CAPTCHA_STORE_URL', 'redis://localhost:6379/0')
+CAPTCHA_STORE_MAX_ENTRIES = int(os.getenv('CAPTCHA_STORE_MAX_ENTRIES', '100000'))
+
+class CaptchaStore:
+    """
+    驗證碼答案存儲介面
+
+    pop() 必須是原子的「取出並刪除」，確保同一個驗證碼只能驗證一次。
+    """
+
+    def set(self, token, answer, ttl):
+        raise NotImplementedError
+
+    def pop(self, token):
+        """取出並刪除答案，不存在或已過期時回傳 None"""
+        raise NotImplementedError
+
+    def ping(self):
+        """檢查存儲是否可用（行程內存儲永遠可用）"""
+        return True
+
+class MemoryCaptchaStore(CaptchaStore):
+    """
+    行程內驗證碼存儲
+
+    以最小堆依到期時間排序，每次寫入時清除已過期項目；
+    超過 max_entries 時淘汰最早到期的項目，記憶體用量有上限。
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._entries = {}  # token -> (answer, expires_at)
+        self._expiry = []  # (expires_at, token) 最小堆
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        # 堆中可能殘留已被 pop 或覆寫的項目，以 _entries 內的到期時間為準
+        while self._expiry and (self._expiry[0][0] <= now or len(self._entries) > self.max_entries):
+            expires_at, token = heapq.heappop(self._expiry)
+            entry = self._entries.get(token)
+            if entry is not None and entry[1] == expires_at:
+                del self._entries[token]
+
+    def set(self, token, answer, ttl):
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            self._entries[token] = (answer, expires_at)
+            heapq.heappush(self._expiry, (expires_at, token))
+            self._evict(time.monotonic())
+            # 堆中過時項目太多時重建，避免只增不減
+            if len(self._expiry) > 2 * self.max_entries:
+                self._expiry = [(entry[1], key) for key, entry in self._entries.items()]
+                heapq.heapify(self._expiry)
+
+    def pop(self, token):
+        with self._lock:
+            entry = self._entries.pop(token, None)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def __len__(self):
+        return len(self._entries)
+
+class RedisCaptchaStore(CaptchaStore):
+    """
+    Redis 協定的共用驗證碼存儲，多個 worker / 節點共用同一份答案
+
+    client 只需支援 set(ex=) / getdel / pipeline，可替換為本機的
+    Redis 相容服務（如 fakeredis）做測試。
+    """
+
+    def __init__(self, client, prefix='captcha:', decode=True):
+        self._client = client
+        self._prefix = prefix
+        self._decode = decode
+
+    def ping(self):
+        return bool(self._client.ping())
+
+    def set(self, token, answer, ttl):
+        self._client.set(self._prefix + token, answer, ex=int(ttl))
+
+    def pop(self, token):
+        key = self._prefix + token
+        try:
+            value = self._client.getdel(key)
+        except Exception:
+            # Redis 6.2 以前沒有 GETDEL，改用 MULTI/EXEC 交易
+            pipe = self._client.pipeline(transaction=True)
+            pipe.get(key)
+            pipe.delete(key)
+            value = pipe.execute()[0]
+        if value is None:
+            return None
+        return value.decode('utf-8') if self._decode and isinstance(value, bytes) else value
+
+def create_captcha_store(prefix='captcha:', decode=True):
+    """依 CAPTCHA_STORE 設定建立驗證碼存儲"""
+    if CAPTCHA_STORE_BACKEND == 'redis':
+        import redis
+        return RedisCaptchaStore(redis.Redis.from_url(CAPTCHA_STORE_URL), prefix=prefix, decode=decode)
+    return MemoryCaptchaStore(max_entries=CAPTCHA_STORE_MAX_ENTRIES)
+
+captcha_store = create_captcha_store()
+
+# 以 URL 取圖模式下暫存的驗證碼圖片（只能讀取一次）
+CAPTCHA_IMAGE_TTL = 60
+captcha_image_store = create_captcha_store(prefix='captcha-image:', decode=False)
+
+# ==================== 無狀態驗證碼 ====================
+
+CAPTCHA_MODE = os.getenv('CAPTCHA_MODE', 'store')  # store（伺服器存答案）或 stateless（token 自帶答案雜湊）
+CAPTCHA_REPLAY_CAPACITY = int(os.getenv('CAPTCHA_REPLAY_CAPACITY', '100000'))  # 每 5 分鐘預估驗證次數
+CAPTCHA_REPLAY_ERROR_RATE = float(os.getenv('CAPTCHA_REPLAY_ERROR_RATE', '0.0001'))
+
+class BloomFilter:
+    """固定大小的 Bloom filter（以 blake2b 雙重雜湊產生 k 個位置）"""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+
+class ReplayFilter:
+    """
+    依時間分區的已使用 nonce 過濾器
+
+    保留「目前」與「上一個」時間窗各一個 Bloom filter，
+    任何 nonce 至少會被記住 window 秒，之後整個分區一起丟棄；
+    記憶體只與時間窗內的驗證次數有關。誤判（false positive）時
+    只會讓使用者需要重新取得驗證碼。
+    """
+
+    def __init__(self, window, capacity, error_rate):
+        self.window = window
+        self._filters = [BloomFilter(capacity, error_rate), BloomFilter(capacity, error_rate)]
+        self._bucket = int(time.time() // window)
+        self._lock = threading.Lock()
+
+    def _rotate(self, now):
+        bucket = int(now // self.window)
+        if bucket == self._bucket:
+            return
+        current, previous = self._filters
+        previous.clear()
+        if bucket == self._bucket + 1:
+            # 目前分區變成上一個分區
+            self._filters = [previous, current]
+        else:
+            # 閒置超過兩個時間窗，兩個分區都已過期
+            current.clear()
+        self._bucket = bucket
+
+    def check_and_add(self, nonce):
+        """nonce 已使用過時回傳 True，否則記錄並回傳 False"""
+        with self._lock:
+            self._rotate(time.time())
+            if any(nonce in bloom for bloom in self._filters):
+                return True
+            self._filters[0].add(nonce)
+            return False
+
+captcha_replay_filter = ReplayFilter(CAPTCHA_TTL, CAPTCHA_REPLAY_CAPACITY, CAPTCHA_REPLAY_ERROR_RATE)
+
+def _captcha_answer_digest(salt, answer):
+    """以 CAPTCHA_SECRET_KEY 對正規化後的答案做加鹽 HMAC"""
+    normalized = answer.strip().upper()
+    return hmac.new(
+        CAPTCHA_SECRET_KEY.encode('utf-8'),
+        f"{salt}:{normalized}".encode('utf-8'),
+        hashlib.sha256
+    ).hexdigest()
+
+def generate_captcha_token(answer=None):
+    """
+    生成驗證碼 token
+
+    Args:
+        answer: 驗證碼答案；提供時產生無狀態 token（自帶答案雜湊、到期時間與 nonce）
+
+    Returns:
+        captcha_token: 驗證碼 token
+    """
+    now = time.time()
+    if answer is None:
+        return pyjwt.encode({'timestamp': now}, CAPTCHA_SECRET_KEY, algorithm='HS256')
+
+    salt = secrets.token_urlsafe(8)
+    return pyjwt.encode(
+        {
+            'timestamp': now,
+            'exp': int(now + CAPTCHA_TTL),
+            'nonce': secrets.token_urlsafe(12),
+            'salt': salt,
+            'answer': _captcha_answer_digest(salt, answer)
+        },
+        CAPTCHA_SECRET_KEY,
+        algorithm='HS256'
+    )
+
+def verify_captcha_token(token, answer):
+    """驗證驗證碼"""
+    try:
+        payload = pyjwt.decode(token, CAPTCHA_SECRET_KEY, algorithms=['HS256'])
+        timestamp = payload.get('timestamp', 0)
+        
+        # 驗證碼 5 分鐘過期
+        if time.time() - timestamp > CAPTCHA_TTL:
+            return False, '驗證碼已過期'
+
+        # 無狀態 token：比對 token 內的答案雜湊，nonce 只能使用一次
+        if 'answer' in payload:
+            if captcha_replay_filter.check_and_add(payload['nonce']):
+                return False, '驗證碼無效'
+            expected = _captcha_answer_digest(payload['salt'], answer)
+            if not hmac.compare_digest(expected, payload['answer']):
+                return False, '驗證碼錯誤'
+            return True, None
+        
+        # 從存儲中取出答案（取出即刪除，只能驗證一次）
+        stored_answer = captcha_store.pop(token)
+        if stored_answer is None:
+            return False, '驗證碼無效'
+        
+        if stored_answer.lower() != answer.lower():
+            return False, '驗證碼錯誤'
+        
+        return True, None
+    except pyjwt.ExpiredSignatureError:
+        return False, '驗證碼已過期'
+    except Exception:
+        return False, '驗證碼驗證失敗'
+
+def get_lockout_until(user):
+    """由用戶資料列判斷是否仍在鎖定期間，回傳鎖定到期時間或 None"""
+    lockout_time = user.get('lockout_until') if user else None
+    if not lockout_time:
+        return None
+
+    if isinstance(lockout_time, str):
+        lockout_time = datetime.fromisoformat(lockout_time.replace('Z', '+00:00'))
+
+    if isinstance(lockout_time, datetime) and lockout_time > datetime.now():
+        return lockout_time
+    return None
+
+# ==================== 登入失敗追蹤 ====================
+
+LOGIN_MAX_FAILURES = int(os.getenv('LOGIN_MAX_FAILURES', '5'))  # 時間窗內失敗幾次後鎖定
+LOGIN_FAILURE_WINDOW = int(os.getenv('LOGIN_FAILURE_WINDOW', '1800'))  # 滑動時間窗（秒）
+LOGIN_LOCKOUT_SECONDS = int(os.getenv('LOGIN_LOCKOUT_SECONDS', '1800'))  # 鎖定時間（秒）
+LOGIN_FAILURE_FLUSH_INTERVAL = float(os.getenv('LOGIN_FAILURE_FLUSH_INTERVAL', '5'))  # 寫回資料庫的間隔（秒）
+LOGIN_FAILURE_STORE = os.getenv('LOGIN_FAILURE_STORE', 'memory')  # memory 或 redis（多 worker 共用計數）
+LOGIN_FAILURE_STORE_URL = os.getenv('LOGIN_FAILURE_STORE_URL', CAPTCHA_STORE_URL)
+
+class MemoryFailureWindow:
+    """行程內的滑動時間窗計數器（每個用戶一個時間戳佇列）"""
+
+    def __init__(self, window):
+        self.window = window
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """記錄一次失敗，回傳時間窗內的失敗次數"""
+        now = time.monotonic()
+        with self._lock:
+            events = self._events.setdefault(key, deque())
+            events.append(now)
+            while events and events[0] <= now - self.window:
+                events.popleft()
+            return len(events)
+
+    def clear(self, key):
+        with self._lock:
+            self._events.pop(key, None)
+
+    def prune(self):
+        """移除時間窗外已無失敗紀錄的用戶"""
+        cutoff = time.monotonic() - self.window
+        with self._lock:
+            for key in [key for key, events in self._events.items() if not events or events[-1] <= cutoff]:
+                del self._events[key]
+
+class RedisFailureWindow:
+    """以 Redis sorted set 實作、多 worker 共用的滑動時間窗計數器"""
+
+    def __init__(self, client, window, prefix='login-failures:'):
+        self._client = client
+        self.window = window
+        self._prefix = prefix
+
+    def add(self, key):
+        now = time.time()
+        redis_key = self._prefix + key
+        pipe = self._client.pipeline(transaction=True)
+        pipe.zadd(redis_key, {f'{now}:{secrets.token_hex(4)}': now})
+        pipe.zremrangebyscore(redis_key, 0, now - self.window)
+        pipe.zcard(redis_key)
+        pipe.expire(redis_key, int(self.window))
+        return pipe.execute()[2]
+
+    def clear(self, key):
+        self._client.delete(self._prefix + key)
+
+    def prune(self):
+        # 由 Redis 的 EXPIRE 自動清除
+        pass
+
+class FailedLoginTracker:
+    """
+    登入失敗追蹤
+
+    失敗次數與鎖定在記憶體中判斷，資料庫的 failed_attempts / lockout_until
+    由背景執行緒每隔 flush_interval 以批次原子 UPDATE 寫回；
+    遭受撞庫攻擊時，資料庫寫入頻率只取決於寫回間隔而非攻擊流量。
+    """
+
+    def __init__(self, window_counter, max_failures=5, lockout_seconds=1800, flush_interval=5.0):
+        self._counter = window_counter
+        self.max_failures = max_failures
+        self.lockout_seconds = lockout_seconds
+        self.flush_interval = flush_interval
+        self._lockouts = {}  # username -> 鎖定到期時間
+        self._pending = {}  # username -> [待寫回的失敗次數, 鎖定到期時間或 None]
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='login-failure-flush', daemon=True)
+            self._thread.start()
+
+    def locked_until(self, username):
+        """記憶體中的鎖定到期時間，未鎖定時回傳 None"""
+        with self._lock:
+            until = self._lockouts.get(username)
+            if until and until <= datetime.now():
+                del self._lockouts[username]
+                return None
+            return until
+
+    def record_failure(self, username):
+        """記錄一次登入失敗，達到上限時鎖定並回傳鎖定到期時間"""
+        count = self._counter.add(username)
+        lockout_until = None
+        if count >= self.max_failures:
+            lockout_until = datetime.now() + timedelta(seconds=self.lockout_seconds)
+
+        with self._lock:
+            self._ensure_worker()
+            pending = self._pending.setdefault(username, [0, None])
+            pending[0] += 1
+            if lockout_until:
+                pending[1] = lockout_until
+                self._lockouts[username] = lockout_until
+        return lockout_until
+
+    def reset(self, username):
+        """登入成功後清除記憶體中的失敗紀錄與尚未寫回的次數"""
+        self._counter.clear(username)
+        with self._lock:
+            self._lockouts.pop(username, None)
+            self._pending.pop(username, None)
+
+    def flush(self):
+        """將累積的失敗次數批次寫回資料庫"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            now = datetime.now()
+            for username in [name for name, until in self._lockouts.items() if until <= now]:
+                del self._lockouts[username]
+        self._counter.prune()
+
+        schema = get_schema()
+        if not pending or not schema.has_failed_attempts:
+            return 0
+
+        if schema.has_lockout:
+            sql = '''UPDATE users SET failed_attempts = COALESCE(failed_attempts, 0) + %s,
+                     lockout_until = COALESCE(%s, lockout_until) WHERE username = %s'''
+            rows = [(count, until, username) for username, (count, until) in pending.items()]
+        else:
+            sql = 'UPDATE users SET failed_attempts = COALESCE(failed_attempts, 0) + %s WHERE username = %s'
+            rows = [(count, username) for username, (count, until) in pending.items()]
+
+        try:
+            conn = db_pool.acquire()
+            try:
+                cursor = conn.cursor()
+                cursor.executemany(sql, rows)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception:
+            self._requeue(pending)
+            raise
+        return len(rows)
+
+    def _requeue(self, pending):
+        """寫回失敗時把這一批放回待寫回清單，與期間新增的失敗次數合併"""
+        with self._lock:
+            for username, (count, until) in pending.items():
+                current = self._pending.setdefault(username, [0, None])
+                current[0] += count
+                if until and (current[1] is None or until > current[1]):
+                    current[1] = until
+
+    def flush_on_exit(self):
+        """行程結束時最後一次寫回，失敗時只記錄日誌"""
+        try:
+            self.flush()
+        except Exception:
+            app.logger.warning('結束前寫回登入失敗次數失敗，%d 位用戶的紀錄遺失', len(self._pending))
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+def create_failure_window():
+    """依 LOGIN_FAILURE_STORE 設定建立失敗計數器"""
+    if LOGIN_FAILURE_STORE == 'redis':
+        import redis
+        return RedisFailureWindow(redis.Redis.from_url(LOGIN_FAILURE_STORE_URL), LOGIN_FAILURE_WINDOW)
+    return MemoryFailureWindow(LOGIN_FAILURE_WINDOW)
+
+failed_login_tracker = FailedLoginTracker(
+    create_failure_window(),
+    max_failures=LOGIN_MAX_FAILURES,
+    lockout_seconds=LOGIN_LOCKOUT_SECONDS,
+    flush_interval=LOGIN_FAILURE_FLUSH_INTERVAL
+)
+
+# 行程結束前寫回尚未寫入資料庫的登入失敗次數（gunicorn 等 WSGI 伺服器匯入時同樣生效）
+atexit.register(failed_login_tracker.flush_on_exit)
+
+def record_failed_login(username):
+    """記錄登入失敗（資料庫由背景批次寫回）"""
+    return failed_login_tracker.record_failure(username)
+
+def reset_failed_attempts(username, user=None):
+    """
+    重置登入失敗次數
+
+    Args:
+        username: 用戶名
+        user: 已查出的用戶資料列；資料庫中的次數已為 0 時不再寫入
+    """
+    failed_login_tracker.reset(username)
+
+    schema = get_schema()
+    if not schema.has_failed_attempts:
+        return
+    if user is not None and not user.get('failed_attempts') and not user.get('lockout_until'):
+        return
 
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute(f"SHOW COLUMNS FROM {table} LIKE %s", (column,))
-        exists = cursor.fetchone() is not None
+        cursor.execute(RESET_FAILED_ATTEMPTS_SQL[schema.has_lockout], (username,))
+        conn.commit()
         conn.close()
-        _db_columns_cache[cache_key] = exists
-        return exists
     except Exception:
-        return False
+        pass
+
+# ==================== 密碼雜湊服務 ====================
+
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 2)))  # 0 = 在請求執行緒內計算
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE_SIZE', '64'))  # 等待中的雜湊工作上限
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', '5'))  # 單次雜湊最長等待秒數
+
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', '')  # 明確指定，例如 scrypt:32768:8:1，留空則自動校準
+PASSWORD_HASH_ALGORITHM = os.getenv('PASSWORD_HASH_ALGORITHM', 'scrypt')  # 自動校準使用的演算法：scrypt 或 pbkdf2
+PASSWORD_HASH_TARGET_MS = float(os.getenv('PASSWORD_HASH_TARGET_MS', '50'))  # 自動校準的目標驗證耗時
+
+class PasswordHashPolicy:
+    """
+    密碼雜湊參數
+
+    未明確指定時，依本機速度校準出最接近目標耗時的參數，但不低於 Werkzeug 預設值；
+    參數在啟動時決定，調整 PASSWORD_HASH_* 設定後需重新啟動，舊雜湊仍可驗證。
+    使用者登入時只會把成本低於目前設定的雜湊升級，不會降級。
+    """
+
+    # 安全下限（Werkzeug 預設值）與上限
+    SCRYPT_MIN_N = 2 ** 15
+    SCRYPT_MAX_N = 2 ** 17
+    PBKDF2_MIN_ITERATIONS = DEFAULT_PBKDF2_ITERATIONS
+
+    def __init__(self, method='', algorithm='scrypt', target_ms=50.0):
+        self.algorithm = algorithm
+        self.target_ms = target_ms
+        self._method = method or None
+        self._lock = threading.Lock()
+
+    @property
+    def method(self):
+        if self._method is None:
+            with self._lock:
+                if self._method is None:
+                    self._method = self.calibrate()
+        return self._method
+
+    def calibrate(self):
+        """量測本機速度，回傳最接近目標耗時的 method 字串"""
+        target = self.target_ms / 1000.0
+        if self.algorithm == 'pbkdf2':
+            base = 10000
+            elapsed = self._measure(f'pbkdf2:sha256:{base}')
+            iterations = int(base * target / elapsed) // 1000 * 1000
+            return f'pbkdf2:sha256:{max(iterations, self.PBKDF2_MIN_ITERATIONS)}'
+
+        # scrypt 耗時與 N 成正比，以 2^12 為基準推算
+        base = 2 ** 12
+        elapsed = self._measure(f'scrypt:{base}:8:1')
+        n = self.SCRYPT_MIN_N
+        while n * 2 <= self.SCRYPT_MAX_N and elapsed * (n * 2 / base) <= target:
+            n *= 2
+        return f'scrypt:{n}:8:1'
+
+    @staticmethod
+    def _measure(method, rounds=3):
+        best = None
+        for _ in range(rounds):
+            started = time.perf_counter()
+            generate_password_hash('calibration', method=method)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    @staticmethod
+    def parse_method(method):
+        """
+        把 method 字串展開成 (演算法, 參數)，補上 Werkzeug 省略參數時的預設值
+
+        例如 scrypt -> ('scrypt', (32768, 8, 1))，pbkdf2:sha512 -> ('pbkdf2', ('sha512', 600000))；
+        無法辨識時回傳 (演算法, None)。
+        """
+        algorithm, *args = method.split(':')
+        try:
+            if algorithm == 'scrypt':
+                n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+                return algorithm, (n, r, p)
+            if algorithm == 'pbkdf2' and len(args) <= 2:
+                hash_name = args[0] if args else 'sha256'
+                iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+                return algorithm, (hash_name, iterations)
+        except ValueError:
+            pass
+        return algorithm, None
+
+    @staticmethod
+    def _cost(algorithm, params):
+        if algorithm == 'scrypt':
+            n, r, p = params
+            return n * r * p
+        return params[1]
+
+    def needs_rehash(self, pwhash):
+        """
+        雜湊需要升級時回傳 True
+
+        演算法（或 pbkdf2 的摘要函式）不同時改用目前設定；相同時只在成本低於目前設定時重新雜湊，
+        因此暫時調低參數不會把既有使用者降級。
+        """
+        stored_algorithm, stored = self.parse_method(pwhash.split('$', 1)[0])
+        algorithm, current = self.parse_method(self.method)
+        if current is None:
+            return False
+        if stored is None or stored_algorithm != algorithm:
+            return True
+        if algorithm == 'pbkdf2' and stored[0] != current[0]:
+            return True
+        return self._cost(stored_algorithm, stored) < self._cost(algorithm, current)
+
+password_hash_policy = PasswordHashPolicy(PASSWORD_HASH_METHOD, PASSWORD_HASH_ALGORITHM, PASSWORD_HASH_TARGET_MS)
+
+class PasswordHashBusyError(Exception):
+    """雜湊佇列已滿或等待逾時，回應 503 並附上 Retry-After"""
+
+    def __init__(self, retry_after):
+        super().__init__('伺服器忙碌中，請稍後再試')
+        self.retry_after = retry_after
+
+class PasswordHasher:
+    """
+    以行程池計算密碼雜湊
+
+    scrypt / pbkdf2 會佔住請求 worker 數十毫秒，交給獨立行程後
+    登入吞吐量隨 CPU 核心數增加；佇列滿時直接拒絕，避免請求無限堆積。
+    """
+
+    def __init__(self, workers, queue_size, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(workers, 1) + queue_size)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._avg_seconds = 0.05  # 單次雜湊耗時的指數移動平均
+        self._pending = 0
+
+    def _get_executor(self):
+        # 行程池不能跨 fork 共用，每個 worker 行程各自建立
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _retry_after(self):
+        return max(1, math.ceil(self._pending * self._avg_seconds / max(self.workers, 1)))
+
+    def _run(self, func, *args):
+        if self.workers <= 0:
+            return func(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHashBusyError(self._retry_after())
+        with self._lock:
+            self._pending += 1
+        started = time.monotonic()
+        try:
+            future = self._get_executor().submit(func, *args)
+        except Exception:
+            self._finish()
+            raise
+        # 名額在工作真正結束（或在佇列中被取消）時才歸還：等待逾時後已在執行的工作
+        # 仍佔著子行程，提早歸還會讓同時進行的雜湊數超過上限
+        future.add_done_callback(self._finish)
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise PasswordHashBusyError(self._retry_after())
+
+        with self._lock:
+            self._avg_seconds = self._avg_seconds * 0.9 + (time.monotonic() - started) * 0.1
+        return result
+
+    def _finish(self, future=None):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    @staticmethod
+    def _algorithm(method):
+        # 標籤值只允許已知演算法，避免資料庫中的異常雜湊產生大量時間序列
+        algorithm = method.split(':', 1)[0]
+        return algorithm if algorithm in ('scrypt', 'pbkdf2') else 'other'
+
+    def hash(self, password):
+        method = password_hash_policy.method
+        started = time.monotonic()
+        result = self._run(generate_password_hash, password, method)
+        observe_metric('password_hash_seconds', (('operation', 'hash'), ('algorithm', self._algorithm(method))),
+                       time.monotonic() - started)
+        return result
+
+    def verify(self, pwhash, password):
+        started = time.monotonic()
+        result = self._run(check_password_hash, pwhash, password)
+        observe_metric('password_hash_seconds', (('operation', 'verify'), ('algorithm', self._algorithm(pwhash))),
+                       time.monotonic() - started)
+        return result
+
+    def stats(self):
+        """取得等待中的雜湊數（各演算法耗時見 password_hash_seconds 指標）"""
+        with self._lock:
+            return {'pending': self._pending}
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_SIZE, PASSWORD_HASH_TIMEOUT)
+
+_rehash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='password-rehash')
+
+def _rehash_password(user_id, old_hash, password):
+    """以目前參數重新雜湊，只在密碼未被同時修改時寫回"""
+    try:
+        new_hash = password_hasher.hash(password)
+        conn = db_pool.acquire()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE users SET password = %s WHERE id = %s AND password = %s',
+                (new_hash, user_id, old_hash)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception:
+        pass
+
+def schedule_rehash(user_id, old_hash, password):
+    """登入成功後，若雜湊參數過時則在背景重新雜湊"""
+    if password_hash_policy.needs_rehash(old_hash):
+        _rehash_executor.submit(_rehash_password, user_id, old_hash, password)
+
+def hash_busy_response(error):
+    """雜湊服務忙碌時的 503 回應"""
+    return jsonify({'message': str(error)}), 503, {'Retry-After': str(error.retry_after)}
+
+# ==================== 速率限制 ====================
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', 'memory')  # memory 或 redis（多 worker 共用）
+RATE_LIMIT_STORE_URL = os.getenv('RATE_LIMIT_STORE_URL', CAPTCHA_STORE_URL)
+
+# 各端點的令牌桶設定：範圍 -> (每秒補充令牌數, 桶容量)
+# ip = 每個客戶端 IP，username = 每個帳號，global = 整個端點
+RATE_LIMITS = {
+    'get_captcha': {
+        'ip': (1.0, 20),
+        'global': (200.0, 400),
+    },
+    'login': {
+        'ip': (0.5, 10),
+        'username': (0.2, 5),
+        'global': (100.0, 200),
+    },
+    'register': {
+        'ip': (0.1, 5),
+        'global': (20.0, 40),
+    },
+    'refresh_access_token': {
+        'ip': (1.0, 20),
+    },
+}
+
+class MemoryTokenBuckets:
+    """
+    行程內令牌桶
+
+    以 OrderedDict 保存最近使用的桶，超過 max_entries 時淘汰最久未使用的桶
+    （被淘汰的桶視為已補滿）。
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()  # key -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst):
+        """取用一個令牌，回傳 (是否允許, 需等待秒數)"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [float(burst), now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_entries:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True, 0
+            return False, (1 - bucket[0]) / rate
+
+class RedisTokenBuckets:
+    """以 Redis Lua 腳本原子更新、多 worker 共用的令牌桶"""
+
+    SCRIPT = """
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, client, prefix='ratelimit:'):
+        self._prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+
+    def consume(self, key, rate, burst):
+        allowed, tokens = self._script(keys=[self._prefix + key], args=[rate, burst, time.time()])
+        if allowed:
+            return True, 0
+        return False, (1 - float(tokens)) / rate
+
+def create_token_buckets():
+    """依 RATE_LIMIT_STORE 設定建立令牌桶存儲"""
+    if RATE_LIMIT_STORE == 'redis':
+        import redis
+        return RedisTokenBuckets(redis.Redis.from_url(RATE_LIMIT_STORE_URL))
+    return MemoryTokenBuckets()
+
+rate_limit_buckets = create_token_buckets()
 
-def execute_with_connection(func):
-    """資料庫連接裝飾器，自動管理連接的開啟和關閉"""
-    def wrapper(*args, **kwargs):
-        conn = get_db_connection()
-        try:
-            result = func(conn, *args, **kwargs)
-            return result
-        finally:
-            conn.close()
-    return wrapper
+def client_ip():
+    """客戶端 IP（TRUSTED_PROXY_COUNT > 0 時已由 ProxyFix 依 X-Forwarded-For 解析）"""
+    return request.remote_addr or 'unknown'
 
-# 驗證碼生成器
-def generate_captcha_image(text, width=200, height=80):
-    """生成驗證碼圖片"""
-    # 創建圖片
-    image = Image.new('RGB', (width, height), color=(255, 255, 255))
-    draw = ImageDraw.Draw(image)
-    
-    # 嘗試載入字體，如果失敗則使用默認字體
-    try:
-        # Windows 系統字體路徑
-        font_path = 'C:/Windows/Fonts/arial.ttf'
-        if not os.path.exists(font_path):
-            font_path = 'C:/Windows/Fonts/calibri.ttf'
-        if os.path.exists(font_path):
-            font = ImageFont.truetype(font_path, 36)
-        else:
-            font = ImageFont.load_default()
-    except:
-        font = ImageFont.load_default()
-    
-    # 繪製文字
-    text_width = sum(draw.textbbox((0, 0), char, font=font)[2] - draw.textbbox((0, 0), char, font=font)[0] for char in text)
-    text_height = draw.textbbox((0, 0), text, font=font)[3] - draw.textbbox((0, 0), text, font=font)[1]
-    
-    x = (width - text_width) / 2
-    y = (height - text_height) / 2
-    
-    # 繪製每個字符，添加隨機偏移和顏色
-    char_x = x
-    for char in text:
-        # 隨機顏色
-        color = (random.randint(0, 100), random.randint(0, 100), random.randint(0, 100))
-        # 隨機偏移
-        offset_y = random.randint(-5, 5)
-        draw.text((char_x, y + offset_y), char, fill=color, font=font)
-        # 獲取字符寬度
-        bbox = draw.textbbox((0, 0), char, font=font)
-        char_x += (bbox[2] - bbox[0]) + 5
-    
-    # 添加干擾線
-    for _ in range(3):
-        start = (random.randint(0, width), random.randint(0, height))
-        end = (random.randint(0, width), random.randint(0, height))
-        draw.line([start, end], fill=(random.randint(150, 255), random.randint(150, 255), random.randint(150, 255)), width=2)
-    
-    # 添加干擾點
-    for _ in range(50):
-        x_point = random.randint(0, width)
-        y_point = random.randint(0, height)
-        draw.point((x_point, y_point), fill=(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
-    
-    # 轉換為 BytesIO
-    img_io = io.BytesIO()
-    image.save(img_io, format='PNG')
-    img_io.seek(0)
-    return img_io
+def rate_limit_keys(endpoint, limits):
+    """
+    列出本次請求要檢查的 (桶 key, 設定)
 
-# 驗證碼存儲（實際應用中應使用 Redis 等）
-captcha_store = {}
+    依序檢查、遇到拒絕即停止，因此全域桶排在最後：被自己的 IP / 用戶名桶擋下的請求
+    不會消耗全域令牌，單一客戶端無法耗盡全域額度讓其他人也收到 429。
+    """
+    keys = []
+    if 'ip' in limits:
+        keys.append((f'{endpoint}:ip:{client_ip()}', limits['ip']))
+    if 'username' in limits:
+        data = request.get_json(silent=True) or {}
+        username = data.get('username')
+        if isinstance(username, str) and username:
+            keys.append((f'{endpoint}:user:{username.lower()}', limits['username']))
+    if 'global' in limits:
+        keys.append((f'{endpoint}:global', limits['global']))
+    return keys
 
-def generate_captcha_token():
-    """生成驗證碼 token"""
-    return pyjwt.encode(
-        {'timestamp': time.time()},
-        CAPTCHA_SECRET_KEY,
-        algorithm='HS256'
-    )
+@app.before_request
+def enforce_rate_limit():
+    """在處理函數前檢查令牌桶，超過限制直接回應 429，不做任何資料庫或圖片運算"""
+    if not RATE_LIMIT_ENABLED:
+        return None
+    limits = RATE_LIMITS.get(request.endpoint)
+    if not limits:
+        return None
 
-def verify_captcha_token(token, answer):
-    """驗證驗證碼"""
     try:
-        payload = pyjwt.decode(token, CAPTCHA_SECRET_KEY, algorithms=['HS256'])
-        timestamp = payload.get('timestamp', 0)
-        
-        # 驗證碼 5 分鐘過期
-        if time.time() - timestamp > 300:
-            return False, '驗證碼已過期'
-        
-        # 從存儲中獲取答案
-        if token not in captcha_store:
-            return False, '驗證碼無效'
-        
-        stored_answer = captcha_store[token]
-        # 清理已使用的驗證碼
-        del captcha_store[token]
-        
-        if stored_answer.lower() != answer.lower():
-            return False, '驗證碼錯誤'
-        
-        return True, None
+        for key, (rate, burst) in rate_limit_keys(request.endpoint, limits):
+            allowed, retry_after = rate_limit_buckets.consume(key, rate, burst)
+            if not allowed:
+                return jsonify({'message': '請求過於頻繁，請稍後再試'}), 429, {
+                    'Retry-After': str(max(1, math.ceil(retry_after)))
+                }
     except Exception:
-        return False, '驗證碼驗證失敗'
+        # 限流存儲故障時放行，避免影響正常登入
+        return None
+    return None
 
-def check_account_lockout(username):
-    """檢查帳號是否被鎖定"""
-    if not check_column_exists('users', 'lockout_until'):
-        return False, None
+# ==================== JSON 序列化與回應壓縮 ====================
 
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT failed_attempts, lockout_until FROM users WHERE username = %s',
-            (username,)
-        )
-        user = cursor.fetchone()
-        conn.close()
+COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', 'true').lower() == 'true'
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))  # 小於此位元組數不壓縮
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))  # gzip 壓縮等級
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', '4'))  # brotli 品質，越高越慢
+COMPRESS_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
 
-        if not user or not user.get('lockout_until'):
-            return False, None
+try:
+    import orjson
+except ImportError:  # 未安裝時退回 Flask 預設的 json 模組
+    orjson = None
 
-        lockout_time = user['lockout_until']
-        if isinstance(lockout_time, str):
-            lockout_time = datetime.fromisoformat(lockout_time.replace('Z', '+00:00'))
+try:
+    import brotli
+except ImportError:  # 未安裝時只提供 gzip
+    brotli = None
 
-        if isinstance(lockout_time, datetime) and lockout_time > datetime.now():
-            return True, lockout_time
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    以 orjson 序列化的 JSON provider
 
-        return False, None
-    except Exception:
-        return False, None
+    輸出格式與 Flask 預設相同（鍵排序、精簡分隔、除錯模式縮排 2 格、
+    datetime 轉 HTTP 日期、Decimal 轉字串），差別是非 ASCII 字元直接以
+    UTF-8 輸出而不轉成 \\uXXXX。帶有其他 json.dumps 參數時交給父類別處理。
+    """
 
-def record_failed_login(username):
-    """記錄登入失敗"""
-    if not check_column_exists('users', 'failed_attempts'):
-        return
+    def _options(self, indent=None):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
 
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT failed_attempts FROM users WHERE username = %s',
-            (username,)
-        )
-        user = cursor.fetchone()
+    def _dumps_bytes(self, obj, indent=None):
+        return orjson.dumps(obj, default=self.default, option=self._options(indent))
 
-        if user:
-            failed_attempts = (user.get('failed_attempts') or 0) + 1
-            has_lockout = check_column_exists('users', 'lockout_until')
+    def dumps(self, obj, **kwargs):
+        if kwargs.keys() - {'indent', 'separators', 'sort_keys', 'ensure_ascii'}:
+            return super().dumps(obj, **kwargs)
+        return self._dumps_bytes(obj, kwargs.get('indent')).decode('utf-8')
 
-            # 5 次失敗後鎖定 30 分鐘
-            if failed_attempts >= 5 and has_lockout:
-                lockout_until = datetime.now() + timedelta(minutes=30)
-                cursor.execute(
-                    'UPDATE users SET failed_attempts = %s, lockout_until = %s WHERE username = %s',
-                    (failed_attempts, lockout_until, username)
-                )
-            else:
-                cursor.execute(
-                    'UPDATE users SET failed_attempts = %s WHERE username = %s',
-                    (failed_attempts, username)
-                )
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
 
-            conn.commit()
-        conn.close()
-    except Exception:
-        pass
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = 2 if (self.compact is None and self._app.debug) or self.compact is False else None
+        # 直接輸出 bytes，省去 str 編碼再解碼
+        return self._app.response_class(self._dumps_bytes(obj, indent) + b'\n', mimetype=self.mimetype)
 
-def reset_failed_attempts(username):
-    """重置登入失敗次數"""
-    if not check_column_exists('users', 'failed_attempts'):
-        return
+if orjson is not None:
+    app.json = FastJSONProvider(app)
 
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        has_lockout = check_column_exists('users', 'lockout_until')
+def negotiate_encoding(accept_encoding):
+    """依 Accept-Encoding 選擇壓縮方式，優先 br 其次 gzip"""
+    if brotli is not None and accept_encoding['br']:
+        return 'br'
+    if accept_encoding['gzip']:
+        return 'gzip'
+    return None
 
-        if has_lockout:
-            cursor.execute(
-                'UPDATE users SET failed_attempts = 0, lockout_until = NULL WHERE username = %s',
-                (username,)
-            )
-        else:
-            cursor.execute(
-                'UPDATE users SET failed_attempts = 0 WHERE username = %s',
-                (username,)
-            )
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
 
-        conn.commit()
-        conn.close()
-    except Exception:
-        pass
+@app.after_request
+def compress_response(response):
+    """對足夠大的文字回應進行 br/gzip 壓縮"""
+    if not COMPRESS_ENABLED or response.status_code != 200 or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    compressed = compress_body(data, encoding)
+    if len(compressed) >= len(data):
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # 壓縮後的位元組與原文不同，強 ETag 必須降為弱 ETag
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
 
 # ==================== 驗證碼 API ====================
 
 @app.route('/api/captcha', methods=['GET'])
 def get_captcha():
-    """取得驗證碼圖片和 token"""
+    """
+    取得驗證碼圖片和 token
+
+    預設在 JSON 內嵌 data URL；帶 ?format=url 時只回傳圖片網址，
+    由 /api/captcha/image/<image_id> 直接輸出圖片 bytes。
+    """
     try:
-        # 生成隨機驗證碼文字（4 個字符）
-        captcha_text = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
+        # 優先從預先產生池取出，池為空時即時產生
+        item = captcha_pool.pop()
+        captcha_text, image_bytes = item if item is not None else run_cpu_bound(render_captcha)
+        mimetype = CAPTCHA_MIMETYPES[CAPTCHA_IMAGE_FORMAT]
         
-        # 生成驗證碼圖片
-        image_io = generate_captcha_image(captcha_text)
+        # 生成 token
+        if CAPTCHA_MODE == 'stateless':
+            # 答案雜湊在 token 內，不需伺服器端存儲
+            captcha_token = generate_captcha_token(captcha_text)
+        else:
+            captcha_token = generate_captcha_token()
+            # 存儲驗證碼答案
+            captcha_store.set(captcha_token, captcha_text, CAPTCHA_TTL)
+
+        if request.args.get('format') == 'url':
+            image_id = secrets.token_urlsafe(16)
+            captcha_image_store.set(image_id, image_bytes, CAPTCHA_IMAGE_TTL)
+            return jsonify({
+                'captcha_token': captcha_token,
+                'image_url': f'/api/captcha/image/{image_id}'
+            }), 200
         
         # 轉換為 base64
-        image_bytes = image_io.getvalue()
         image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        image_data_url = f"data:image/png;base64,{image_base64}"
-        
-        # 生成 token
-        captcha_token = generate_captcha_token()
-        
-        # 存儲驗證碼答案
-        captcha_store[captcha_token] = captcha_text
+        image_data_url = f"data:{mimetype};base64,{image_base64}"
         
         return jsonify({
             'captcha_token': captcha_token,
@@ -304,6 +2149,223 @@ def get_captcha():
         error_msg = f"{str(e)}\n{traceback.format_exc()}"
         return jsonify({'error': error_msg}), 500
 
+@app.route('/api/captcha/image/<image_id>', methods=['GET'])
+def get_captcha_image(image_id):
+    """輸出驗證碼圖片（每張只能讀取一次）"""
+    image_bytes = captcha_image_store.pop(image_id)
+    if image_bytes is None:
+        return jsonify({'message': '驗證碼圖片不存在或已過期'}), 404
+
+    response = Response(image_bytes, mimetype=CAPTCHA_MIMETYPES[CAPTCHA_IMAGE_FORMAT])
+    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    response.headers['Pragma'] = 'no-cache'
+    return response
+
+# ==================== JWT 撤銷與 Refresh Token ====================
+
+ACCESS_TOKEN_EXPIRES = int(app.config['JWT_ACCESS_TOKEN_EXPIRES'].total_seconds())
+REFRESH_TOKEN_EXPIRES = int(os.getenv('REFRESH_TOKEN_EXPIRES_DAYS', '14')) * 86400  # refresh token 家族的絕對效期
+JWT_REVOCATION_STORE = os.getenv('JWT_REVOCATION_STORE', 'memory')  # memory 或 redis
+JWT_REVOCATION_STORE_URL = os.getenv('JWT_REVOCATION_STORE_URL', 'redis://localhost:6379/0')
+JWT_DENYLIST_PARTITION = int(os.getenv('JWT_DENYLIST_PARTITION', '300'))  # 拒絕清單分區秒數
+
+class MemoryRevocationStore:
+    """
+    行程內的 JWT 撤銷狀態
+
+    - 拒絕清單：依 token 到期時間分區保存 jti，整個分區過期後一次丟棄，
+      不需要逐筆清理，記憶體只與「仍未過期的已撤銷 token」數量成正比
+    - 用戶 token 版本：變更密碼時記錄 (新版本, 撤銷時間)，保留到舊 token
+      全部過期為止
+    """
+
+    def __init__(self, partition_seconds=300):
+        self.partition_seconds = partition_seconds
+        self._denied = {}  # 分區編號 -> set(jti)
+        self._versions = {}  # user_id -> (version, revoked_at, expires_at)
+        self._lock = threading.Lock()
+        self._next_prune = 0.0
+
+    def _prune(self, now):
+        if now < self._next_prune:
+            return
+        self._next_prune = now + self.partition_seconds
+        current = int(now // self.partition_seconds)
+        for partition in [p for p in self._denied if p < current]:
+            del self._denied[partition]
+        for user_id in [u for u, entry in self._versions.items() if entry[2] <= now]:
+            del self._versions[user_id]
+
+    def deny(self, jti, exp):
+        with self._lock:
+            self._prune(time.time())
+            self._denied.setdefault(int(exp // self.partition_seconds), set()).add(jti)
+
+    def revoke_versions(self, user_id, version, revoked_at, ttl):
+        with self._lock:
+            self._versions[str(user_id)] = (version, revoked_at, time.time() + ttl)
+
+    def lookup(self, jti, exp, user_id):
+        """回傳 (jti 是否已撤銷, (最低有效版本, 撤銷時間) 或 None)"""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            denied = jti in self._denied.get(int(exp // self.partition_seconds), ())
+            entry = self._versions.get(str(user_id))
+        if entry is None or entry[2] <= now:
+            return denied, None
+        return denied, entry[:2]
+
+class RedisRevocationStore:
+    """以 Redis 保存的 JWT 撤銷狀態（多 worker / 多節點共用），每次檢查一次 MGET"""
+
+    def __init__(self, client, prefix='jwt:'):
+        self.client = client
+        self.prefix = prefix
+
+    def deny(self, jti, exp):
+        ttl = max(1, int(exp - time.time()))
+        self.client.set(f'{self.prefix}deny:{jti}', b'1', ex=ttl)
+
+    def revoke_versions(self, user_id, version, revoked_at, ttl):
+        self.client.set(f'{self.prefix}ver:{user_id}', f'{version}:{revoked_at}', ex=max(1, int(ttl)))
+
+    def lookup(self, jti, exp, user_id):
+        denied, entry = self.client.mget(f'{self.prefix}deny:{jti}', f'{self.prefix}ver:{user_id}')
+        if entry is None:
+            return denied is not None, None
+        version, _, revoked_at = entry.decode('ascii').partition(':')
+        return denied is not None, (int(version), int(revoked_at))
+
+def create_revocation_store():
+    """依 JWT_REVOCATION_STORE 設定建立撤銷狀態存儲"""
+    if JWT_REVOCATION_STORE == 'redis':
+        import redis
+        return RedisRevocationStore(redis.Redis.from_url(JWT_REVOCATION_STORE_URL))
+    return MemoryRevocationStore(JWT_DENYLIST_PARTITION)
+
+def detect_worker_count():
+    """推測同一服務的 worker 行程數（gunicorn 的 -w / --workers 參數，否則為 WEB_CONCURRENCY）"""
+    if 'gunicorn' in os.path.basename(sys.argv[0]):
+        args = sys.argv[1:]
+        for index, arg in enumerate(args):
+            if arg in ('-w', '--workers') and index + 1 < len(args):
+                return int(args[index + 1])
+            if arg.startswith('--workers='):
+                return int(arg.split('=', 1)[1])
+            if arg.startswith('-w') and arg[2:].isdigit():
+                return int(arg[2:])
+    return int(os.getenv('WEB_CONCURRENCY', '1'))
+
+def check_revocation_store():
+    """
+    記憶體撤銷存儲只在目前行程有效：多 worker 時變更密碼或登出只會撤銷處理該請求的
+    worker 上的 token，因此直接拒絕啟動；單一 worker 時提醒重新啟動會遺失撤銷狀態
+    """
+    if JWT_REVOCATION_STORE != 'memory':
+        return
+    workers = detect_worker_count()
+    if workers > 1:
+        raise RuntimeError(f'JWT_REVOCATION_STORE=memory 無法在 {workers} 個 worker 之間共用撤銷狀態，'
+                           '請設定 JWT_REVOCATION_STORE=redis')
+    app.logger.warning('JWT_REVOCATION_STORE=memory：撤銷狀態只存在目前行程，重新啟動後已登出 / 已變更密碼前的 '
+                       'token 在到期前會重新生效；正式環境請使用 redis')
+
+revocation_store = create_revocation_store()
+check_revocation_store()
+
+@jwt.token_in_blocklist_loader
+def is_token_revoked(jwt_header, jwt_payload):
+    """每個 @jwt_required 請求的撤銷檢查，只查記憶體（或 Redis），不查資料庫"""
+    try:
+        denied, revoked = revocation_store.lookup(jwt_payload['jti'], jwt_payload['exp'], jwt_payload['sub'])
+    except Exception:
+        # 撤銷存儲故障時放行，避免所有已登入用戶被登出
+        return False
+    if denied:
+        return True
+    if revoked is None:
+        return False
+    version, revoked_at = revoked
+    # 撤銷之後簽發的 token（例如 OAuth 登入）不受影響
+    return jwt_payload.get('ver', 0) < version and jwt_payload.get('iat', 0) <= revoked_at
+
+@jwt.revoked_token_loader
+def revoked_token_response(jwt_header, jwt_payload):
+    return jsonify({'message': '登入已失效，請重新登入'}), 401
+
+def create_user_access_token(user_id, version=0):
+    """建立帶有 token 版本的 access token"""
+    return create_access_token(identity=str(user_id), additional_claims={'ver': version})
+
+def revoke_access_token(jwt_payload):
+    """撤銷單一 access token（登出）"""
+    revocation_store.deny(jwt_payload['jti'], jwt_payload['exp'])
+
+def revoke_user_tokens(user_id, version):
+    """使版本低於 version 的 access token 全部失效（變更密碼）"""
+    revocation_store.revoke_versions(user_id, version, int(time.time()), ACCESS_TOKEN_EXPIRES)
+
+# Refresh token 格式：{家族 ID}.{用戶 ID}.{token 版本}.{密鑰}
+# 資料庫每個家族（一次登入）只保存一列，token_hash 為目前有效密鑰的 SHA-256；
+# 用戶 ID 與版本不需保密，但必須與資料列相符才能輪替
+REFRESH_INSERT_SQL = '''INSERT INTO refresh_tokens (family_id, user_id, token_hash, token_version, expires_at)
+                        VALUES (%s, %s, %s, %s, %s)'''
+REFRESH_ROTATE_SQL = '''UPDATE refresh_tokens SET token_hash = %s
+                        WHERE family_id = %s AND token_hash = %s AND user_id = %s AND token_version = %s
+                          AND revoked = 0 AND expires_at > %s'''
+REFRESH_LOOKUP_SQL = 'SELECT token_hash, revoked, expires_at FROM refresh_tokens WHERE family_id = %s'
+REFRESH_REVOKE_FAMILY_SQL = 'UPDATE refresh_tokens SET revoked = 1 WHERE family_id = %s'
+REFRESH_LOGOUT_SQL = 'UPDATE refresh_tokens SET revoked = 1 WHERE family_id = %s AND user_id = %s'
+REFRESH_REVOKE_USER_SQL = 'UPDATE refresh_tokens SET revoked = 1 WHERE user_id = %s AND revoked = 0'
+
+class RefreshTokenError(Exception):
+    """refresh token 無效、過期或被重複使用"""
+
+def _refresh_secret():
+    secret = secrets.token_urlsafe(32)
+    return secret, hashlib.sha256(secret.encode('ascii')).digest()
+
+def parse_refresh_token(token):
+    """解析 refresh token，回傳 (家族 ID bytes, 用戶 ID, 版本, 密鑰雜湊)"""
+    try:
+        family_hex, user_id, version, secret = token.split('.')
+        return bytes.fromhex(family_hex), int(user_id), int(version), hashlib.sha256(secret.encode('ascii')).digest()
+    except (AttributeError, ValueError, UnicodeEncodeError):
+        raise RefreshTokenError('無效的 refresh token')
+
+def issue_refresh_token(cursor, user_id, version=0):
+    """建立新的 refresh token 家族（呼叫端負責 commit）"""
+    family_id = secrets.token_bytes(16)
+    secret, token_hash = _refresh_secret()
+    expires_at = datetime.now() + timedelta(seconds=REFRESH_TOKEN_EXPIRES)
+    cursor.execute(REFRESH_INSERT_SQL, (family_id, user_id, token_hash, version, expires_at))
+    return f'{family_id.hex()}.{user_id}.{version}.{secret}'
+
+def rotate_refresh_token(cursor, token):
+    """
+    輪替 refresh token
+
+    正常情況只需一次條件式 UPDATE（不檢查密碼）；UPDATE 沒有命中時才查詢
+    原因，若家族仍有效但雜湊不符，表示舊 token 被重複使用，撤銷整個家族。
+
+    Returns:
+        (用戶 ID, 版本, 新的 refresh token)
+    """
+    family_id, user_id, version, token_hash = parse_refresh_token(token)
+    secret, new_hash = _refresh_secret()
+    now = datetime.now()
+    cursor.execute(REFRESH_ROTATE_SQL, (new_hash, family_id, token_hash, user_id, version, now))
+    if cursor.rowcount == 1:
+        return user_id, version, f'{family_id.hex()}.{user_id}.{version}.{secret}'
+
+    cursor.execute(REFRESH_LOOKUP_SQL, (family_id,))
+    row = cursor.fetchone()
+    if row and not row['revoked'] and row['expires_at'] > now and not hmac.compare_digest(row['token_hash'], token_hash):
+        cursor.execute(REFRESH_REVOKE_FAMILY_SQL, (family_id,))
+        raise RefreshTokenError('偵測到 refresh token 重複使用，請重新登入')
+    raise RefreshTokenError('refresh token 無效或已過期')
+
 # ==================== 身份驗證 API ====================
 
 @app.route('/api/register', methods=['POST'])
@@ -355,47 +2417,24 @@ def register():
                 conn.close()
                 return jsonify({'message': '此電子郵件已被使用'}), 409
 
-        # 建立新用戶
-        hashed_password = generate_password_hash(password)
-
-        # 檢查資料表結構
-        cursor.execute("SHOW COLUMNS FROM users LIKE 'role'")
-        has_role = cursor.fetchone() is not None
-        cursor.execute("SHOW COLUMNS FROM users LIKE 'failed_attempts'")
-        has_failed_attempts = cursor.fetchone() is not None
+        # 建立新用戶（雜湊期間不佔用資料庫連接）
+        release_request_connection()
+        hashed_password = password_hasher.hash(password)
 
         # 根據資料表結構插入數據
-        if has_role and has_failed_attempts:
-            # 新版資料庫：有 role 和 failed_attempts 欄位
-            cursor.execute(
-                '''INSERT INTO users (username, role, password, display_name, email, phone, failed_attempts)
-                   VALUES (%s, %s, %s, %s, %s, %s, 0)''',
-                (username, role, hashed_password, display_name or username, email, phone)
-            )
-        elif has_role:
-            # 有 role 但沒有 failed_attempts
-            cursor.execute(
-                '''INSERT INTO users (username, role, password, display_name, email, phone)
-                   VALUES (%s, %s, %s, %s, %s, %s)''',
-                (username, role, hashed_password, display_name or username, email, phone)
-            )
-        elif has_failed_attempts:
-            # 舊版資料庫：只有 failed_attempts
-            cursor.execute(
-                'INSERT INTO users (username, password, failed_attempts) VALUES (%s, %s, 0)',
-                (username, hashed_password)
-            )
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        schema = get_schema()
+        insert_sql = USER_INSERT_SQL[(schema.has_role, schema.has_failed_attempts)]
+        if schema.has_role:
+            cursor.execute(insert_sql, (username, role, hashed_password, display_name or username, email, phone))
         else:
-            # 最舊版資料庫：只有基本欄位
-            cursor.execute(
-                'INSERT INTO users (username, password) VALUES (%s, %s)',
-                (username, hashed_password)
-            )
+            cursor.execute(insert_sql, (username, hashed_password))
 
         user_id = cursor.lastrowid
 
         # 如果是商家，創建商家資料
-        if role == 'merchant' and has_role:
+        if role == 'merchant' and schema.has_role and schema.has_merchants:
             business_name = data.get('business_name', display_name or username)
             cursor.execute(
                 '''INSERT INTO merchants (user_id, business_name) VALUES (%s, %s)''',
@@ -411,6 +2450,8 @@ def register():
             'role': role
         }), 201
 
+    except PasswordHashBusyError as e:
+        return hash_busy_response(e)
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
@@ -435,83 +2476,343 @@ def login():
         if not is_valid:
             return jsonify({'message': error_msg or '驗證碼錯誤'}), 400
         
-        # 檢查帳號鎖定
-        is_locked, lockout_until = check_account_lockout(username)
-        if is_locked:
+        # 先檢查記憶體中的鎖定，被鎖定的帳號不需查詢資料庫
+        lockout_until = failed_login_tracker.locked_until(username)
+        if lockout_until:
             return jsonify({
                 'message': f'帳號因錯誤次數過多被鎖定，請於 {lockout_until.strftime("%Y-%m-%d %H:%M:%S")} 後再試'
             }), 403
-        
-        # 驗證用戶
+
+        # 單一查詢取得用戶、鎖定狀態與商家資料
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # 檢查是否有 role 欄位
-        cursor.execute("SHOW COLUMNS FROM users LIKE 'role'")
-        has_role = cursor.fetchone() is not None
-
-        if has_role:
-            cursor.execute(
-                'SELECT id, username, email, password, display_name, role, phone, line_id, google_id FROM users WHERE username = %s',
-                (username,)
-            )
-        else:
-            cursor.execute(
-                'SELECT id, username, email, password, display_name, line_id, google_id FROM users WHERE username = %s',
-                (username,)
-            )
+        schema = get_schema()
+        has_role = schema.has_role
+        cursor.execute(build_login_sql(schema), (username,))
 
         user = cursor.fetchone()
 
-        if not user or not user.get('password') or not check_password_hash(user['password'], password):
+        # 檢查帳號鎖定
+        lockout_until = get_lockout_until(user)
+        if lockout_until:
+            conn.close()
+            return jsonify({
+                'message': f'帳號因錯誤次數過多被鎖定，請於 {lockout_until.strftime("%Y-%m-%d %H:%M:%S")} 後再試'
+            }), 403
+
+        # 驗證用戶（雜湊期間不佔用資料庫連接，之後的寫入重新借出）
+        release_request_connection()
+        if not user or not user.get('password') or not password_hasher.verify(user['password'], password):
             conn.close()
-            record_failed_login(username)
+            if user:
+                record_failed_login(username)
             return jsonify({'message': '帳號或密碼錯誤'}), 401
 
-        # 如果是商家，獲取商家資訊
-        merchant_info = None
-        if has_role and user.get('role') == 'merchant':
-            cursor.execute(
-                'SELECT id, business_name, business_type, address, logo_url, is_verified, rating FROM merchants WHERE user_id = %s',
-                (user['id'],)
-            )
-            merchant_info = cursor.fetchone()
+        conn.close()
+
+        # 重置失敗次數（資料庫中已為 0 時不需寫入）
+        reset_failed_attempts(username, user)
+
+        # 雜湊參數過時則在背景以新參數重新雜湊
+        schedule_rehash(user['id'], user['password'], password)
+
+        # 建立 JWT token 與 refresh token（之後以 refresh token 續期，不必重新登入）
+        token_version = user.get('token_version') or 0
+        access_token = create_user_access_token(user['id'], token_version)
+        refresh_token = None
+        if schema.has_refresh_tokens:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            refresh_token = issue_refresh_token(cursor, user['id'], token_version)
+            conn.commit()
+            conn.close()
+
+        response_data = {
+            'message': '登入成功',
+            'token': access_token,
+            'user': user['username'],
+            'role': user.get('role', 'customer') if has_role else 'customer',
+            'display_name': user.get('display_name'),
+            'email': user.get('email'),
+            'phone': user.get('phone'),
+            'expires_in': ACCESS_TOKEN_EXPIRES
+        }
+        if refresh_token:
+            response_data['refresh_token'] = refresh_token
+            response_data['refresh_expires_in'] = REFRESH_TOKEN_EXPIRES
+
+        # 如果是商家，添加商家資訊
+        if user.get('role') == 'merchant' and user.get('merchant_id') is not None:
+            response_data['merchant'] = {
+                'id': user['merchant_id'],
+                'business_name': user['merchant_business_name'],
+                'business_type': user.get('merchant_business_type'),
+                'address': user.get('merchant_address'),
+                'logo_url': user.get('merchant_logo_url'),
+                'is_verified': bool(user.get('merchant_is_verified')),
+                'rating': float(user.get('merchant_rating', 0))
+            }
+
+        return jsonify(response_data), 200
+    
+    except PasswordHashBusyError as e:
+        return hash_busy_response(e)
+    except Exception as e:
+        return jsonify({'message': str(e)}), 500
+
+@app.route('/api/token/refresh', methods=['POST'])
+def refresh_access_token():
+    """以 refresh token 換發新的 access token 與 refresh token（輪替）"""
+    try:
+        data = request.get_json(silent=True) or {}
+        refresh_token = data.get('refresh_token')
 
+        if not refresh_token:
+            return jsonify({'message': '缺少 refresh token'}), 400
+
+        if not get_schema().has_refresh_tokens:
+            return jsonify({'message': '未啟用 refresh token'}), 404
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            user_id, token_version, new_refresh_token = rotate_refresh_token(cursor, refresh_token)
+        except RefreshTokenError as e:
+            # 偵測到重複使用時已撤銷整個家族，需要提交
+            conn.commit()
+            conn.close()
+            return jsonify({'message': str(e)}), 401
+        conn.commit()
         conn.close()
 
-        # 重置失敗次數
-        reset_failed_attempts(username)
+        return jsonify({
+            'message': '換發成功',
+            'token': create_user_access_token(user_id, token_version),
+            'refresh_token': new_refresh_token,
+            'expires_in': ACCESS_TOKEN_EXPIRES
+        }), 200
+
+    except Exception as e:
+        return jsonify({'message': str(e)}), 500
+
+@app.route('/api/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    """登出：撤銷目前的 access token 與對應的 refresh token 家族"""
+    try:
+        user_id = get_jwt_identity()
+        revoke_access_token(get_jwt())
+
+        data = request.get_json(silent=True) or {}
+        refresh_token = data.get('refresh_token')
+        if refresh_token and get_schema().has_refresh_tokens:
+            try:
+                family_id = parse_refresh_token(refresh_token)[0]
+            except RefreshTokenError:
+                family_id = None
+            if family_id:
+                conn = get_db_connection()
+                cursor = conn.cursor()
+                cursor.execute(REFRESH_LOGOUT_SQL, (family_id, user_id))
+                conn.commit()
+                conn.close()
+
+        return jsonify({'message': '已登出'}), 200
+
+    except Exception as e:
+        return jsonify({'message': str(e)}), 500
+
+# ==================== 個人資料快取 ====================
+
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '10000'))  # 最多快取幾位用戶
+PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', '60'))  # 快取秒數
+PROFILE_CACHE_STORE = os.getenv('PROFILE_CACHE_STORE', 'memory')  # memory（單一 worker）或 redis（多 worker 共用）
+PROFILE_CACHE_STORE_URL = os.getenv('PROFILE_CACHE_STORE_URL', CAPTCHA_STORE_URL)
+
+class ProfileCache:
+    """
+    個人資料回應快取（LRU + TTL）
+
+    以用戶 ID 為 key 保存序列化後的 JSON 與 ETag，任何會修改 users
+    資料列的操作都必須在 commit 後呼叫 invalidate()。快取只存在目前行程，invalidate()
+    無法通知其他 worker，因此只適用單一 worker；多 worker 請改用 RedisProfileCache。
+
+    讀取資料庫前先以 generation() 取得版本，set() 時若期間有 invalidate() 就不存入，
+    避免查詢到舊資料的請求在失效之後才把舊資料寫回快取。
+    """
+
+    def __init__(self, max_entries=10000, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (body, etag, expires_at)
+        self._generation = 0
+        # user_id -> 最後一次失效時的版本；被淘汰的記錄以 _invalidated_floor 保守代替
+        self._invalidated = OrderedDict()
+        self._invalidated_floor = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'stale_writes': 0}
+
+    def get(self, user_id):
+        """取得 (body, etag)，不存在或過期時回傳 None"""
+        key = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0], entry[1]
+
+    def generation(self, user_id):
+        """讀取資料庫前取得的版本，傳給 set()"""
+        with self._lock:
+            return self._generation
+
+    def set(self, user_id, body, generation):
+        """存入序列化後的回應，回傳 ETag；generation 之後曾失效時不存入"""
+        etag = hashlib.sha1(body).hexdigest()
+        key = str(user_id)
+        with self._lock:
+            if self._invalidated.get(key, self._invalidated_floor) > generation:
+                self._stats['stale_writes'] += 1
+                return etag
+            self._entries[key] = (body, etag, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag
+
+    def invalidate(self, user_id):
+        key = str(user_id)
+        with self._lock:
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.max_entries:
+                _, evicted = self._invalidated.popitem(last=False)
+                self._invalidated_floor = max(self._invalidated_floor, evicted)
+            if self._entries.pop(key, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def stats(self):
+        """取得命中率等指標"""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['size'] = len(self._entries)
+        return snapshot
+
+class RedisProfileCache:
+    """
+    以 Redis 共用的個人資料快取
+
+    所有 worker 讀寫同一份資料，任何一個 worker 呼叫 invalidate() 後
+    其他 worker 立即看不到舊資料。Redis 無法連線時視為未命中，改查資料庫。
+
+    每位用戶另有版本 key（profile:gen:{id}），invalidate() 遞增版本並刪除快取；
+    set() 以 WATCH 確認版本與讀取資料庫前相同才寫入。
+    """
+
+    GENERATION_TTL_MS = 86400 * 1000  # 版本 key 保留時間，遠大於單次請求耗時
+
+    def __init__(self, client, ttl=60.0, prefix='profile:'):
+        from redis.exceptions import WatchError
+        self._watch_error = WatchError
+        self._client = client
+        self.ttl = ttl
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'stale_writes': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, user_id):
+        """取得 (body, etag)，不存在、過期或 Redis 故障時回傳 None"""
+        try:
+            value = self._client.get(f'{self._prefix}{user_id}')
+        except Exception:
+            self._count('errors')
+            value = None
+        if value is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        # 儲存格式：40 字元的 ETag + JSON 內容
+        return value[40:], value[:40].decode('ascii')
+
+    def generation(self, user_id):
+        """讀取資料庫前取得的版本，傳給 set()；Redis 故障時回傳 None（不寫入快取）"""
+        try:
+            return self._client.get(f'{self._prefix}gen:{user_id}') or b'0'
+        except Exception:
+            self._count('errors')
+            return None
+
+    def set(self, user_id, body, generation):
+        """存入序列化後的回應，回傳 ETag；版本已改變時不存入"""
+        etag = hashlib.sha1(body).hexdigest()
+        if self.ttl <= 0 or generation is None:
+            return etag
+        generation_key = f'{self._prefix}gen:{user_id}'
+        try:
+            with self._client.pipeline(transaction=True) as pipe:
+                pipe.watch(generation_key)
+                if (pipe.get(generation_key) or b'0') != generation:
+                    self._count('stale_writes')
+                    return etag
+                pipe.multi()
+                pipe.set(f'{self._prefix}{user_id}', etag.encode('ascii') + body, px=int(self.ttl * 1000))
+                pipe.execute()
+        except self._watch_error:
+            # WATCH 之後有其他 worker 失效了這位用戶
+            self._count('stale_writes')
+        except Exception:
+            self._count('errors')
+        return etag
+
+    def invalidate(self, user_id):
+        generation_key = f'{self._prefix}gen:{user_id}'
+        try:
+            pipe = self._client.pipeline(transaction=True)
+            pipe.incr(generation_key)
+            pipe.pexpire(generation_key, self.GENERATION_TTL_MS)
+            pipe.delete(f'{self._prefix}{user_id}')
+            if pipe.execute()[-1]:
+                self._count('invalidations')
+        except Exception:
+            # 刪除失敗時舊資料最多再保留 TTL 秒
+            self._count('errors')
+            app.logger.warning('個人資料快取失效失敗 user_id=%s', user_id)
 
-        # 建立 JWT token
-        access_token = create_access_token(identity=user['id'])
+    def stats(self):
+        """取得命中率等指標"""
+        with self._lock:
+            return dict(self._stats)
 
-        response_data = {
-            'message': '登入成功',
-            'token': access_token,
-            'user': user['username'],
-            'role': user.get('role', 'customer') if has_role else 'customer',
-            'display_name': user.get('display_name'),
-            'email': user.get('email'),
-            'phone': user.get('phone'),
-            'expires_in': 1800
-        }
+def create_profile_cache():
+    """依 PROFILE_CACHE_STORE 設定建立個人資料快取"""
+    if PROFILE_CACHE_STORE == 'redis':
+        import redis
+        return RedisProfileCache(redis.Redis.from_url(PROFILE_CACHE_STORE_URL), PROFILE_CACHE_TTL)
+    return ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
 
-        # 如果是商家，添加商家資訊
-        if merchant_info:
-            response_data['merchant'] = {
-                'id': merchant_info['id'],
-                'business_name': merchant_info['business_name'],
-                'business_type': merchant_info.get('business_type'),
-                'address': merchant_info.get('address'),
-                'logo_url': merchant_info.get('logo_url'),
-                'is_verified': bool(merchant_info.get('is_verified')),
-                'rating': float(merchant_info.get('rating', 0))
-            }
+profile_cache = create_profile_cache()
 
-        return jsonify(response_data), 200
-    
-    except Exception as e:
-        return jsonify({'message': str(e)}), 500
+def profile_response(body, etag):
+    """輸出個人資料；客戶端的 If-None-Match 相同時回應 304"""
+    # 回應壓縮後 ETag 會變成弱 ETag，因此以弱比較判斷
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype=app.json.mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 # ==================== 帳號管理 API ====================
 
@@ -522,23 +2823,18 @@ def get_profile():
     try:
         user_id = get_jwt_identity()
 
+        cached = profile_cache.get(user_id)
+        if cached is not None:
+            return profile_response(*cached)
+
+        # 查詢前取得快取版本，查詢期間若有變更並失效，就不把這次讀到的資料寫入快取
+        generation = profile_cache.generation(user_id)
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # 檢查是否有 role 欄位
-        cursor.execute("SHOW COLUMNS FROM users LIKE 'role'")
-        has_role = cursor.fetchone() is not None
-
-        if has_role:
-            cursor.execute(
-                'SELECT id, username, email, display_name, role, phone, line_id, google_id FROM users WHERE id = %s',
-                (user_id,)
-            )
-        else:
-            cursor.execute(
-                'SELECT id, username, email, display_name, line_id, google_id FROM users WHERE id = %s',
-                (user_id,)
-            )
+        schema = get_schema()
+        has_role = schema.has_role
+        cursor.execute(PROFILE_USER_SQL[has_role], (user_id,))
 
         user = cursor.fetchone()
 
@@ -559,7 +2855,7 @@ def get_profile():
         }
 
         # 如果是商家，獲取商家資訊
-        if has_role and user.get('role') == 'merchant':
+        if has_role and schema.has_merchants and user.get('role') == 'merchant':
             cursor.execute(
                 'SELECT id, business_name, business_type, address, description, logo_url, is_verified, rating FROM merchants WHERE user_id = %s',
                 (user_id,)
@@ -578,7 +2874,10 @@ def get_profile():
                 }
 
         conn.close()
-        return jsonify(response_data), 200
+
+        body = app.json.response(response_data).get_data()
+        etag = profile_cache.set(user_id, body, generation)
+        return profile_response(body, etag)
 
     except Exception as e:
         return jsonify({'message': str(e)}), 500
@@ -610,16 +2909,18 @@ def change_username():
         # 更新使用者名稱
         cursor.execute('UPDATE users SET username = %s WHERE id = %s', (new_username, user_id))
         conn.commit()
+        profile_cache.invalidate(user_id)
+        oauth_user_cache.invalidate_user(user_id)
         conn.close()
         
         # 生成新的 JWT token
-        new_token = create_access_token(identity=user_id)
+        new_token = create_user_access_token(user_id, get_jwt().get('ver', 0))
         
         return jsonify({
             'message': '使用者名稱變更成功',
             'new_username': new_username,
             'token': new_token,
-            'expires_in': 1800
+            'expires_in': ACCESS_TOKEN_EXPIRES
         }), 200
     
     except Exception as e:
@@ -645,9 +2946,10 @@ def change_password():
         if new_password != confirm_password:
             return jsonify({'message': '兩次新密碼輸入不一致'}), 400
         
+        schema = get_schema()
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT password FROM users WHERE id = %s', (user_id,))
+        cursor.execute(CHANGE_PASSWORD_SELECT_SQL[schema.has_token_version], (user_id,))
         user = cursor.fetchone()
         
         if not user:
@@ -659,30 +2961,499 @@ def change_password():
             conn.close()
             return jsonify({'message': '第三方登入帳號未設定密碼'}), 401
         
-        # 驗證舊密碼
-        if not check_password_hash(user['password'], old_password):
-            conn.close()
+        # 驗證舊密碼（雜湊期間不佔用資料庫連接）
+        release_request_connection()
+        if not password_hasher.verify(user['password'], old_password):
             return jsonify({'message': '舊密碼錯誤'}), 401
         
-        # 更新密碼
-        hashed_password = generate_password_hash(new_password)
-        cursor.execute('UPDATE users SET password = %s WHERE id = %s', (hashed_password, user_id))
+        # 更新密碼並遞增 token 版本，其他裝置上的 token 與 refresh token 全部失效
+        hashed_password = password_hasher.hash(new_password)
+        token_version = (user.get('token_version') or 0) + 1
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(CHANGE_PASSWORD_UPDATE_SQL[schema.has_token_version], (hashed_password, user_id))
+        refresh_token = None
+        if schema.has_refresh_tokens:
+            cursor.execute(REFRESH_REVOKE_USER_SQL, (user_id,))
+            refresh_token = issue_refresh_token(cursor, user_id, token_version)
         conn.commit()
+        profile_cache.invalidate(user_id)
+        oauth_user_cache.invalidate_user(user_id)
         conn.close()
-        
-        return jsonify({
-            'message': '密碼變更成功'
-        }), 200
+
+        if schema.has_token_version:
+            revoke_user_tokens(user_id, token_version)
+        else:
+            revoke_access_token(get_jwt())
+
+        # 目前的裝置直接取得新的 token，不必重新登入
+        response_data = {
+            'message': '密碼變更成功',
+            'token': create_user_access_token(user_id, token_version),
+            'expires_in': ACCESS_TOKEN_EXPIRES
+        }
+        if refresh_token:
+            response_data['refresh_token'] = refresh_token
+        return jsonify(response_data), 200
     
+    except PasswordHashBusyError as e:
+        return hash_busy_response(e)
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
+# ==================== OAuth HTTP 客戶端 ====================
+
+OAUTH_HTTP_CONNECT_TIMEOUT = float(os.getenv('OAUTH_HTTP_CONNECT_TIMEOUT', '3'))  # 建立連線逾時秒數
+OAUTH_HTTP_READ_TIMEOUT = float(os.getenv('OAUTH_HTTP_READ_TIMEOUT', '10'))  # 等待回應逾時秒數
+OAUTH_HTTP_RETRIES = int(os.getenv('OAUTH_HTTP_RETRIES', '2'))  # 冪等請求最多重試次數
+OAUTH_HTTP_BACKOFF = float(os.getenv('OAUTH_HTTP_BACKOFF', '0.2'))  # 重試退避基準秒數
+OAUTH_HTTP_POOL_SIZE = int(os.getenv('OAUTH_HTTP_POOL_SIZE', '10'))  # 每個提供者保留的連線數
+OAUTH_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class OAuthHTTPClient:
+    """
+    單一 OAuth 提供者的 HTTP 客戶端
+
+    共用 keep-alive 連線池，避免每次回調都重新做 TLS 握手；所有請求都有
+    連線/讀取逾時。GET 等冪等請求遇到連線錯誤、逾時或 5xx/429 時以
+    指數退避加隨機抖動重試；授權碼只能使用一次，因此 POST 只在連線尚未
+    建立（connect timeout）時重試。
+    """
+
+    def __init__(self, provider, connect_timeout=3.0, read_timeout=10.0, retries=2,
+                 backoff=0.2, pool_size=10, sample_size=1000):
+        self.provider = provider
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=sample_size)
+        self._outcomes = deque(maxlen=100)  # 最近的 (時間, 是否成功)，供就緒檢查使用
+        self._stats = {'requests': 0, 'errors': 0, 'retries': 0}
+
+    def _get_session(self):
+        # fork 之後不可沿用父行程的連線，依 PID 重新建立
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+                    )
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    # 連線池由所有用戶共用，不保存任何 cookie
+                    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                    self._session = session
+                    self._pid = pid
+        return self._session
+
+    def _sleep_before_retry(self, attempt):
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def _record(self, elapsed, error=False, retried=False):
+        observe_metric('oauth_request_duration_seconds',
+                       (('provider', self.provider), ('outcome', 'error' if error else 'ok')), elapsed)
+        with self._lock:
+            self._latencies.append(elapsed)
+            self._outcomes.append((time.monotonic(), not error))
+            self._stats['requests'] += 1
+            if error:
+                self._stats['errors'] += 1
+            if retried:
+                self._stats['retries'] += 1
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        """送出請求，失敗時依冪等性決定是否重試"""
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD', 'OPTIONS')
+        kwargs.setdefault('timeout', self.timeout)
+        session = self._get_session()
+
+        attempt = 0
+        while True:
+            retry = attempt < self.retries
+            started = time.perf_counter()
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectTimeout:
+                self._record(time.perf_counter() - started, error=True, retried=retry)
+                if not retry:
+                    raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                retry = retry and idempotent
+                self._record(time.perf_counter() - started, error=True, retried=retry)
+                if not retry:
+                    raise
+            else:
+                retry = retry and idempotent and response.status_code in OAUTH_RETRY_STATUSES
+                self._record(time.perf_counter() - started, error=response.status_code >= 500, retried=retry)
+                if not retry:
+                    return response
+                response.close()
+            self._sleep_before_retry(attempt)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def health(self, window=300.0, min_calls=5, max_error_rate=0.5):
+        """
+        依最近 window 秒內的呼叫結果判斷提供者是否可用（不發出任何請求）
+
+        Returns:
+            {'status': 'ok' / 'degraded' / 'unknown', 'recent_calls', 'error_rate'}
+        """
+        cutoff = time.monotonic() - window
+        with self._lock:
+            recent = [ok for at, ok in self._outcomes if at >= cutoff]
+        if not recent:
+            return {'status': 'unknown', 'recent_calls': 0, 'error_rate': None}
+        error_rate = round(1 - sum(recent) / len(recent), 3)
+        degraded = len(recent) >= min_calls and error_rate > max_error_rate
+        return {'status': 'degraded' if degraded else 'ok', 'recent_calls': len(recent), 'error_rate': error_rate}
+
+    def stats(self):
+        """取得請求次數、錯誤數與延遲分位數（毫秒）"""
+        with self._lock:
+            snapshot = dict(self._stats)
+            samples = sorted(self._latencies)
+        if samples:
+            snapshot['latency_ms'] = {
+                'p50': round(samples[len(samples) // 2] * 1000, 2),
+                'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 2),
+                'max': round(samples[-1] * 1000, 2),
+            }
+        return snapshot
+
+oauth_clients = {
+    provider: OAuthHTTPClient(
+        provider,
+        connect_timeout=OAUTH_HTTP_CONNECT_TIMEOUT,
+        read_timeout=OAUTH_HTTP_READ_TIMEOUT,
+        retries=OAUTH_HTTP_RETRIES,
+        backoff=OAUTH_HTTP_BACKOFF,
+        pool_size=OAUTH_HTTP_POOL_SIZE,
+    )
+    for provider in ('line', 'google')
+}
+
+# ==================== OAuth id_token 驗證 ====================
+
+LINE_JWKS_URL = os.getenv('LINE_JWKS_URL', 'https://api.line.me/oauth2/v2.1/certs')
+GOOGLE_JWKS_URL = os.getenv('GOOGLE_JWKS_URL', 'https://www.googleapis.com/oauth2/v3/certs')
+OAUTH_JWKS_TTL = float(os.getenv('OAUTH_JWKS_TTL', '3600'))  # 提供者未給 max-age 時的快取秒數
+OAUTH_JWKS_MIN_REFETCH = float(os.getenv('OAUTH_JWKS_MIN_REFETCH', '60'))  # 兩次抓取（含失敗）的最短間隔
+OAUTH_ID_TOKEN_LEEWAY = int(os.getenv('OAUTH_ID_TOKEN_LEEWAY', '60'))  # 允許的時鐘誤差秒數
+
+class IdTokenError(Exception):
+    """id_token 無法驗證"""
+
+class JWKSCache:
+    """
+    提供者公鑰（JWKS）快取
+
+    依回應的 Cache-Control max-age 決定有效期限，用掉 80% 後在背景執行緒
+    預先更新；更新進行中或過期後仍沿用舊的金鑰，請求路徑不必等待。
+    只有在沒有任何金鑰或遇到未知 kid（提供者輪替金鑰）時才同步抓取。
+
+    不論成功或失敗，距上次抓取未滿 min_refetch 秒時不再抓取（失敗也會被
+    「記住」），且同一時間只有一個抓取；提供者故障時請求會立即失敗並改用
+    profile API，而不是每次都等待完整的重試與逾時。
+    """
+
+    def __init__(self, provider, url, client, ttl=3600.0, min_refetch=60.0):
+        self.provider = provider
+        self.url = url
+        self.client = client
+        self.ttl = ttl
+        self.min_refetch = min_refetch
+        self._keys = {}
+        self._lifetime = ttl
+        self._expires_at = 0.0
+        self._fetched_at = None
+        self._last_attempt = None  # 最近一次開始抓取的時間（含失敗）
+        self._last_error = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _max_age(self, response):
+        for directive in response.headers.get('Cache-Control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name.lower() == 'max-age' and value.isdigit():
+                return float(value)
+        return self.ttl
+
+    def refresh(self):
+        """從提供者抓取 JWKS"""
+        response = self.client.get(self.url)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get('keys', []):
+            try:
+                keys[jwk.get('kid')] = pyjwt.PyJWK(jwk)
+            except pyjwt.PyJWKError:
+                # 略過不支援的金鑰類型
+                continue
+        lifetime = self._max_age(response)
+        now = time.monotonic()
+        with self._lock:
+            self._keys = keys
+            self._lifetime = lifetime
+            self._expires_at = now + lifetime
+            self._fetched_at = now
+
+    def _begin_refresh(self, force=False):
+        """取得抓取權：沒有其他抓取進行中，且距上次嘗試已滿 min_refetch 秒（force 略過間隔）"""
+        now = time.monotonic()
+        with self._lock:
+            if self._refreshing:
+                return False
+            if not force and self._last_attempt is not None and now - self._last_attempt < self.min_refetch:
+                return False
+            self._refreshing = True
+            self._last_attempt = now
+            return True
+
+    def _run_refresh(self):
+        """執行已取得抓取權的更新；失敗時沿用舊的金鑰"""
+        try:
+            self.refresh()
+            error = None
+        except Exception as e:
+            error = str(e)
+        with self._lock:
+            self._refreshing = False
+            self._last_error = error
+
+    def refresh_async(self, force=False):
+        """在背景執行緒更新，已有更新進行中或距上次嘗試太近時不啟動"""
+        if not self._begin_refresh(force):
+            return
+        threading.Thread(target=self._run_refresh, name=f'jwks-{self.provider}', daemon=True).start()
+
+    def get_key(self, kid):
+        """取得指定 kid 的公鑰"""
+        now = time.monotonic()
+        with self._lock:
+            keys, expires_at, lifetime = self._keys, self._expires_at, self._lifetime
+
+        # 快到期或已過期：背景更新，這次仍使用目前的金鑰
+        if keys and now >= expires_at - lifetime * 0.2:
+            self.refresh_async()
+
+        key = keys.get(kid)
+        if key is None and self._begin_refresh():
+            self._run_refresh()
+            with self._lock:
+                key = self._keys.get(kid)
+        if key is None:
+            raise IdTokenError(f'{self.provider} 公鑰中找不到 kid={kid}')
+        return key
+
+oauth_jwks = {
+    'line': JWKSCache('line', LINE_JWKS_URL, oauth_clients['line'], OAUTH_JWKS_TTL, OAUTH_JWKS_MIN_REFETCH),
+    'google': JWKSCache('google', GOOGLE_JWKS_URL, oauth_clients['google'], OAUTH_JWKS_TTL, OAUTH_JWKS_MIN_REFETCH),
+}
+
+# 各提供者 id_token 的簽發者、受眾與 HS256 共用密鑰（LINE 網頁登入以 channel secret 簽章）
+ID_TOKEN_SETTINGS = {
+    'line': {
+        'issuers': ['https://access.line.me'],
+        'audience': LINE_CLIENT_ID,
+        'secret': LINE_CLIENT_SECRET,
+    },
+    'google': {
+        'issuers': ['https://accounts.google.com', 'accounts.google.com'],
+        'audience': GOOGLE_CLIENT_ID,
+        'secret': None,
+    },
+}
+
+ID_TOKEN_ASYMMETRIC_ALGORITHMS = {'RS256', 'ES256'}
+
+def verify_id_token(provider, id_token):
+    """
+    在本機驗證 id_token 的簽章、簽發者、受眾與有效期限
+
+    Returns:
+        claims: 驗證通過的 claims
+
+    Raises:
+        IdTokenError: 簽章或 claims 無效
+    """
+    settings = ID_TOKEN_SETTINGS[provider]
+    try:
+        header = pyjwt.get_unverified_header(id_token)
+        algorithm = header.get('alg')
+        if algorithm == 'HS256' and settings['secret']:
+            key = settings['secret']
+        elif algorithm in ID_TOKEN_ASYMMETRIC_ALGORITHMS:
+            key = oauth_jwks[provider].get_key(header.get('kid')).key
+        else:
+            raise IdTokenError(f'不支援的 id_token 演算法: {algorithm}')
+
+        return pyjwt.decode(
+            id_token,
+            key,
+            algorithms=[algorithm],
+            audience=settings['audience'],
+            issuer=settings['issuers'],
+            leeway=OAUTH_ID_TOKEN_LEEWAY,
+            options={'require': ['sub', 'iss', 'aud', 'exp']},
+        )
+    except pyjwt.PyJWTError as e:
+        raise IdTokenError(str(e)) from e
+
+def get_id_token_claims(provider, id_token):
+    """驗證 id_token；沒有 id_token 或驗證失敗時回傳 None，由呼叫端改用 profile API"""
+    if not id_token:
+        return None
+    try:
+        return verify_id_token(provider, id_token)
+    except IdTokenError:
+        return None
+
 # ==================== OAuth 輔助函數 ====================
 
+OAUTH_USER_CACHE_SIZE = int(os.getenv('OAUTH_USER_CACHE_SIZE', '10000'))  # 最多快取幾組提供者 ID
+OAUTH_USER_CACHE_TTL = float(os.getenv('OAUTH_USER_CACHE_TTL', '300'))  # 快取秒數
+OAUTH_USER_CACHE_STORE = os.getenv('OAUTH_USER_CACHE_STORE', 'memory')  # memory（單一 worker）或 redis（多 worker 共用）
+OAUTH_USER_CACHE_STORE_URL = os.getenv('OAUTH_USER_CACHE_STORE_URL', CAPTCHA_STORE_URL)
+USERNAME_MAX_LENGTH = 50  # users.username 欄位長度
+
+class OAuthUserCache:
+    """
+    提供者 ID -> (用戶 ID, 用戶名, token 版本) 的 LRU + TTL 快取
+
+    重複的 OAuth 登入不必查詢資料庫；變更用戶名、密碼（token 版本）或重新綁定
+    提供者帳號後必須呼叫 invalidate_user()。快取只存在目前行程，多 worker 請改用
+    RedisOAuthUserCache，否則其他 worker 在 TTL 內仍可能以舊綁定登入。
+    """
+
+    def __init__(self, max_entries=10000, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (provider, provider_id) -> (user_id, username, token_version, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, provider_name, provider_id):
+        key = (provider_name, provider_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[3] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[:3]
+
+    def set(self, provider_name, provider_id, user_id, username, token_version=0):
+        key = (provider_name, provider_id)
+        with self._lock:
+            self._entries[key] = (user_id, username, token_version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        # 變更用戶名與綁定都很少發生，直接掃描即可
+        user_id = str(user_id)
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if str(entry[0]) == user_id]:
+                del self._entries[key]
+
+class RedisOAuthUserCache:
+    """
+    以 Redis 共用的 OAuth 用戶快取
+
+    每位用戶另存一個集合記錄自己的快取 key，invalidate_user() 一次刪除，
+    任何 worker 的綁定變更都會立即對所有 worker 生效。Redis 無法連線時視為未命中。
+    """
+
+    def __init__(self, client, ttl=300.0, prefix='oauth-user:'):
+        self._client = client
+        self.ttl = ttl
+        self._prefix = prefix
+
+    def get(self, provider_name, provider_id):
+        try:
+            value = self._client.get(f'{self._prefix}{provider_name}:{provider_id}')
+        except Exception:
+            return None
+        if value is None:
+            return None
+        # 儲存格式：用戶 ID:token 版本:用戶名（用戶名可能含冒號，放在最後）
+        try:
+            user_id, token_version, username = value.decode('utf-8').split(':', 2)
+            return int(user_id), username, int(token_version)
+        except ValueError:
+            # 舊格式（沒有 token 版本）視為未命中
+            return None
+
+    def set(self, provider_name, provider_id, user_id, username, token_version=0):
+        key = f'{self._prefix}{provider_name}:{provider_id}'
+        index = f'{self._prefix}user:{user_id}'
+        ttl_ms = int(self.ttl * 1000)
+        try:
+            pipe = self._client.pipeline(transaction=True)
+            pipe.set(key, f'{user_id}:{token_version}:{username}', px=ttl_ms)
+            pipe.sadd(index, key)
+            pipe.pexpire(index, ttl_ms)
+            pipe.execute()
+        except Exception:
+            pass
+
+    def invalidate_user(self, user_id):
+        index = f'{self._prefix}user:{user_id}'
+        try:
+            keys = self._client.smembers(index)
+            self._client.delete(index, *keys)
+        except Exception:
+            app.logger.warning('OAuth 用戶快取失效失敗 user_id=%s', user_id)
+
+def create_oauth_user_cache():
+    """依 OAUTH_USER_CACHE_STORE 設定建立 OAuth 用戶快取"""
+    if OAUTH_USER_CACHE_STORE == 'redis':
+        import redis
+        return RedisOAuthUserCache(redis.Redis.from_url(OAUTH_USER_CACHE_STORE_URL), OAUTH_USER_CACHE_TTL)
+    return OAuthUserCache(OAUTH_USER_CACHE_SIZE, OAUTH_USER_CACHE_TTL)
+
+oauth_user_cache = create_oauth_user_cache()
+
+OAUTH_USERNAME_HASH_LENGTH = 12  # 預設用戶名使用的雜湊字元數
+
+def oauth_usernames(provider_name, provider_id):
+    """
+    依提供者 ID 推導新用戶的候選用戶名
+
+    用戶名會顯示給其他用戶，因此不直接使用提供者 ID，而是使用 ID 的 SHA-256 前綴：
+    第一個候選取 12 個字元；已被其他用戶佔用時改用欄位長度允許的最長前綴。
+    """
+    digest = hashlib.sha256(provider_id.encode('utf-8')).hexdigest()
+    longest = USERNAME_MAX_LENGTH - len(provider_name) - 1
+    return [
+        f'{provider_name}_{digest[:OAUTH_USERNAME_HASH_LENGTH]}',
+        f'{provider_name}_{digest[:longest]}',
+    ]
+
 def find_or_create_oauth_user(provider_id, provider_name, display_name=None, email=None):
     """
     查找或創建 OAuth 用戶
 
+    先查快取與資料庫；不存在時以 INSERT ... ON DUPLICATE KEY UPDATE 建立，
+    並行的第一次登入不會觸發唯一鍵錯誤。衝突時以 LAST_INSERT_ID(id) 取回衝突列的 ID，
+    再讀回該列比對提供者欄位：相同表示是自己（並行建立），不同表示用戶名屬於其他用戶，
+    改用下一個候選用戶名，絕不登入到其他人的帳號。
+
     Args:
         provider_id: OAuth 提供者的用戶 ID
         provider_name: 提供者名稱 ('line' 或 'google')
@@ -692,33 +3463,53 @@ def find_or_create_oauth_user(provider_id, provider_name, display_name=None, ema
     Returns:
         user_id: 用戶 ID
         username: 用戶名
+        token_version: 目前的 token 版本（變更密碼後遞增）
     """
+    cached = oauth_user_cache.get(provider_name, provider_id)
+    if cached is not None:
+        return cached
+
     conn = get_db_connection()
     cursor = conn.cursor()
 
     # 根據提供者查找用戶
     id_column = f'{provider_name}_id'
-    cursor.execute(f'SELECT id, username FROM users WHERE {id_column} = %s', (provider_id,))
+    version_column = ', token_version' if get_schema().has_token_version else ''
+    cursor.execute(f'SELECT id, username{version_column} FROM users WHERE {id_column} = %s', (provider_id,))
     user = cursor.fetchone()
 
     if user:
         # 登入現有用戶
         user_id = user['id']
         username = user['username']
+        token_version = user.get('token_version') or 0
     else:
-        # 創建新用戶
-        username = f"{provider_name}_{provider_id[:8]}"
-        cursor.execute(
-            f'INSERT INTO users (username, {id_column}, display_name, email) VALUES (%s, %s, %s, %s)',
-            (username, provider_id, display_name, email)
-        )
+        # 創建新用戶；不論新增或衝突，lastrowid 都是該列的 ID，讀回後確認提供者欄位屬於自己
+        user_id = 0
+        for candidate in oauth_usernames(provider_name, provider_id):
+            cursor.execute(
+                f'''INSERT INTO users (username, {id_column}, display_name, email) VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)''',
+                (candidate, provider_id, display_name, email)
+            )
+            cursor.execute(f'SELECT id, username, {id_column}{version_column} FROM users WHERE id = %s',
+                           (cursor.lastrowid,))
+            row = cursor.fetchone()
+            if row and row[id_column] == provider_id:
+                user_id = row['id']
+                username = row['username']
+                token_version = row.get('token_version') or 0
+                break
         conn.commit()
-        user_id = cursor.lastrowid
+        if not user_id:
+            conn.close()
+            raise ValueError('無法建立 OAuth 用戶：用戶名已被使用')
 
     conn.close()
-    return user_id, username
+    oauth_user_cache.set(provider_name, provider_id, user_id, username, token_version)
+    return user_id, username, token_version
 
-def create_oauth_redirect_url(user_id, username, provider):
+def create_oauth_redirect_url(user_id, username, provider, token_version=0):
     """
     創建 OAuth 回調重定向 URL
 
@@ -726,11 +3517,12 @@ def create_oauth_redirect_url(user_id, username, provider):
         user_id: 用戶 ID
         username: 用戶名
         provider: OAuth 提供者名稱
+        token_version: 用戶目前的 token 版本
 
     Returns:
         redirect_url: 重定向 URL
     """
-    access_token = create_access_token(identity=user_id)
+    access_token = create_user_access_token(user_id, token_version)
     frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:5173')
     redirect_url = f"{frontend_url}/oauth/callback?token={quote(access_token)}&user={quote(username)}&provider={provider}"
     return redirect_url
@@ -755,6 +3547,57 @@ def create_oauth_error_redirect(error_msg, provider):
     redirect_url = f"{frontend_url}/oauth/callback?error={quote(error_msg, safe='')}&provider={provider}"
     return redirect_url
 
+# ==================== OAuth 回調頁面 ====================
+
+OAUTH_PROVIDER_LABELS = {'line': 'LINE', 'google': 'Google'}
+
+# 綁定成功頁面顯示的 JSON（規範要求）
+LINK_SUCCESS_DATA = {
+    'message': '帳號連結成功',
+    'is_linked': True
+}
+
+OAUTH_PAGE_SOURCES = {
+    'login_failed': '''
+            <html><body>
+                <h1>{{ provider_label }} 登入失敗</h1>
+                <p>{{ message }}</p>
+            </body></html>
+        ''',
+    'link_failed': '''
+            <html><body>
+                <h1>{{ provider_label }} 連結失敗</h1>
+                <p>{{ message }}</p>
+            </body></html>
+        ''',
+    'linked': '''
+            <html><body>
+                <h1>帳號連結成功</h1>
+                <pre style="background:#f5f5f5;padding:20px;border-radius:8px;">{{ json_data }}</pre>
+                <p>{{ provider_label }} 帳號已成功綁定</p>
+                <script>
+                    setTimeout(() => {
+                        window.close();
+                    }, 2000);
+                </script>
+            </body></html>
+        ''',
+}
+
+# 啟動時編譯一次，依 (提供者, 結果) 取用，不必每次回應都重新解析樣板
+oauth_pages = {
+    (provider, outcome): app.jinja_env.from_string(source, globals={
+        'provider_label': label,
+        'json_data': json.dumps(LINK_SUCCESS_DATA, ensure_ascii=False, indent=2),
+    })
+    for provider, label in OAUTH_PROVIDER_LABELS.items()
+    for outcome, source in OAUTH_PAGE_SOURCES.items()
+}
+
+def render_oauth_page(provider, outcome, **context):
+    """以預先編譯的樣板輸出 OAuth 回調頁面"""
+    return render_template(oauth_pages[(provider, outcome)], **context)
+
 # ==================== OAuth 登入/註冊 API ====================
 
 @app.route('/api/login/line/init', methods=['GET'])
@@ -800,24 +3643,14 @@ def line_callback():
     error = request.args.get('error')
     
     if error:
-        return render_template_string('''
-            <html><body>
-                <h1>LINE 登入失敗</h1>
-                <p>{{ error }}</p>
-            </body></html>
-        ''', error=error), 400
+        return render_oauth_page('line', 'login_failed', message=error), 400
     
     if not code:
-        return render_template_string('''
-            <html><body>
-                <h1>LINE 登入失敗</h1>
-                <p>未收到授權碼</p>
-            </body></html>
-        '''), 400
+        return render_oauth_page('line', 'login_failed', message='未收到授權碼'), 400
     
     try:
         # 交換 access token
-        token_url = 'https://api.line.me/oauth2/v2.1/token'
+        token_url = LINE_TOKEN_URL
         token_data = {
             'grant_type': 'authorization_code',
             'code': code,
@@ -826,55 +3659,34 @@ def line_callback():
             'client_secret': LINE_CLIENT_SECRET
         }
         
-        token_response = requests.post(token_url, data=token_data)
+        token_response = oauth_clients['line'].post(token_url, data=token_data)
         token_json = token_response.json()
         
         if 'access_token' not in token_json:
-            return render_template_string('''
-                <html><body>
-                    <h1>LINE 登入失敗</h1>
-                    <p>無法取得 access token</p>
-                </body></html>
-            '''), 400
+            return render_oauth_page('line', 'login_failed', message='無法取得 access token'), 400
         
         access_token = token_json['access_token']
         id_token = token_json.get('id_token')
         
-        # 取得用戶資訊
+        # 取得用戶資訊：優先使用本機驗證後的 id_token，省去一次 profile API 往返
         line_id = None
         email = None
         display_name = ''
-        
-        if id_token:
-            # 嘗試解析 id_token 獲取用戶資訊
-            try:
-                payload = id_token.split('.')[1]
-                payload += '=' * (4 - len(payload) % 4)  # Padding
-                decoded_payload = base64.b64decode(payload)
-                # 嘗試多種編碼方式
-                try:
-                    user_info_str = decoded_payload.decode('utf-8')
-                except UnicodeDecodeError:
-                    # 如果 UTF-8 失敗，嘗試使用 errors='ignore' 或 'replace'
-                    user_info_str = decoded_payload.decode('utf-8', errors='replace')
-                
-                user_info = json.loads(user_info_str)
-                line_id = user_info.get('sub')
-                email = user_info.get('email')
-                display_name = user_info.get('name', '')
-                # 確保 display_name 是字符串且可以安全編碼
-                if display_name and not isinstance(display_name, str):
-                    display_name = str(display_name)
-            except (UnicodeDecodeError, json.JSONDecodeError, IndexError, Exception) as e:
-                # 如果 id_token 解析失敗，使用 access token 作為備用方法
-                # 不拋出異常，而是繼續使用 access token 方法
-                pass
-        
-        # 如果 id_token 解析失敗或沒有 id_token，使用 access token 獲取用戶資訊
+
+        claims = get_id_token_claims('line', id_token)
+        if claims:
+            line_id = claims.get('sub')
+            email = claims.get('email')
+            display_name = claims.get('name', '')
+            # 確保 display_name 是字符串且可以安全編碼
+            if display_name and not isinstance(display_name, str):
+                display_name = str(display_name)
+
+        # 沒有 id_token 或驗證失敗時，使用 access token 獲取用戶資訊
         if not line_id:
-            profile_url = 'https://api.line.me/v2/profile'
+            profile_url = LINE_PROFILE_URL
             headers = {'Authorization': f'Bearer {access_token}'}
-            profile_response = requests.get(profile_url, headers=headers)
+            profile_response = oauth_clients['line'].get(profile_url, headers=headers)
             profile_data = profile_response.json()
             line_id = profile_data.get('userId')
             display_name = profile_data.get('displayName', '')
@@ -883,10 +3695,10 @@ def line_callback():
             email = None
         
         # 查找或創建用戶
-        user_id, username = find_or_create_oauth_user(line_id, 'line', display_name, email)
+        user_id, username, token_version = find_or_create_oauth_user(line_id, 'line', display_name, email)
 
         # 創建重定向 URL
-        redirect_url = create_oauth_redirect_url(user_id, username, 'line')
+        redirect_url = create_oauth_redirect_url(user_id, username, 'line', token_version)
         return redirect(redirect_url)
     
     except Exception as e:
@@ -900,24 +3712,14 @@ def google_callback():
     error = request.args.get('error')
     
     if error:
-        return render_template_string('''
-            <html><body>
-                <h1>Google 登入失敗</h1>
-                <p>{{ error }}</p>
-            </body></html>
-        ''', error=error), 400
+        return render_oauth_page('google', 'login_failed', message=error), 400
     
     if not code:
-        return render_template_string('''
-            <html><body>
-                <h1>Google 登入失敗</h1>
-                <p>未收到授權碼</p>
-            </body></html>
-        '''), 400
+        return render_oauth_page('google', 'login_failed', message='未收到授權碼'), 400
     
     try:
         # 交換 access token
-        token_url = 'https://oauth2.googleapis.com/token'
+        token_url = GOOGLE_TOKEN_URL
         token_data = {
             'code': code,
             'client_id': GOOGLE_CLIENT_ID,
@@ -926,34 +3728,35 @@ def google_callback():
             'grant_type': 'authorization_code'
         }
         
-        token_response = requests.post(token_url, data=token_data)
+        token_response = oauth_clients['google'].post(token_url, data=token_data)
         token_json = token_response.json()
         
         if 'access_token' not in token_json:
-            return render_template_string('''
-                <html><body>
-                    <h1>Google 登入失敗</h1>
-                    <p>無法取得 access token</p>
-                </body></html>
-            '''), 400
+            return render_oauth_page('google', 'login_failed', message='無法取得 access token'), 400
         
         access_token = token_json['access_token']
         
-        # 取得用戶資訊
-        userinfo_url = 'https://www.googleapis.com/oauth2/v2/userinfo'
-        headers = {'Authorization': f'Bearer {access_token}'}
-        userinfo_response = requests.get(userinfo_url, headers=headers)
-        userinfo_data = userinfo_response.json()
-        
-        google_id = userinfo_data.get('id')
-        email = userinfo_data.get('email')
-        display_name = userinfo_data.get('name')
+        # 取得用戶資訊：優先使用本機驗證後的 id_token，缺少 claims 時才呼叫 userinfo
+        claims = get_id_token_claims('google', token_json.get('id_token'))
+        if claims:
+            google_id = claims.get('sub')
+            email = claims.get('email')
+            display_name = claims.get('name')
+        else:
+            userinfo_url = GOOGLE_USERINFO_URL
+            headers = {'Authorization': f'Bearer {access_token}'}
+            userinfo_response = oauth_clients['google'].get(userinfo_url, headers=headers)
+            userinfo_data = userinfo_response.json()
+            
+            google_id = userinfo_data.get('id')
+            email = userinfo_data.get('email')
+            display_name = userinfo_data.get('name')
         
         # 查找或創建用戶
-        user_id, username = find_or_create_oauth_user(google_id, 'google', display_name, email)
+        user_id, username, token_version = find_or_create_oauth_user(google_id, 'google', display_name, email)
 
         # 創建重定向 URL
-        redirect_url = create_oauth_redirect_url(user_id, username, 'google')
+        redirect_url = create_oauth_redirect_url(user_id, username, 'google', token_version)
         return redirect(redirect_url)
 
     except Exception as e:
@@ -1018,20 +3821,10 @@ def line_link_callback():
     error = request.args.get('error')
     
     if error:
-        return render_template_string('''
-            <html><body>
-                <h1>LINE 連結失敗</h1>
-                <p>{{ error }}</p>
-            </body></html>
-        ''', error=error), 400
+        return render_oauth_page('line', 'link_failed', message=error), 400
     
     if not code or not state:
-        return render_template_string('''
-            <html><body>
-                <h1>LINE 連結失敗</h1>
-                <p>未收到授權碼或狀態參數</p>
-            </body></html>
-        '''), 400
+        return render_oauth_page('line', 'link_failed', message='未收到授權碼或狀態參數'), 400
     
     try:
         # 解析 state 獲取用戶 ID
@@ -1039,15 +3832,10 @@ def line_link_callback():
         user_id = state_data.get('user_id')
         
         if not user_id:
-            return render_template_string('''
-                <html><body>
-                    <h1>LINE 連結失敗</h1>
-                    <p>無效的狀態參數</p>
-                </body></html>
-            '''), 400
+            return render_oauth_page('line', 'link_failed', message='無效的狀態參數'), 400
         
         # 交換 access token
-        token_url = 'https://api.line.me/oauth2/v2.1/token'
+        token_url = LINE_TOKEN_URL
         token_data = {
             'grant_type': 'authorization_code',
             'code': code,
@@ -1056,30 +3844,23 @@ def line_link_callback():
             'client_secret': LINE_CLIENT_SECRET
         }
         
-        token_response = requests.post(token_url, data=token_data)
+        token_response = oauth_clients['line'].post(token_url, data=token_data)
         token_json = token_response.json()
         
         if 'access_token' not in token_json:
-            return render_template_string('''
-                <html><body>
-                    <h1>LINE 連結失敗</h1>
-                    <p>無法取得 access token</p>
-                </body></html>
-            '''), 400
+            return render_oauth_page('line', 'link_failed', message='無法取得 access token'), 400
         
         access_token = token_json['access_token']
         id_token = token_json.get('id_token')
         
         # 取得用戶資訊
-        if id_token:
-            payload = id_token.split('.')[1]
-            payload += '=' * (4 - len(payload) % 4)
-            user_info = json.loads(base64.b64decode(payload))
-            line_id = user_info.get('sub')
+        claims = get_id_token_claims('line', id_token)
+        if claims and claims.get('sub'):
+            line_id = claims['sub']
         else:
-            profile_url = 'https://api.line.me/v2/profile'
+            profile_url = LINE_PROFILE_URL
             headers = {'Authorization': f'Bearer {access_token}'}
-            profile_response = requests.get(profile_url, headers=headers)
+            profile_response = oauth_clients['line'].get(profile_url, headers=headers)
             profile_data = profile_response.json()
             line_id = profile_data.get('userId')
         
@@ -1090,44 +3871,19 @@ def line_link_callback():
         cursor.execute('SELECT id FROM users WHERE line_id = %s AND id != %s', (line_id, user_id))
         if cursor.fetchone():
             conn.close()
-            return render_template_string('''
-                <html><body>
-                    <h1>LINE 連結失敗</h1>
-                    <p>此 LINE 帳號已被其他用戶綁定</p>
-                </body></html>
-            '''), 409
+            return render_oauth_page('line', 'link_failed', message='此 LINE 帳號已被其他用戶綁定'), 409
         
         # 更新用戶的 LINE ID
         cursor.execute('UPDATE users SET line_id = %s WHERE id = %s', (line_id, user_id))
         conn.commit()
+        profile_cache.invalidate(user_id)
+        oauth_user_cache.invalidate_user(user_id)
         conn.close()
         
-        # 返回 JSON 格式（規範要求）
-        response_data = {
-            'message': '帳號連結成功',
-            'is_linked': True
-        }
-        
-        return render_template_string('''
-            <html><body>
-                <h1>帳號連結成功</h1>
-                <pre style="background:#f5f5f5;padding:20px;border-radius:8px;">{{ json_data }}</pre>
-                <p>LINE 帳號已成功綁定</p>
-                <script>
-                    setTimeout(() => {
-                        window.close();
-                    }, 2000);
-                </script>
-            </body></html>
-        ''', json_data=json.dumps(response_data, ensure_ascii=False, indent=2)), 200
+        return render_oauth_page('line', 'linked'), 200
     
     except Exception as e:
-        return render_template_string('''
-            <html><body>
-                <h1>LINE 連結失敗</h1>
-                <p>{{ error }}</p>
-            </body></html>
-        ''', error=str(e)), 500
+        return render_oauth_page('line', 'link_failed', message=str(e)), 500
 
 @app.route('/api/callback/link/google', methods=['GET'])
 def google_link_callback():
@@ -1137,20 +3893,10 @@ def google_link_callback():
     error = request.args.get('error')
     
     if error:
-        return render_template_string('''
-            <html><body>
-                <h1>Google 連結失敗</h1>
-                <p>{{ error }}</p>
-            </body></html>
-        ''', error=error), 400
+        return render_oauth_page('google', 'link_failed', message=error), 400
     
     if not code or not state:
-        return render_template_string('''
-            <html><body>
-                <h1>Google 連結失敗</h1>
-                <p>未收到授權碼或狀態參數</p>
-            </body></html>
-        '''), 400
+        return render_oauth_page('google', 'link_failed', message='未收到授權碼或狀態參數'), 400
     
     try:
         # 解析 state 獲取用戶 ID
@@ -1158,15 +3904,10 @@ def google_link_callback():
         user_id = state_data.get('user_id')
         
         if not user_id:
-            return render_template_string('''
-                <html><body>
-                    <h1>Google 連結失敗</h1>
-                    <p>無效的狀態參數</p>
-                </body></html>
-            '''), 400
+            return render_oauth_page('google', 'link_failed', message='無效的狀態參數'), 400
         
         # 交換 access token
-        token_url = 'https://oauth2.googleapis.com/token'
+        token_url = GOOGLE_TOKEN_URL
         token_data = {
             'code': code,
             'client_id': GOOGLE_CLIENT_ID,
@@ -1175,26 +3916,25 @@ def google_link_callback():
             'grant_type': 'authorization_code'
         }
         
-        token_response = requests.post(token_url, data=token_data)
+        token_response = oauth_clients['google'].post(token_url, data=token_data)
         token_json = token_response.json()
         
         if 'access_token' not in token_json:
-            return render_template_string('''
-                <html><body>
-                    <h1>Google 連結失敗</h1>
-                    <p>無法取得 access token</p>
-                </body></html>
-            '''), 400
+            return render_oauth_page('google', 'link_failed', message='無法取得 access token'), 400
         
         access_token = token_json['access_token']
         
         # 取得用戶資訊
-        userinfo_url = 'https://www.googleapis.com/oauth2/v2/userinfo'
-        headers = {'Authorization': f'Bearer {access_token}'}
-        userinfo_response = requests.get(userinfo_url, headers=headers)
-        userinfo_data = userinfo_response.json()
-        
-        google_id = userinfo_data.get('id')
+        claims = get_id_token_claims('google', token_json.get('id_token'))
+        if claims and claims.get('sub'):
+            google_id = claims['sub']
+        else:
+            userinfo_url = GOOGLE_USERINFO_URL
+            headers = {'Authorization': f'Bearer {access_token}'}
+            userinfo_response = oauth_clients['google'].get(userinfo_url, headers=headers)
+            userinfo_data = userinfo_response.json()
+            
+            google_id = userinfo_data.get('id')
         
         # 檢查此 Google ID 是否已被其他用戶綁定
         conn = get_db_connection()
@@ -1203,48 +3943,183 @@ def google_link_callback():
         cursor.execute('SELECT id FROM users WHERE google_id = %s AND id != %s', (google_id, user_id))
         if cursor.fetchone():
             conn.close()
-            return render_template_string('''
-                <html><body>
-                    <h1>Google 連結失敗</h1>
-                    <p>此 Google 帳號已被其他用戶綁定</p>
-                </body></html>
-            '''), 409
+            return render_oauth_page('google', 'link_failed', message='此 Google 帳號已被其他用戶綁定'), 409
         
         # 更新用戶的 Google ID
         cursor.execute('UPDATE users SET google_id = %s WHERE id = %s', (google_id, user_id))
         conn.commit()
+        profile_cache.invalidate(user_id)
+        oauth_user_cache.invalidate_user(user_id)
         conn.close()
         
-        # 返回 JSON 格式（規範要求）
-        response_data = {
-            'message': '帳號連結成功',
-            'is_linked': True
-        }
-        
-        return render_template_string('''
-            <html><body>
-                <h1>帳號連結成功</h1>
-                <pre style="background:#f5f5f5;padding:20px;border-radius:8px;">{{ json_data }}</pre>
-                <p>Google 帳號已成功綁定</p>
-                <script>
-                    setTimeout(() => {
-                        window.close();
-                    }, 2000);
-                </script>
-            </body></html>
-        ''', json_data=json.dumps(response_data, ensure_ascii=False, indent=2)), 200
+        return render_oauth_page('google', 'linked'), 200
     
     except Exception as e:
-        return render_template_string('''
-            <html><body>
-                <h1>Google 連結失敗</h1>
-                <p>{{ error }}</p>
-            </body></html>
-        ''', error=str(e)), 500
+        return render_oauth_page('google', 'link_failed', message=str(e)), 500
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'ok'}), 200
 
+# ==================== 就緒檢查 ====================
+
+READY_CACHE_SECONDS = float(os.getenv('READY_CACHE_SECONDS', '2'))  # 檢查結果快取秒數
+READY_DB_TIMEOUT = float(os.getenv('READY_DB_TIMEOUT', '1'))  # 借用連接的最長等待秒數
+READY_POOL_SATURATION = float(os.getenv('READY_POOL_SATURATION', '0'))  # >0 時借出比例達此值視為未就緒；0 = 只回報
+
+def probe_database():
+    """資料庫 ping 延遲與連接池飽和度"""
+    pool = db_pool.stats()
+    saturation = round(pool['in_use'] / pool['max_size'], 3) if pool['max_size'] else 1.0
+    result = {'pool_in_use': pool['in_use'], 'pool_max_size': pool['max_size'], 'pool_saturation': saturation}
+    if READY_POOL_SATURATION > 0 and saturation >= READY_POOL_SATURATION:
+        result.update(status='saturated', ping_ms=None)
+        return result
+    if pool['idle'] == 0 and pool['size'] >= pool['max_size']:
+        # 連接全數借出代表資料庫正在服務請求；不排隊等待 ping，也不因忙碌而被負載平衡器摘除
+        result.update(status='busy', ping_ms=None)
+        return result
+
+    started = time.perf_counter()
+    try:
+        conn = db_pool.acquire(timeout=READY_DB_TIMEOUT)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+        finally:
+            conn.close()
+    except Exception as e:
+        result.update(status='down', ping_ms=None, error=str(e))
+        return result
+    result.update(status='ok', ping_ms=round((time.perf_counter() - started) * 1000, 2))
+    return result
+
+def probe_captcha():
+    """驗證碼預產生池與答案存儲"""
+    pool = captcha_pool.stats()
+    result = {
+        'mode': CAPTCHA_MODE,
+        'pool_depth': pool['depth'],
+        'pool_errors': pool['errors'],
+        'worker_alive': pool['worker_alive'],
+    }
+    try:
+        store_ok = captcha_store.ping()
+    except Exception:
+        store_ok = False
+    result['store'] = 'ok' if store_ok else 'down'
+    if not store_ok and CAPTCHA_MODE != 'stateless':
+        result['status'] = 'down'
+    elif pool['depth'] == 0 and pool['errors'] > 0:
+        # 池為空且背景產生失敗時仍可即時產生，只標示為降級
+        result['status'] = 'degraded'
+    else:
+        result['status'] = 'ok'
+    return result
+
+def probe_oauth():
+    """OAuth 提供者可用性（依最近呼叫結果，不發出即時請求）"""
+    return {provider: client.health() for provider, client in oauth_clients.items()}
+
+class ReadinessCache:
+    """
+    就緒檢查結果快取
+
+    負載平衡器頻繁輪詢時，READY_CACHE_SECONDS 內只執行一次實際檢查；
+    同一時間只有一個請求執行檢查，其他請求沿用上一次的結果。
+    """
+
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl
+        self._result = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, probe):
+        now = time.monotonic()
+        if self._result is not None and now < self._expires_at:
+            return self._result
+        if not self._lock.acquire(blocking=self._result is None):
+            return self._result
+        try:
+            if self._result is None or time.monotonic() >= self._expires_at:
+                self._result = probe()
+                self._expires_at = time.monotonic() + self.ttl
+            return self._result
+        finally:
+            self._lock.release()
+
+readiness_cache = ReadinessCache(READY_CACHE_SECONDS)
+
+def run_readiness_probes():
+    checks = {
+        'database': probe_database(),
+        'captcha': probe_captcha(),
+        'oauth': probe_oauth(),
+    }
+    # 資料庫無法使用或驗證碼無法驗證時無法登入；連接池忙碌與 OAuth 異常只回報不影響就緒
+    ready = checks['database']['status'] in ('ok', 'busy') and checks['captcha']['status'] != 'down'
+    return ready, {
+        'status': 'ready' if ready else 'not_ready',
+        'checked_at': datetime.now().isoformat(timespec='seconds'),
+        'checks': checks,
+    }
+
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """就緒檢查：資料庫、連接池、驗證碼與 OAuth 提供者狀態"""
+    ready, body = readiness_cache.get(run_readiness_probes)
+    response = jsonify(body)
+    response.status_code = 200 if ready else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def collect_component_gauges():
+    """抓取時讀取連接池、驗證碼池與各快取的即時狀態"""
+    components = {
+        'db_pool': db_pool.stats(),
+        'captcha_pool': captcha_pool.stats(),
+        'profile_cache': profile_cache.stats(),
+        'jwt_verify_cache': verified_token_cache.stats(),
+        'password_hash': password_hasher.stats(),
+    }
+    for component, snapshot in components.items():
+        for name, value in snapshot.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield f'{component}_{name}', (), value
+
+metrics.register_collector(collect_component_gauges)
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 指標"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return jsonify({'message': '未授權'}), 401
+    return app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8',
+                              headers={'Cache-Control': 'no-store'})
+
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    # 啟動時校準密碼雜湊參數，避免第一個註冊/登入請求承擔校準耗時
+    password_hash_policy.method
+
+    # 啟動時偵測資料表結構；資料庫尚未就緒時改為第一次請求時偵測
+    try:
+        refresh_schema_capabilities()
+    except Exception:
+        pass
+
+    # 執行資料庫遷移後可送出 SIGHUP 重新偵測
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: refresh_schema_capabilities())
+
+    # 預先抓取 OAuth 提供者公鑰，第一個 OAuth 登入不必等待
+    for provider, settings in ID_TOKEN_SETTINGS.items():
+        if settings['audience']:
+            oauth_jwks[provider].refresh_async()
+
+    if SERVER_MODE == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        WSGIServer((SERVER_HOST, SERVER_PORT), app, spawn=SERVER_MAX_CONNECTIONS).serve_forever()
+    else:
+        app.run(debug=True, port=5000)
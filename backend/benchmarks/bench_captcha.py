@@ -0,0 +1,73 @@
+"""
+驗證碼渲染吞吐量
+
+比較舊版逐字 textbbox / draw.point 的渲染方式（每次重新載入字體）與目前的
+字元圖集 + 向量化雜訊渲染器；兩者使用同一個字體與 PNG 輸出，另列出 png8 / webp。
+
+用法：python benchmarks/bench_captcha.py [--iterations 500]
+"""
+import argparse
+import io
+import random
+
+from common import per_call, report
+
+from PIL import Image, ImageDraw, ImageFont
+
+import app as backend
+
+def resolve_font_path():
+    for font_path in backend.CAPTCHA_FONT_PATHS:
+        if font_path and backend.os.path.exists(font_path):
+            return font_path
+    return None
+
+def legacy_captcha_image(text, font_path, width=200, height=80):
+    """改版前的渲染流程（每次載入字體、逐字量測、逐點繪製、Pillow PNG 編碼）"""
+    image = Image.new('RGB', (width, height), color=(255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.truetype(font_path, 36) if font_path else ImageFont.load_default()
+
+    text_width = sum(draw.textbbox((0, 0), char, font=font)[2] - draw.textbbox((0, 0), char, font=font)[0] for char in text)
+    text_height = draw.textbbox((0, 0), text, font=font)[3] - draw.textbbox((0, 0), text, font=font)[1]
+    x = (width - text_width) / 2
+    y = (height - text_height) / 2
+
+    char_x = x
+    for char in text:
+        color = (random.randint(0, 100), random.randint(0, 100), random.randint(0, 100))
+        offset_y = random.randint(-5, 5)
+        draw.text((char_x, y + offset_y), char, fill=color, font=font)
+        bbox = draw.textbbox((0, 0), char, font=font)
+        char_x += (bbox[2] - bbox[0]) + 5
+
+    for _ in range(3):
+        start = (random.randint(0, width), random.randint(0, height))
+        end = (random.randint(0, width), random.randint(0, height))
+        draw.line([start, end], fill=(random.randint(150, 255), random.randint(150, 255), random.randint(150, 255)), width=2)
+
+    for _ in range(50):
+        draw.point((random.randint(0, width), random.randint(0, height)),
+                   fill=(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
+
+    img_io = io.BytesIO()
+    image.save(img_io, format='PNG')
+    img_io.seek(0)
+    return img_io
+
+def main():
+    parser = argparse.ArgumentParser(description='驗證碼渲染吞吐量')
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    font_path = resolve_font_path()
+    print(f'字體：{font_path or "Pillow 預設字體"}（單一執行緒，每秒張數 = 1 / 每張耗時）')
+
+    legacy = per_call(lambda: legacy_captcha_image('X7QZ', font_path), args.iterations)
+    for image_format in ('png', 'png8', 'webp'):
+        current = per_call(lambda: backend.generate_captcha_image('X7QZ', image_format=image_format), args.iterations)
+        report(f'generate_captcha_image ({image_format})', legacy, current)
+        print(f'{"":<44}{1 / legacy:>10.0f} /s -> {1 / current:>8.0f} /s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+單一行程的並行能力：同步模式 vs SERVER_MODE=gevent
+
+啟動一個本機假 LINE 提供者（token 與 profile 各延遲 --latency 秒），再以子行程
+啟動後端（sync = 單執行緒 WSGI，相當於 gunicorn sync worker；threaded = werkzeug
+每請求一執行緒；gevent = 協程模式），同時送出 --clients 個 /api/callback/line 請求，
+回報吞吐量與延遲分位數。不需要資料庫：回調在查詢用戶時失敗並重定向，
+但前面兩次提供者往返與真實流程相同。
+
+用法：python benchmarks/bench_concurrency.py --modes sync,gevent --clients 50
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from common import BACKEND_DIR
+
+import requests
+
+SERVE_CODE = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import app as backend
+mode, port = sys.argv[2], int(sys.argv[3])
+if mode == 'gevent':
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(('127.0.0.1', port), backend.app, spawn=backend.SERVER_MAX_CONNECTIONS, log=None).serve_forever()
+else:
+    from werkzeug.serving import make_server
+    make_server('127.0.0.1', port, backend.app, threaded=(mode == 'threaded')).serve_forever()
+'''
+
+class SlowProvider(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        time.sleep(self.latency)
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # 不回傳 id_token，後端改呼叫 profile API（兩次往返）
+        self._reply({'access_token': 'fake-access-token'})
+
+    def do_GET(self):
+        self._reply({'userId': 'U-bench', 'displayName': 'Bench'})
+
+def run_mode(mode, port, provider_url, clients):
+    env = dict(os.environ, SERVER_MODE='gevent' if mode == 'gevent' else 'dev', RATE_LIMIT_ENABLED='false',
+               LINE_TOKEN_URL=f'{provider_url}/token', LINE_PROFILE_URL=f'{provider_url}/profile')
+    process = subprocess.Popen([sys.executable, '-c', SERVE_CODE, BACKEND_DIR, mode, str(port)],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                requests.get(f'{base_url}/api/health', timeout=1)
+                break
+            except requests.RequestException:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError(f'{mode} 模式的後端無法啟動')
+                time.sleep(0.2)
+
+        latencies = []
+        lock = threading.Lock()
+
+        def one():
+            started = time.perf_counter()
+            requests.get(f'{base_url}/api/callback/line', params={'code': 'bench'}, allow_redirects=False)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+        threads = [threading.Thread(target=one) for _ in range(clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+    print(f'{mode:<10}{clients:>8}{clients / elapsed:>10.1f}{p50 * 1000:>10.0f}{p99 * 1000:>10.0f}')
+
+def main():
+    parser = argparse.ArgumentParser(description='單一行程的並行能力')
+    parser.add_argument('--modes', default='sync,threaded,gevent')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.1, help='假提供者每次回應延遲秒數')
+    parser.add_argument('--port', type=int, default=5098)
+    args = parser.parse_args()
+
+    SlowProvider.latency = args.latency
+    ThreadingHTTPServer.request_queue_size = 1024
+    provider = ThreadingHTTPServer(('127.0.0.1', 0), SlowProvider)
+    provider.daemon_threads = True
+    threading.Thread(target=provider.serve_forever, daemon=True).start()
+    provider_url = f'http://127.0.0.1:{provider.server_port}'
+
+    print(f'{"mode":<10}{"clients":>8}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}')
+    for mode in args.modes.split(','):
+        run_mode(mode.strip(), args.port, provider_url, args.clients)
+    provider.shutdown()
+
+if __name__ == '__main__':
+    main()
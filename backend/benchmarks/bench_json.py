@@ -0,0 +1,90 @@
+"""
+JSON 序列化與回應壓縮
+
+以 login / get_profile 的回應結構（另加一個 50 筆的菜單清單，模擬之後的列表端點）
+比較 Flask 預設 provider 與 FastJSONProvider 的 response() 耗時，並列出
+原始、gzip 與 brotli（已安裝時）的回應大小。
+
+用法：python benchmarks/bench_json.py [--iterations 20000]
+"""
+import argparse
+
+from common import per_call, report
+
+from flask.json.provider import DefaultJSONProvider
+
+import app as backend
+
+LOGIN_RESPONSE = {
+    'message': '登入成功',
+    'token': 'eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.' + 'x' * 220,
+    'refresh_token': '0123456789abcdef0123456789abcdef.42.0.' + 'y' * 43,
+    'refresh_expires_in': 2592000,
+    'user': 'merchant_owner',
+    'role': 'merchant',
+    'display_name': '王小明的早餐店',
+    'email': 'owner@example.com',
+    'phone': '0912345678',
+    'expires_in': 1800,
+    'merchant': {
+        'id': 17, 'business_name': '王小明的早餐店', 'business_type': '早餐',
+        'address': '台北市中正區重慶南路一段 122 號', 'logo_url': None,
+        'is_verified': True, 'rating': 4.6,
+    },
+}
+
+PROFILE_RESPONSE = {
+    'message': 'test success',
+    'user_id': 42,
+    'username': 'merchant_owner',
+    'email': 'owner@example.com',
+    'display_name': '王小明的早餐店',
+    'role': 'merchant',
+    'phone': '0912345678',
+    'is_line_linked': True,
+    'is_google_linked': False,
+    'merchant': {
+        'id': 17, 'business_name': '王小明的早餐店', 'business_type': '早餐',
+        'address': '台北市中正區重慶南路一段 122 號', 'description': '手工蛋餅與現煮豆漿',
+        'logo_url': None, 'is_verified': True, 'rating': 4.6,
+    },
+}
+
+MENU_RESPONSE = {
+    'items': [
+        {'id': i, 'name': f'招牌蛋餅 {i} 號', 'price': 45 + i, 'category': '蛋餅',
+         'description': '酥脆餅皮搭配新鮮雞蛋與青蔥', 'is_available': i % 7 != 0}
+        for i in range(50)
+    ],
+    'total': 50,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON 序列化與回應壓縮')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    if backend.orjson is None:
+        print('未安裝 orjson，FastJSONProvider 未啟用，只列出大小')
+    default_provider = DefaultJSONProvider(backend.app)
+    fast_provider = backend.app.json
+
+    shapes = {'login': LOGIN_RESPONSE, 'get_profile': PROFILE_RESPONSE, 'menu (50 items)': MENU_RESPONSE}
+    with backend.app.app_context():
+        print('序列化（provider.response，每次耗時）')
+        for name, payload in shapes.items():
+            before = per_call(lambda: default_provider.response(payload), args.iterations)
+            after = per_call(lambda: fast_provider.response(payload), args.iterations)
+            report(name, before, after)
+
+        print(f'\n回應大小（bytes；超過 COMPRESS_MIN_SIZE={backend.COMPRESS_MIN_SIZE} 才會壓縮）')
+        print(f'{"":<20}{"default":>10}{"fast":>10}{"gzip":>10}{"br":>10}')
+        for name, payload in shapes.items():
+            default_body = default_provider.response(payload).get_data()
+            fast_body = fast_provider.response(payload).get_data()
+            gzip_size = len(backend.compress_body(fast_body, 'gzip'))
+            br_size = len(backend.compress_body(fast_body, 'br')) if backend.brotli else '-'
+            print(f'{name:<20}{len(default_body):>10}{len(fast_body):>10}{gzip_size:>10}{br_size:>10}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+已驗證 JWT 快取：每次請求的解碼耗時（快取開 / 關）
+
+1. 直接呼叫 jwt._decode_jwt_from_config（HS256 access token）
+2. 以 test client 呼叫 @jwt_required 的 /api/profile（預先放入個人資料快取，
+   不需要資料庫），量測整個請求
+
+關閉快取時把 VerifiedTokenCache.max_entries 設為 0，與 JWT_VERIFY_CACHE_SIZE=0 相同。
+
+用法：python benchmarks/bench_jwt_cache.py [--iterations 5000]
+"""
+import argparse
+
+from common import per_call, report
+
+import app as backend
+
+def main():
+    parser = argparse.ArgumentParser(description='已驗證 JWT 快取')
+    parser.add_argument('--iterations', type=int, default=5000)
+    args = parser.parse_args()
+
+    cache = backend.verified_token_cache
+    enabled_size = cache.max_entries or 10000
+    user_id = 42
+    with backend.app.app_context():
+        token = backend.create_user_access_token(user_id)
+    backend.profile_cache.set(user_id, backend.app.json.dumps({'user_id': user_id}).encode('utf-8'),
+                              backend.profile_cache.generation(user_id))
+    client = backend.app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+
+    def decode():
+        with backend.app.app_context():
+            backend.jwt._decode_jwt_from_config(token)
+
+    def profile_request():
+        response = client.get('/api/profile', headers=headers)
+        assert response.status_code == 200, response.status_code
+
+    results = {}
+    for label, size in (('off', 0), ('on', enabled_size)):
+        cache.max_entries = size
+        results[label] = (per_call(decode, args.iterations), per_call(profile_request, args.iterations // 5))
+    cache.max_entries = enabled_size
+
+    report('_decode_jwt_from_config', results['off'][0], results['on'][0])
+    report('GET /api/profile (@jwt_required)', results['off'][1], results['on'][1])
+
+if __name__ == '__main__':
+    main()
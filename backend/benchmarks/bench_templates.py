@@ -0,0 +1,36 @@
+"""
+OAuth 回調頁面：每次 render_template_string vs 預先編譯的樣板
+
+兩者輸出相同的「登入失敗」與「連結成功」頁面，並在請求環境內渲染
+（與處理函數相同，會執行 context processor）。
+
+用法：python benchmarks/bench_templates.py [--iterations 5000]
+"""
+import argparse
+import json
+
+from common import per_call, report
+
+from flask import render_template_string
+
+import app as backend
+
+def main():
+    parser = argparse.ArgumentParser(description='OAuth 回調頁面渲染')
+    parser.add_argument('--iterations', type=int, default=5000)
+    args = parser.parse_args()
+
+    link_json = json.dumps(backend.LINK_SUCCESS_DATA, ensure_ascii=False, indent=2)
+    with backend.app.test_request_context('/api/callback/line'):
+        for outcome in ('login_failed', 'linked'):
+            source = backend.OAUTH_PAGE_SOURCES[outcome]
+            inline = per_call(lambda: render_template_string(
+                source, provider_label='LINE', json_data=link_json, message='無法取得 access token'
+            ), args.iterations)
+            compiled = per_call(lambda: backend.render_oauth_page(
+                'line', outcome, message='無法取得 access token'
+            ), args.iterations)
+            report(f'{outcome} page', inline, compiled)
+
+if __name__ == '__main__':
+    main()
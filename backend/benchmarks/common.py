@@ -0,0 +1,29 @@
+"""
+基準測試共用工具
+
+各 bench_*.py 直接匯入 backend/app.py 並在單一行程內量測；
+數字會隨機器而不同，比較時請在同一台機器上執行前後版本。
+"""
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+def per_call(func, iterations, rounds=3):
+    """執行 rounds 輪、每輪 iterations 次，回傳最快一輪的每次耗時（秒）"""
+    func()  # 暖機（載入字體、編譯樣板等一次性成本）
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = (time.perf_counter() - started) / iterations
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def report(name, before, after, unit='us'):
+    """輸出前後對照與倍數（before / after 為秒）"""
+    scale = {'us': 1e6, 'ms': 1e3}[unit]
+    print(f'{name:<44}{before * scale:>10.1f} {unit} -> {after * scale:>8.1f} {unit}   {before / after:>5.1f}x')
@@ -22,6 +22,7 @@ CREATE TABLE IF NOT EXISTS users (
     google_id VARCHAR(100) NULL UNIQUE COMMENT 'Google ID（OAuth）',
     failed_attempts INT DEFAULT 0 COMMENT '登入失敗次數',
     lockout_until DATETIME NULL COMMENT '帳號鎖定到期時間',
+    token_version INT NOT NULL DEFAULT 0 COMMENT 'JWT 版本（變更密碼時遞增，使舊 token 失效）',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
@@ -33,6 +34,9 @@ CREATE INDEX IF NOT EXISTS idx_users_line_id ON users(line_id);
 CREATE INDEX IF NOT EXISTS idx_users_google_id ON users(google_id);
 CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
 
+-- 既有資料庫升級：補上 token 版本欄位
+ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INT NOT NULL DEFAULT 0 COMMENT 'JWT 版本（變更密碼時遞增，使舊 token 失效）';
+
 -- ==========================================
 -- 2. 創建商家表 (merchants)
 -- ==========================================
@@ -115,6 +119,24 @@ CREATE TABLE IF NOT EXISTS order_items (
 CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id);
 CREATE INDEX IF NOT EXISTS idx_order_items_menu ON order_items(menu_item_id);
 
+-- ==========================================
+-- 6. 創建 Refresh Token 表 (refresh_tokens)
+-- ==========================================
+-- 每次登入（一個 token 家族）一列，只保存目前有效 refresh token 的 SHA-256
+CREATE TABLE IF NOT EXISTS refresh_tokens (
+    family_id BINARY(16) PRIMARY KEY COMMENT 'Token 家族ID',
+    user_id INT NOT NULL COMMENT '用戶ID',
+    token_hash BINARY(32) NOT NULL COMMENT '目前有效 refresh token 的 SHA-256',
+    token_version INT NOT NULL DEFAULT 0 COMMENT '簽發時的用戶 token 版本',
+    revoked BOOLEAN NOT NULL DEFAULT FALSE COMMENT '是否已撤銷（登出、變更密碼或偵測到重複使用）',
+    expires_at DATETIME NOT NULL COMMENT '家族到期時間',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Refresh Token 表索引
+CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user ON refresh_tokens(user_id);
+
 -- ==========================================
 -- 完成
 -- ==========================================
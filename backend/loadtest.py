@@ -0,0 +1,470 @@
+"""
+認證流程壓力測試
+
+以子行程啟動後端（固定驗證碼答案、關閉速率限制、LINE OAuth 指向本機假提供者），
+由後端以目前的密碼雜湊參數植入測試用戶後，多執行緒依權重同時混合執行各流程，
+回報各流程與整體的吞吐量與延遲分位數；結果比基準值差超過容許範圍、
+或尚無相同設定的基準值時以非零狀態碼結束。
+
+用法：
+    python loadtest.py --write-baseline
+    python loadtest.py --mix captcha_login=4,profile=10,register=1,change_username=1,oauth_callback=2
+    python loadtest.py --server-mode gevent --tolerance 0.3
+
+資料庫連線沿用 .env 的 DB_* 設定，請指向測試用資料庫（會新增 / 刪除 lt_ 開頭的用戶）。
+結束狀態碼：0 通過、1 效能退化、2 沒有可比較的基準值（設定不同時請以 --baseline 指定另一個檔案）。
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import jwt as pyjwt
+import requests
+from dotenv import load_dotenv
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BACKEND_DIR, 'loadtest_baseline.json')
+
+LOADTEST_CAPTCHA = 'LT42'
+LOADTEST_PASSWORD = 'loadtest-password'
+LINE_CLIENT_ID = 'loadtest-channel'
+LINE_CLIENT_SECRET = 'loadtest-channel-secret-0123456789abcdef'
+OAUTH_IDS_PER_WORKER = 50  # 每個執行緒輪流使用的假 LINE 帳號數（第一次建立，之後為重複登入）
+
+FLOWS = ('captcha_login', 'register', 'profile', 'change_username', 'oauth_callback')
+# 預設權重：以個人資料輪詢與登入為主，註冊與改名為少數
+DEFAULT_MIX = 'captcha_login=4,profile=10,register=1,change_username=1,oauth_callback=2'
+# 與基準值比較前必須一致的設定
+BASELINE_SETTINGS = ('mix', 'concurrency', 'duration', 'seed_users', 'server_mode', 'oauth_latency')
+
+# 子行程先載入 app（協程模式需在其他模組前修補標準函式庫），再交給 serve()
+SERVE_CODE = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import app as backend
+import loadtest
+loadtest.serve(backend, *map(int, sys.argv[2:5]))
+'''
+
+# ==================== 假 OAuth 提供者 ====================
+
+class FakeLineProvider(BaseHTTPRequestHandler):
+    """以授權碼作為 LINE 用戶 ID，回傳以 channel secret 簽章的 id_token"""
+
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(pair.split('=', 1) for pair in self.rfile.read(length).decode('ascii').split('&') if '=' in pair)
+        time.sleep(self.latency)
+        now = int(time.time())
+        id_token = pyjwt.encode({
+            'iss': 'https://access.line.me',
+            'aud': LINE_CLIENT_ID,
+            'sub': form.get('code', 'lt-unknown'),
+            'name': 'Load Test',
+            'iat': now,
+            'exp': now + 300,
+        }, LINE_CLIENT_SECRET, algorithm='HS256')
+        self._send_json(200, {'access_token': 'fake-access-token', 'id_token': id_token})
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self._send_json(200, {'userId': 'lt-profile', 'displayName': 'Load Test'})
+
+def start_fake_provider(latency):
+    FakeLineProvider.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeLineProvider)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ==================== 測試資料與後端子行程 ====================
+
+CLEANUP_SQL = r"""DELETE FROM users
+                  WHERE username LIKE 'lt\_reg\_%' OR username LIKE 'lt\_mv\_%' OR line_id LIKE 'lt-%'"""
+CLEANUP_REFRESH_SQL = r"""DELETE refresh_tokens FROM refresh_tokens JOIN users ON users.id = refresh_tokens.user_id
+                          WHERE users.username LIKE 'lt\_%'"""
+
+def seed_users(backend, count, rename_users):
+    """（子行程）清除上次測試留下的資料，植入 lt_user_0 ~ lt_user_{count-1} 與每個執行緒專用的 lt_rename_N
+
+    密碼以後端目前的雜湊參數（設定值或校準結果）計算一次，登入時不會觸發重新雜湊。
+    """
+    password_hash = backend.generate_password_hash(LOADTEST_PASSWORD, backend.password_hash_policy.method)
+    usernames = [f'lt_user_{i}' for i in range(count)] + [f'lt_rename_{i}' for i in range(rename_users)]
+    schema = backend.refresh_schema_capabilities()
+    conn = backend.db_pool.acquire()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(CLEANUP_SQL)
+        if schema.has_refresh_tokens:
+            cursor.execute(CLEANUP_REFRESH_SQL)
+        cursor.executemany('INSERT IGNORE INTO users (username, password) VALUES (%s, %s)',
+                           [(username, password_hash) for username in usernames])
+        cursor.execute(r"UPDATE users SET password = %s WHERE username LIKE 'lt\_user\_%' OR username LIKE 'lt\_rename\_%'",
+                       (password_hash,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def serve(backend, port, count, rename_users):
+    """（子行程）固定驗證碼答案、植入測試用戶後啟動伺服器；植入完成前 /api/ready 不會回應"""
+    backend.generate_captcha_text = lambda: LOADTEST_CAPTCHA
+    seed_users(backend, count, rename_users)
+    if backend.SERVER_MODE == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('127.0.0.1', port), backend.app, spawn=backend.SERVER_MAX_CONNECTIONS, log=None).serve_forever()
+    else:
+        from werkzeug.serving import make_server
+        make_server('127.0.0.1', port, backend.app, threaded=True).serve_forever()
+
+# ==================== 流程 ====================
+
+class FlowError(Exception):
+    pass
+
+def expect(response, *statuses):
+    if response.status_code not in statuses:
+        raise FlowError(f'{response.request.method} {response.url} -> {response.status_code}')
+    return response
+
+class Worker:
+    """單一執行緒的流程狀態（各自的 keep-alive 連線、登入 token 與改名用戶）"""
+
+    def __init__(self, base_url, index, seeded_users):
+        self.base_url = base_url
+        self.index = index
+        self.seeded_users = seeded_users
+        self.session = requests.Session()
+        self.counter = 0
+        self.token = None
+        self.etag = None
+        self.rename_username = f'lt_rename_{index}'
+        self.rename_token = None
+        self.renamed = False
+
+    def url(self, path):
+        return f'{self.base_url}{path}'
+
+    def login(self, username):
+        captcha = expect(self.session.get(self.url('/api/captcha')), 200).json()
+        response = expect(self.session.post(self.url('/api/login'), json={
+            'username': username,
+            'password': LOADTEST_PASSWORD,
+            'captcha_answer': LOADTEST_CAPTCHA,
+            'captcha_token': captcha['captcha_token'],
+        }), 200)
+        return response.json()['token']
+
+    def captcha_login(self):
+        self.login(f'lt_user_{random.randrange(self.seeded_users)}')
+
+    def register(self):
+        self.counter += 1
+        username = f'lt_reg_{self.index}_{self.counter}_{os.getpid()}'
+        expect(self.session.post(self.url('/api/register'), json={
+            'username': username,
+            'password': LOADTEST_PASSWORD,
+            'confirm_password': LOADTEST_PASSWORD,
+        }), 201)
+
+    def profile(self):
+        if self.token is None:
+            self.token = self.login(f'lt_user_{self.index % self.seeded_users}')
+        headers = {'Authorization': f'Bearer {self.token}'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        response = expect(self.session.get(self.url('/api/profile'), headers=headers), 200, 304)
+        self.etag = response.headers.get('ETag', self.etag)
+
+    def change_username(self):
+        # 每個執行緒使用自己的 lt_rename_N，與 profile 使用的用戶分開，兩個名稱之間切換
+        if self.rename_token is None:
+            self.rename_token = self.login(self.rename_username)
+        self.counter += 1
+        new_username = f'lt_mv_{self.index}_{self.counter % 2}'
+        response = expect(self.session.post(
+            self.url('/api/user/username'),
+            json={'new_username': new_username},
+            headers={'Authorization': f'Bearer {self.rename_token}'}
+        ), 200)
+        self.rename_token = response.json().get('token', self.rename_token)
+        self.renamed = True
+
+    def oauth_callback(self):
+        self.counter += 1
+        code = f'lt-{self.index}-{self.counter % OAUTH_IDS_PER_WORKER}'
+        response = expect(self.session.get(self.url('/api/callback/line'), params={'code': code},
+                                           allow_redirects=False), 302)
+        if 'error=' in response.headers.get('Location', ''):
+            raise FlowError(f'OAuth 回調失敗: {response.headers["Location"]}')
+
+    def restore(self):
+        """結束後把改名用戶改回 lt_rename_N，下次執行才能以原名稱登入"""
+        if self.renamed and self.rename_token:
+            try:
+                self.session.post(self.url('/api/user/username'), json={'new_username': self.rename_username},
+                                  headers={'Authorization': f'Bearer {self.rename_token}'})
+            except requests.RequestException:
+                pass
+
+def parse_mix(spec):
+    """把 'flow=weight,...' 轉成 {flow: weight}；未知流程或權重不是正數時拋出 ValueError"""
+    mix = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        flow, _, weight = item.partition('=')
+        flow = flow.strip()
+        if flow not in FLOWS:
+            raise ValueError(f'未知的流程: {flow}')
+        weight = float(weight) if weight.strip() else 1.0
+        if weight <= 0:
+            raise ValueError(f'{flow} 的權重必須大於 0')
+        mix[flow] = weight
+    if not mix:
+        raise ValueError('至少需要一個流程')
+    return mix
+
+def format_mix(mix):
+    return ','.join(f'{flow}={weight:g}' for flow, weight in mix.items())
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def summarize(latencies, errors, duration):
+    latencies.sort()
+    completed = len(latencies)
+    return {
+        'requests': completed,
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:3],
+        'throughput': round(completed / duration, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+    }
+
+def run_mix(mix, base_url, concurrency, duration, warmup, seeded_users):
+    """以 concurrency 條執行緒同時執行 duration 秒，每次依權重挑選流程；暖機期間的結果不列入統計"""
+    flows = list(mix)
+    weights = [mix[flow] for flow in flows]
+    latencies = {flow: [] for flow in flows}
+    errors = {flow: [] for flow in flows}
+    lock = threading.Lock()
+    start = time.monotonic()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+    workers = [Worker(base_url, index, seeded_users) for index in range(concurrency)]
+
+    def loop(worker):
+        rng = random.Random(worker.index)
+        while True:
+            began = time.monotonic()
+            if began >= stop_at:
+                break
+            flow = rng.choices(flows, weights)[0]
+            try:
+                getattr(worker, flow)()
+                failed = None
+            except (FlowError, requests.RequestException, KeyError, ValueError) as e:
+                failed = str(e)
+            elapsed = time.monotonic() - began
+            if began >= measure_from:
+                with lock:
+                    if failed:
+                        errors[flow].append(failed)
+                    else:
+                        latencies[flow].append(elapsed)
+        worker.restore()
+
+    threads = [threading.Thread(target=loop, args=(worker,), daemon=True) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results = {flow: summarize(list(latencies[flow]), errors[flow], duration) for flow in flows}
+    results['total'] = summarize([value for flow in flows for value in latencies[flow]],
+                                 [error for flow in flows for error in errors[flow]], duration)
+    return results
+
+# ==================== 基準值比較 ====================
+
+def baseline_mismatch(settings, baseline):
+    """回傳與基準值不同的設定；不同設定下的數字無法比較"""
+    expected = baseline.get('settings', {})
+    return [f'{key}: 本次 {settings[key]}，基準 {expected.get(key, "-")}'
+            for key in BASELINE_SETTINGS if expected.get(key) != settings[key]]
+
+def compare_with_baseline(results, baseline, tolerance):
+    """延遲超過基準 (1 + tolerance) 倍、吞吐量低於 (1 - tolerance) 倍、出現錯誤或基準缺少該流程即視為失敗"""
+    failures = []
+    for flow, result in results.items():
+        if result['errors']:
+            failures.append(f'{flow}: {result["errors"]} 個錯誤，例如 {result["error_samples"]}')
+        expected = baseline.get(flow)
+        if not expected:
+            failures.append(f'{flow}: 基準值沒有這個流程')
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if result[key] is not None and expected.get(key) and result[key] > expected[key] * (1 + tolerance):
+                failures.append(f'{flow}: {key} {result[key]} > 基準 {expected[key]} × {1 + tolerance:.2f}')
+        if expected.get('throughput') and result['throughput'] < expected['throughput'] * (1 - tolerance):
+            failures.append(f'{flow}: throughput {result["throughput"]} < 基準 {expected["throughput"]} × {1 - tolerance:.2f}')
+    return failures
+
+def print_report(results, baseline):
+    print(f'{"flow":<16}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"errors":>8}   baseline p50/p99')
+    for flow, result in results.items():
+        expected = baseline.get(flow, {})
+        reference = f'{expected.get("p50_ms", "-")}/{expected.get("p99_ms", "-")}' if expected else '-'
+        print(f'{flow:<16}{result["throughput"]:>10}{str(result["p50_ms"]):>10}{str(result["p95_ms"]):>10}'
+              f'{str(result["p99_ms"]):>10}{result["errors"]:>8}   {reference}')
+
+# ==================== 主程式 ====================
+
+def wait_until_ready(base_url, process, log, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'後端子行程啟動失敗：\n{read_tail(log)}')
+        try:
+            if requests.get(f'{base_url}/api/ready', timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f'後端在時限內未就緒（請確認 MySQL 與 DB_* 設定）：\n{read_tail(log)}')
+
+def read_tail(log, lines=20):
+    log.seek(0)
+    return '\n'.join(log.read().decode('utf-8', 'replace').splitlines()[-lines:])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='認證流程壓力測試')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'流程權重，可選流程：{", ".join(FLOWS)}')
+    parser.add_argument('--concurrency', type=int, default=20, help='同時執行的執行緒數')
+    parser.add_argument('--duration', type=float, default=30.0, help='量測秒數')
+    parser.add_argument('--warmup', type=float, default=5.0, help='暖機秒數（不列入統計）')
+    parser.add_argument('--seed-users', type=int, default=1000, help='植入的測試用戶數')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--server-mode', choices=('dev', 'gevent'), default='dev')
+    parser.add_argument('--oauth-latency', type=float, default=0.05, help='假 OAuth 提供者每次回應延遲秒數')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允許比基準差的比例')
+    parser.add_argument('--write-baseline', action='store_true', help='以本次結果覆寫基準值')
+    return parser.parse_args()
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def main():
+    args = parse_args()
+    load_dotenv(os.path.join(BACKEND_DIR, '.env'))
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        sys.exit(f'--mix 格式錯誤: {e}')
+    settings = {
+        'mix': format_mix(mix),
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'seed_users': args.seed_users,
+        'server_mode': args.server_mode,
+        'oauth_latency': args.oauth_latency,
+    }
+
+    # 先確認有可比較的基準值，避免跑完才發現無法判斷
+    baseline = None if args.write_baseline else load_baseline(args.baseline)
+    if not args.write_baseline:
+        if baseline is None:
+            print(f'找不到基準值 {args.baseline}，請先在基準版本以 --write-baseline 建立並提交')
+            sys.exit(2)
+        mismatch = baseline_mismatch(settings, baseline)
+        if mismatch:
+            print('本次設定與基準值不同，無法比較：')
+            for item in mismatch:
+                print(f'  - {item}')
+            sys.exit(2)
+
+    provider = start_fake_provider(args.oauth_latency)
+    provider_url = f'http://127.0.0.1:{provider.server_port}'
+
+    env = dict(
+        os.environ,
+        SERVER_MODE=args.server_mode,
+        RATE_LIMIT_ENABLED='false',
+        METRICS_ENABLED='true',
+        LINE_CLIENT_ID=LINE_CLIENT_ID,
+        LINE_CLIENT_SECRET=LINE_CLIENT_SECRET,
+        LINE_TOKEN_URL=f'{provider_url}/token',
+        LINE_PROFILE_URL=f'{provider_url}/profile',
+    )
+    base_url = f'http://127.0.0.1:{args.port}'
+    with tempfile.TemporaryFile() as log:
+        process = subprocess.Popen(
+            [sys.executable, '-c', SERVE_CODE, BACKEND_DIR, str(args.port), str(args.seed_users), str(args.concurrency)],
+            cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        try:
+            wait_until_ready(base_url, process, log)
+            print(f'執行 {settings["mix"]}（{args.concurrency} 執行緒，{args.duration:g} 秒）...', flush=True)
+            results = run_mix(mix, base_url, args.concurrency, args.duration, args.warmup, args.seed_users)
+        except RuntimeError as e:
+            sys.exit(str(e))
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+            provider.shutdown()
+
+    flows_baseline = (baseline or {}).get('flows', {})
+    print_report(results, flows_baseline)
+
+    if args.write_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'settings': settings,
+                'flows': {flow: {key: result[key] for key in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms')}
+                          for flow, result in results.items()},
+            }, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f'已寫入基準值 {args.baseline}')
+        return
+
+    failures = compare_with_baseline(results, flows_baseline, args.tolerance)
+    if failures:
+        print('效能退化：')
+        for failure in failures:
+            print(f'  - {failure}')
+        sys.exit(1)
+    print('通過')
+
+if __name__ == '__main__':
+    main()
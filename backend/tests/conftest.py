@@ -0,0 +1,84 @@
+"""
+測試共用設定
+
+測試直接匯入 backend/app.py；本機假 OAuth 提供者以 ThreadingHTTPServer 執行，
+每個路徑依序回應預先排好的 (狀態碼, 內容, 延遲秒數)。
+"""
+import json
+import os
+import sys
+import threading
+from collections import defaultdict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+
+class FakeProvider:
+    """排定回應並記錄每個路徑收到的請求次數"""
+
+    def __init__(self):
+        self.responses = defaultdict(deque)
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length', 0))
+                if length:
+                    self.rfile.read(length)
+                status, body, delay = provider._next(self.path.split('?', 1)[0])
+                if delay:
+                    threading.Event().wait(delay)
+                payload = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json' if not isinstance(body, bytes) else 'text/html')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客戶端逾時後已關閉連線
+                    pass
+
+            do_GET = _handle
+            do_POST = _handle
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self._server.server_port}{path}'
+
+    def queue(self, path, status=200, body=None, delay=0.0, times=1):
+        """排入 times 次相同回應；佇列用完後固定回應 404"""
+        with self._lock:
+            for _ in range(times):
+                self.responses[path].append((status, {} if body is None else body, delay))
+
+    def _next(self, path):
+        with self._lock:
+            self.calls[path] += 1
+            if self.responses[path]:
+                return self.responses[path].popleft()
+        return 404, {'error': 'not_found'}, 0.0
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+@pytest.fixture
+def fake_provider():
+    provider = FakeProvider()
+    yield provider
+    provider.close()
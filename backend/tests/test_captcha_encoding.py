@@ -0,0 +1,48 @@
+"""驗證碼圖片編碼：調色盤 PNG 與全彩 PNG 的內容一致"""
+import io
+
+import numpy as np
+from PIL import Image
+
+import app as backend
+
+def render_pixels(text):
+    captured = []
+    original = backend.encode_captcha_image
+
+    def capture(pixels, image_format='png'):
+        captured.append(pixels.copy())
+        return original(pixels, image_format)
+
+    backend.encode_captcha_image = capture
+    try:
+        backend.generate_captcha_image(text)
+    finally:
+        backend.encode_captcha_image = original
+    return captured[0]
+
+def decode(data):
+    return Image.open(io.BytesIO(data))
+
+def test_png_is_lossless():
+    pixels = render_pixels('X7QZ')
+
+    assert np.array_equal(np.asarray(decode(backend.encode_png(pixels)).convert('RGB')), pixels)
+
+def test_png8_keeps_colors_within_quantization_step():
+    for text in ('X7QZ', 'AB12', 'MWK9'):
+        pixels = render_pixels(text)
+        image = decode(backend.encode_png8(pixels))
+
+        assert image.mode == 'P'
+        decoded = np.asarray(image.convert('RGB')).astype(int)
+        assert np.abs(decoded - pixels).max() <= 7
+        # 白底保持純白
+        assert (decoded[pixels.min(axis=2) == 255] == 255).all()
+
+def test_png8_falls_back_when_too_many_colors():
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, size=(80, 200, 3), dtype=np.uint8)
+
+    assert backend.encode_png8(pixels) is None
+    assert decode(backend.encode_captcha_image(pixels, 'png8')).mode == 'P'
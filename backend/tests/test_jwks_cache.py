@@ -0,0 +1,56 @@
+"""JWKSCache 在提供者故障時的抓取間隔與沿用舊公鑰"""
+import json
+import time
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+import app as backend
+
+def make_jwks(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({'kid': kid, 'alg': 'RS256', 'use': 'sig'})
+    return {'keys': [jwk]}
+
+def make_cache(fake_provider, ttl=3600.0, min_refetch=60.0):
+    client = backend.OAuthHTTPClient('test', connect_timeout=1.0, read_timeout=1.0, retries=0, backoff=0.0)
+    return backend.JWKSCache('test', fake_provider.url('/certs'), client, ttl=ttl, min_refetch=min_refetch)
+
+def test_failed_fetch_is_not_retried_within_min_refetch(fake_provider):
+    fake_provider.queue('/certs', status=503, times=5)
+    cache = make_cache(fake_provider)
+
+    for _ in range(3):
+        with pytest.raises(backend.IdTokenError):
+            cache.get_key('k1')
+
+    assert fake_provider.calls['/certs'] == 1
+
+def test_unknown_kid_refetches_at_most_once_per_interval(fake_provider):
+    fake_provider.queue('/certs', body=make_jwks('k1'), times=3)
+    cache = make_cache(fake_provider)
+
+    assert cache.get_key('k1') is not None
+    for _ in range(3):
+        with pytest.raises(backend.IdTokenError):
+            cache.get_key('rotated')
+
+    assert fake_provider.calls['/certs'] == 1
+
+def test_expired_keys_are_served_while_refreshing(fake_provider):
+    fake_provider.queue('/certs', body=make_jwks('k1'))
+    fake_provider.queue('/certs', status=200, body=make_jwks('k2'), delay=0.3)
+    cache = make_cache(fake_provider, ttl=0.05, min_refetch=0.0)
+    cache.get_key('k1')
+    time.sleep(0.1)
+
+    started = time.monotonic()
+    assert cache.get_key('k1') is not None
+    assert time.monotonic() - started < 0.2
+
+    deadline = time.monotonic() + 2
+    while fake_provider.calls['/certs'] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fake_provider.calls['/certs'] == 2
@@ -0,0 +1,121 @@
+"""登入流程的資料庫語句數（經由 TracingCursor 計數，以假連接取代 MySQL）"""
+import flask
+import pytest
+from werkzeug.security import generate_password_hash
+
+import app as backend
+
+PASSWORD = 'correct-password'
+HASH_METHOD = 'pbkdf2:sha256:1000'
+
+class FakeDatabase:
+    def __init__(self, user):
+        self.user = user
+        self.statements = []
+
+class FakeCursor:
+    def __init__(self, db):
+        self._db = db
+        self._row = None
+        self.rowcount = 0
+        self.lastrowid = 0
+
+    def execute(self, query, args=None):
+        self._db.statements.append(' '.join(query.split()))
+        self._row = self._db.user if ' FROM users u' in query else None
+        self.rowcount = 1
+        return 1
+
+    def fetchone(self):
+        return self._row
+
+    def fetchall(self):
+        return [self._row] if self._row else []
+
+class FakeConnection:
+    def __init__(self, db):
+        self._db = db
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self._db)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def login_db(monkeypatch):
+    """回傳 (假資料庫, 每個請求經 TracingCursor 計得的語句數)"""
+    db = FakeDatabase({
+        'id': 7, 'username': 'alice', 'email': None, 'display_name': 'Alice', 'phone': None,
+        'password': generate_password_hash(PASSWORD, method=HASH_METHOD),
+        'line_id': None, 'google_id': None, 'role': 'customer',
+        'failed_attempts': 0, 'lockout_until': None, 'token_version': 0, 'merchant_id': None,
+    })
+    monkeypatch.setattr(backend.pymysql, 'connect', lambda **config: FakeConnection(db))
+    monkeypatch.setattr(backend, 'db_pool', backend.ConnectionPool(backend.DB_CONFIG, max_size=2))
+    monkeypatch.setattr(backend, '_schema', backend.SchemaCapabilities(
+        has_role=True, has_failed_attempts=True, has_lockout=True, has_merchants=True,
+        has_token_version=True, has_refresh_tokens=True,
+    ))
+    monkeypatch.setattr(backend.password_hash_policy, '_method', HASH_METHOD)
+
+    counts = []
+
+    def record(sender, **extra):
+        counts.append(flask.g.get('_db_query_count', 0))
+
+    flask.request_tearing_down.connect(record, backend.app)
+    yield db, counts
+    flask.request_tearing_down.disconnect(record, backend.app)
+
+def post_login(username, password):
+    return backend.app.test_client().post('/api/login', json={
+        'username': username,
+        'password': password,
+        'captcha_answer': 'ABCD',
+        'captcha_token': backend.generate_captcha_token('ABCD'),
+    })
+
+def test_login_runs_two_statements(login_db):
+    db, counts = login_db
+
+    response = post_login('alice', PASSWORD)
+
+    assert response.status_code == 200
+    assert response.get_json()['refresh_token']
+    # 登入查詢（含商家 LEFT JOIN）+ 建立 refresh token；失敗次數為 0 時不寫回
+    assert counts == [2]
+    assert db.statements[0].startswith('SELECT') and 'LEFT JOIN merchants' in db.statements[0]
+    assert db.statements[1].startswith('INSERT INTO refresh_tokens')
+
+def test_login_resets_failed_attempts_in_one_extra_statement(login_db):
+    db, counts = login_db
+    db.user['failed_attempts'] = 2
+
+    response = post_login('alice', PASSWORD)
+
+    assert response.status_code == 200
+    assert counts == [3]
+
+def test_wrong_password_runs_only_the_lookup(login_db):
+    db, counts = login_db
+
+    response = post_login('alice', 'wrong-password')
+
+    assert response.status_code == 401
+    assert counts == [1]
+
+def test_verify_time_is_exported_per_algorithm(login_db):
+    response = post_login('alice', PASSWORD)
+
+    assert response.status_code == 200
+    assert 'password_hash_seconds_count{operation="verify",algorithm="pbkdf2"}' in backend.metrics.render()
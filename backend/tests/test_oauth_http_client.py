@@ -0,0 +1,118 @@
+"""OAuthHTTPClient 對本機假提供者的重試、逾時與錯誤處理"""
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+import requests
+
+import app as backend
+
+def make_client(retries=2, read_timeout=2.0):
+    return backend.OAuthHTTPClient('test', connect_timeout=1.0, read_timeout=read_timeout,
+                                   retries=retries, backoff=0.0, pool_size=2)
+
+def test_get_retries_5xx_until_success(fake_provider):
+    fake_provider.queue('/profile', status=503, times=2)
+    fake_provider.queue('/profile', status=200, body={'userId': 'U1'})
+    client = make_client(retries=2)
+
+    response = client.get(fake_provider.url('/profile'))
+
+    assert response.status_code == 200
+    assert response.json() == {'userId': 'U1'}
+    assert fake_provider.calls['/profile'] == 3
+    assert client.stats()['retries'] == 2
+    assert client.stats()['errors'] == 2
+
+def test_get_returns_last_5xx_after_retries_exhausted(fake_provider):
+    fake_provider.queue('/profile', status=502, times=5)
+    client = make_client(retries=1)
+
+    response = client.get(fake_provider.url('/profile'))
+
+    assert response.status_code == 502
+    assert fake_provider.calls['/profile'] == 2
+
+def test_post_is_not_retried_on_5xx(fake_provider):
+    # 授權碼只能使用一次，交換 token 的 POST 不可重送
+    fake_provider.queue('/token', status=503)
+    fake_provider.queue('/token', status=200, body={'access_token': 'x'})
+    client = make_client(retries=2)
+
+    response = client.post(fake_provider.url('/token'), data={'code': 'abc'})
+
+    assert response.status_code == 503
+    assert fake_provider.calls['/token'] == 1
+
+def test_4xx_is_returned_without_retry(fake_provider):
+    fake_provider.queue('/profile', status=401, body={'error': 'invalid_token'})
+    client = make_client(retries=2)
+
+    response = client.get(fake_provider.url('/profile'))
+
+    assert response.status_code == 401
+    assert fake_provider.calls['/profile'] == 1
+    assert client.stats()['errors'] == 0
+
+def test_read_timeout_retries_get_then_raises(fake_provider):
+    fake_provider.queue('/profile', delay=0.5, times=2)
+    client = make_client(retries=1, read_timeout=0.1)
+
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.get(fake_provider.url('/profile'))
+
+    assert fake_provider.calls['/profile'] == 2
+    assert client.stats()['errors'] == 2
+
+def test_read_timeout_on_post_is_not_retried(fake_provider):
+    fake_provider.queue('/token', delay=0.5, times=2)
+    client = make_client(retries=2, read_timeout=0.1)
+
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post(fake_provider.url('/token'), data={'code': 'abc'})
+
+    assert fake_provider.calls['/token'] == 1
+
+def test_health_reports_degraded_after_errors(fake_provider):
+    fake_provider.queue('/profile', status=500, times=6)
+    client = make_client(retries=0)
+
+    for _ in range(6):
+        client.get(fake_provider.url('/profile'))
+
+    assert client.health()['status'] == 'degraded'
+
+@pytest.fixture
+def line_provider(fake_provider, monkeypatch):
+    monkeypatch.setattr(backend, 'LINE_TOKEN_URL', fake_provider.url('/token'))
+    monkeypatch.setattr(backend, 'LINE_PROFILE_URL', fake_provider.url('/profile'))
+    return fake_provider
+
+def test_callback_maps_non_json_token_response_to_error_redirect(line_provider):
+    line_provider.queue('/token', status=502, body=b'<html>Bad Gateway</html>')
+
+    response = backend.app.test_client().get('/api/callback/line?code=abc')
+
+    assert response.status_code == 302
+    query = parse_qs(urlparse(response.headers['Location']).query)
+    assert query['provider'] == ['line']
+    assert query['error']
+    assert line_provider.calls['/token'] == 1
+
+def test_callback_maps_token_error_to_login_failed_page(line_provider):
+    line_provider.queue('/token', status=400, body={'error': 'invalid_grant'})
+
+    response = backend.app.test_client().get('/api/callback/line?code=abc')
+
+    assert response.status_code == 400
+    assert '無法取得 access token' in response.get_data(as_text=True)
+
+def test_callback_maps_profile_4xx_to_error(line_provider):
+    # 沒有 id_token 時改用 profile API，profile 失敗不可建立用戶
+    line_provider.queue('/token', status=200, body={'access_token': 'at'})
+    line_provider.queue('/profile', status=401, body={'message': 'invalid token'})
+
+    response = backend.app.test_client().get('/api/callback/line?code=abc')
+
+    assert response.status_code == 302
+    assert 'error=' in response.headers['Location']
+    assert line_provider.calls['/profile'] == 1
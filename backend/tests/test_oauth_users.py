@@ -0,0 +1,144 @@
+"""OAuth 用戶名推導、建立 OAuth 用戶的 upsert 與跨 worker 的 OAuth 用戶快取"""
+from urllib.parse import parse_qs, urlsplit
+
+import fakeredis
+import pytest
+
+import app as backend
+
+class FakeUsersTable:
+    """以 MySQL 的語意模擬 users 表的 INSERT ... ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)"""
+
+    UNIQUE = ('username', 'line_id', 'google_id')
+
+    def __init__(self):
+        self.rows = {}
+        self.stale_lookup = False  # True 時以提供者 ID 查詢一律查無資料（模擬並行寫入前的讀取）
+
+    def add(self, **values):
+        row = {'id': len(self.rows) + 1, 'username': None, 'line_id': None, 'google_id': None, 'token_version': 0}
+        row.update(values)
+        self.rows[row['id']] = row
+        return row
+
+    def cursor(self, *args, **kwargs):
+        return FakeUsersCursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+class FakeUsersCursor:
+    def __init__(self, table):
+        self._table = table
+        self._row = None
+        self.lastrowid = 0
+
+    def execute(self, query, args=()):
+        query = ' '.join(query.split())
+        if query.startswith('INSERT INTO users'):
+            assert 'ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)' in query
+            column = query.split('(')[1].split(',')[1].strip()
+            username, provider_id = args[0], args[1]
+            values = {'username': username, column: provider_id}
+            # 衝突時回傳第一個衝突列的 ID；沒有衝突才新增
+            conflict = next((row for row in self._table.rows.values()
+                             if any(values.get(key) is not None and row[key] == values.get(key)
+                                    for key in FakeUsersTable.UNIQUE)), None)
+            self.lastrowid = conflict['id'] if conflict else self._table.add(**values)['id']
+        elif query.startswith('SELECT') and query.endswith('WHERE id = %s'):
+            self._row = dict(self._table.rows.get(args[0]) or {}) or None
+        elif query.startswith('SELECT'):
+            column = query.split('WHERE ')[1].split(' =')[0]
+            rows = () if self._table.stale_lookup else self._table.rows.values()
+            self._row = next((dict(row) for row in rows if row[column] == args[0]), None)
+        else:
+            raise AssertionError(f'unexpected query: {query}')
+
+    def fetchone(self):
+        return self._row
+
+@pytest.fixture
+def users_table(monkeypatch):
+    table = FakeUsersTable()
+    monkeypatch.setattr(backend, 'get_db_connection', lambda: table)
+    monkeypatch.setattr(backend, 'oauth_user_cache', backend.OAuthUserCache())
+    monkeypatch.setattr(backend, '_schema', backend.SchemaCapabilities(has_token_version=True))
+    return table
+
+def test_first_oauth_login_creates_user(users_table):
+    user_id, username, token_version = backend.find_or_create_oauth_user('U1', 'line', 'Alice')
+
+    assert username == backend.oauth_usernames('line', 'U1')[0]
+    assert users_table.rows[user_id]['line_id'] == 'U1'
+
+def test_concurrent_first_login_returns_the_same_user(users_table):
+    # 另一個請求已用第二個候選用戶名建立同一個 LINE 帳號，但本請求的 SELECT 早於該次寫入
+    existing = users_table.add(username=backend.oauth_usernames('line', 'U1')[1], line_id='U1')
+    users_table.add(username='someone-else', line_id='U2')
+    users_table.stale_lookup = True
+
+    assert backend.find_or_create_oauth_user('U1', 'line') == (existing['id'], existing['username'], 0)
+    assert len(users_table.rows) == 2
+
+def test_username_taken_by_another_user_never_logs_into_their_account(users_table):
+    first, second = backend.oauth_usernames('line', 'U1')
+    victim = users_table.add(username=first, google_id='G-victim')
+
+    user_id, username, _ = backend.find_or_create_oauth_user('U1', 'line')
+
+    assert user_id != victim['id']
+    assert username == second
+    assert users_table.rows[user_id]['line_id'] == 'U1'
+    assert users_table.rows[victim['id']]['line_id'] is None
+
+def test_oauth_token_carries_current_token_version(users_table):
+    users_table.add(username='alice', line_id='U1', token_version=3)
+
+    user_id, username, token_version = backend.find_or_create_oauth_user('U1', 'line')
+    with backend.app.test_request_context():
+        url = backend.create_oauth_redirect_url(user_id, username, 'line', token_version)
+    token = parse_qs(urlsplit(url).query)['token'][0]
+
+    assert token_version == 3
+    assert backend.pyjwt.decode(token, options={'verify_signature': False})['ver'] == 3
+    # 之後以快取登入同樣帶有 token 版本
+    assert backend.find_or_create_oauth_user('U1', 'line') == (user_id, 'alice', 3)
+
+def test_every_candidate_taken_raises(users_table):
+    for candidate in backend.oauth_usernames('line', 'U1'):
+        users_table.add(username=candidate, google_id=f'G-{candidate}')
+
+    with pytest.raises(ValueError):
+        backend.find_or_create_oauth_user('U1', 'line')
+
+def test_oauth_usernames_do_not_expose_provider_id():
+    line_id = 'U4af4980629a1b2c3d4e5f60718293a4b'
+
+    candidates = backend.oauth_usernames('line', line_id)
+
+    assert len(candidates) == 2
+    for username in candidates:
+        assert line_id not in username
+        assert line_id[1:] not in username
+        assert username.startswith('line_')
+        assert len(username) <= backend.USERNAME_MAX_LENGTH
+    assert len(candidates[0]) == len('line_') + backend.OAUTH_USERNAME_HASH_LENGTH
+    assert candidates == backend.oauth_usernames('line', line_id)
+
+def test_redis_cache_invalidation_is_seen_by_every_worker():
+    client = fakeredis.FakeRedis()
+    worker_a = backend.RedisOAuthUserCache(client)
+    worker_b = backend.RedisOAuthUserCache(client)
+
+    worker_a.set('line', 'U1', 7, 'line_abc', 2)
+    worker_a.set('google', 'G1', 7, 'line_abc', 2)
+    assert worker_b.get('line', 'U1') == (7, 'line_abc', 2)
+
+    # 用戶 7 在 worker B 重新綁定 LINE 帳號
+    worker_b.invalidate_user(7)
+
+    assert worker_a.get('line', 'U1') is None
+    assert worker_a.get('google', 'G1') is None
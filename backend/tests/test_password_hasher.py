@@ -0,0 +1,27 @@
+"""密碼雜湊行程池：等待逾時的工作結束前不可歸還名額"""
+import time
+
+import pytest
+
+import app as backend
+
+def test_timed_out_job_keeps_its_slot_until_it_finishes():
+    hasher = backend.PasswordHasher(workers=1, queue_size=0, timeout=0.2)
+    try:
+        # 子行程啟動加上 1 秒工作，一定超過等待時限
+        with pytest.raises(backend.PasswordHashBusyError):
+            hasher._run(time.sleep, 1.0)
+
+        # 逾時的工作仍在子行程中執行，不可再收新的工作
+        with pytest.raises(backend.PasswordHashBusyError):
+            hasher._run(time.sleep, 0)
+        assert hasher.stats()['pending'] == 1
+
+        deadline = time.monotonic() + 30
+        while hasher.stats()['pending'] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert hasher.stats()['pending'] == 0
+        hasher.timeout = 30
+        assert hasher._run(time.sleep, 0) is None
+    finally:
+        hasher._executor.shutdown(wait=True)
@@ -0,0 +1,85 @@
+"""個人資料快取：查詢期間發生的失效不可被舊資料覆蓋"""
+import fakeredis
+import pytest
+
+import app as backend
+
+@pytest.fixture(params=['memory', 'redis'])
+def cache(request):
+    if request.param == 'redis':
+        return backend.RedisProfileCache(fakeredis.FakeRedis())
+    return backend.ProfileCache()
+
+def test_set_without_invalidation_is_cached(cache):
+    generation = cache.generation(7)
+    etag = cache.set(7, b'{"username":"alice"}', generation)
+
+    assert cache.get(7) == (b'{"username":"alice"}', etag)
+
+def test_invalidation_between_read_and_set_discards_the_stale_body(cache):
+    generation = cache.generation(7)
+    # 另一個請求在這次查詢之後改名並失效
+    cache.invalidate(7)
+    cache.set(7, b'{"username":"old"}', generation)
+
+    assert cache.get(7) is None
+    assert cache.stats()['stale_writes'] == 1
+
+    # 下一次讀取以新版本寫入
+    generation = cache.generation(7)
+    cache.set(7, b'{"username":"new"}', generation)
+    assert cache.get(7)[0] == b'{"username":"new"}'
+
+def test_invalidating_other_users_does_not_block_set(cache):
+    generation = cache.generation(7)
+    cache.invalidate(8)
+    cache.set(7, b'{}', generation)
+
+    assert cache.get(7) is not None
+
+def test_evicted_invalidation_records_stay_conservative():
+    cache = backend.ProfileCache(max_entries=2)
+    generation = cache.generation(7)
+    for user_id in (7, 8, 9):
+        cache.invalidate(user_id)
+
+    cache.set(7, b'{}', generation)
+
+    assert cache.get(7) is None
+
+class InvalidatingCursor:
+    """查詢用戶時模擬另一個請求剛好改名並失效快取"""
+
+    def __init__(self, user):
+        self._user = user
+
+    def execute(self, query, args=None):
+        backend.profile_cache.invalidate(self._user['id'])
+
+    def fetchone(self):
+        return self._user
+
+class FakeConnection:
+    def __init__(self, user):
+        self._user = user
+
+    def cursor(self, *args, **kwargs):
+        return InvalidatingCursor(self._user)
+
+    def close(self):
+        pass
+
+def test_profile_request_racing_an_invalidation_is_not_cached(monkeypatch):
+    user = {'id': 7, 'username': 'alice', 'email': None, 'display_name': None, 'phone': None,
+            'line_id': None, 'google_id': None, 'role': 'customer'}
+    monkeypatch.setattr(backend, 'profile_cache', backend.ProfileCache())
+    monkeypatch.setattr(backend, 'get_db_connection', lambda: FakeConnection(user))
+    monkeypatch.setattr(backend, '_schema', backend.SchemaCapabilities(has_role=True))
+    with backend.app.app_context():
+        token = backend.create_user_access_token(7)
+
+    response = backend.app.test_client().get('/api/profile', headers={'Authorization': f'Bearer {token}'})
+
+    assert response.status_code == 200
+    assert response.get_json()['username'] == 'alice'
+    assert backend.profile_cache.get(7) is None
@@ -0,0 +1,40 @@
+"""速率限制：被單一 IP 桶擋下的請求不可消耗端點的全域額度"""
+import pytest
+
+import app as backend
+
+@pytest.fixture
+def rate_limited(monkeypatch):
+    monkeypatch.setattr(backend, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(backend, 'rate_limit_buckets', backend.MemoryTokenBuckets())
+    # 補充速率調到極低，測試期間桶不會回補
+    monkeypatch.setitem(backend.RATE_LIMITS, 'login', {
+        'ip': (0.001, 5),
+        'username': (0.001, 5),
+        'global': (0.001, 50),
+    })
+
+def post_login(client, ip):
+    # 空白帳密在處理函數內直接回 400，不會查詢資料庫
+    return client.post('/api/login', json={}, environ_base={'REMOTE_ADDR': ip})
+
+def test_throttled_ip_does_not_exhaust_global_bucket(rate_limited):
+    client = backend.app.test_client()
+    ip_burst = backend.RATE_LIMITS['login']['ip'][1]
+    global_burst = backend.RATE_LIMITS['login']['global'][1]
+
+    statuses = [post_login(client, '203.0.113.1').status_code for _ in range(global_burst * 4)]
+
+    assert statuses.count(400) == ip_burst
+    assert statuses.count(429) == global_burst * 4 - ip_burst
+    # 第一個 IP 已被限流，另一個 IP 仍可正常送出請求
+    assert post_login(client, '203.0.113.2').status_code == 400
+
+def test_global_bucket_still_limits_many_ips(rate_limited):
+    client = backend.app.test_client()
+    global_burst = backend.RATE_LIMITS['login']['global'][1]
+
+    statuses = [post_login(client, f'10.0.0.{i}').status_code for i in range(global_burst + 5)]
+
+    assert statuses.count(400) == global_burst
+    assert statuses[-1] == 429
@@ -0,0 +1,32 @@
+"""記憶體撤銷存儲不可在多個 worker 下啟動"""
+import pytest
+
+import app as backend
+
+def test_memory_store_refuses_multiple_workers(monkeypatch):
+    monkeypatch.setattr(backend, 'JWT_REVOCATION_STORE', 'memory')
+    monkeypatch.setenv('WEB_CONCURRENCY', '4')
+
+    with pytest.raises(RuntimeError):
+        backend.check_revocation_store()
+
+def test_gunicorn_worker_flag_is_detected(monkeypatch):
+    monkeypatch.delenv('WEB_CONCURRENCY', raising=False)
+    for argv, expected in (
+        (['/venv/bin/gunicorn', '-w', '3', 'app:app'], 3),
+        (['/venv/bin/gunicorn', '--workers=2', 'app:app'], 2),
+        (['/venv/bin/gunicorn', '-w8', 'app:app'], 8),
+        (['/venv/bin/gunicorn', 'app:app'], 1),
+        (['app.py', '-w', '3'], 1),
+    ):
+        monkeypatch.setattr(backend.sys, 'argv', argv)
+        assert backend.detect_worker_count() == expected
+
+def test_single_worker_and_redis_store_start(monkeypatch):
+    monkeypatch.setenv('WEB_CONCURRENCY', '1')
+    monkeypatch.setattr(backend, 'JWT_REVOCATION_STORE', 'memory')
+    backend.check_revocation_store()
+
+    monkeypatch.setenv('WEB_CONCURRENCY', '4')
+    monkeypatch.setattr(backend, 'JWT_REVOCATION_STORE', 'redis')
+    backend.check_revocation_store()
@@ -22,12 +22,58 @@ api.interceptors.request.use(
   }
 )
 
-// 回應攔截器：處理錯誤
+// 同一時間只送出一個換發請求，避免舊的 refresh token 被重複使用而撤銷整個登入。
+// 分頁內以共用 Promise 合併；跨分頁以 Web Locks 互斥，後取得鎖的分頁若發現
+// localStorage 中的 refresh token 已被其他分頁輪替，直接沿用而不再送出請求
+let refreshPromise = null
+
+const withRefreshLock = (callback) => {
+  if (navigator.locks) {
+    return navigator.locks.request('auth-token-refresh', callback)
+  }
+  return callback()
+}
+
+const refreshAccessToken = (authStore) => {
+  if (!refreshPromise) {
+    refreshPromise = withRefreshLock(async () => {
+      const storedRefreshToken = localStorage.getItem('refreshToken')
+      const storedToken = localStorage.getItem('token')
+      if (storedRefreshToken && storedToken && storedRefreshToken !== authStore.refreshToken) {
+        authStore.setTokens(storedToken, storedRefreshToken)
+        return storedToken
+      }
+      const response = await api.post(
+        '/api/token/refresh',
+        { refresh_token: authStore.refreshToken },
+        { _skipRefresh: true }
+      )
+      authStore.setTokens(response.data.token, response.data.refresh_token)
+      return response.data.token
+    }).finally(() => {
+      refreshPromise = null
+    })
+  }
+  return refreshPromise
+}
+
+// 回應攔截器：access token 過期時以 refresh token 換發後重試，失敗才導回登入頁
 api.interceptors.response.use(
   (response) => response,
-  (error) => {
+  async (error) => {
+    const config = error.config
     if (error.response?.status === 401) {
       const authStore = useAuthStore()
+      if (authStore.refreshToken && config && !config._skipRefresh && !config._retried) {
+        try {
+          const token = await refreshAccessToken(authStore)
+          config._retried = true
+          config.headers.Authorization = `Bearer ${token}`
+          return api(config)
+        } catch (refreshError) {
+          // 換發失敗，改為重新登入
+        }
+      }
       authStore.clearAuth()
       window.location.href = '/login'
     }
@@ -38,7 +84,12 @@ api.interceptors.response.use(
 export const authApi = {
   // 驗證碼 API
   getCaptcha: () => {
-    return api.get('/api/captcha')
+    return api.get('/api/captcha', { params: { format: 'url' } })
+  },
+
+  // 驗證碼圖片網址（後端回傳相對路徑）
+  captchaImageUrl: (path) => {
+    return `${api.defaults.baseURL}${path}`
   },
 
   // 身份驗證 API
@@ -51,6 +102,10 @@ export const authApi = {
     })
   },
 
+  logout: (refreshToken) => {
+    return api.post('/api/logout', { refresh_token: refreshToken }, { _skipRefresh: true })
+  },
+
   register: (username, password, confirmPassword, role = 'customer', additionalData = {}) => {
     return api.post('/api/register', {
       username,
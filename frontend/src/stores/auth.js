@@ -4,6 +4,7 @@ import { authApi } from '@/api/auth'
 
 export const useAuthStore = defineStore('auth', () => {
   const token = ref(localStorage.getItem('token') || null)
+  const refreshToken = ref(localStorage.getItem('refreshToken') || null)
   const user = ref(JSON.parse(localStorage.getItem('user') || 'null'))
 
   const isAuthenticated = computed(() => !!token.value)
@@ -18,17 +19,29 @@ export const useAuthStore = defineStore('auth', () => {
     localStorage.setItem('user', JSON.stringify(userData))
   }
 
+  // 換發 token（refresh token 每次使用後都會輪替）
+  const setTokens = (newToken, newRefreshToken) => {
+    token.value = newToken
+    localStorage.setItem('token', newToken)
+    if (newRefreshToken) {
+      refreshToken.value = newRefreshToken
+      localStorage.setItem('refreshToken', newRefreshToken)
+    }
+  }
+
   const clearAuth = () => {
     token.value = null
+    refreshToken.value = null
     user.value = null
     localStorage.removeItem('token')
+    localStorage.removeItem('refreshToken')
     localStorage.removeItem('user')
   }
 
   const login = async (username, password, captchaAnswer, captchaToken) => {
     try {
       const response = await authApi.login(username, password, captchaAnswer, captchaToken)
-      // API 返回格式: { message, token, user, role, display_name, email, phone, merchant?, expires_in }
+      // API 返回格式: { message, token, refresh_token?, user, role, display_name, email, phone, merchant?, expires_in }
       const userData = {
         username: response.data.user,
         role: response.data.role || 'customer',
@@ -38,6 +51,9 @@ export const useAuthStore = defineStore('auth', () => {
         merchant: response.data.merchant
       }
       setAuth(response.data.token, userData)
+      if (response.data.refresh_token) {
+        setTokens(response.data.token, response.data.refresh_token)
+      }
       return { success: true, role: userData.role }
     } catch (error) {
       return {
@@ -59,7 +75,13 @@ export const useAuthStore = defineStore('auth', () => {
     }
   }
 
-  const logout = () => {
+  const logout = async () => {
+    try {
+      // 通知後端撤銷 token，失敗也照常登出
+      await authApi.logout(refreshToken.value)
+    } catch (error) {
+      // 忽略
+    }
     clearAuth()
   }
 
@@ -99,7 +121,11 @@ export const useAuthStore = defineStore('auth', () => {
 
   const updatePassword = async (oldPassword, newPassword, confirmPassword) => {
     try {
-      await authApi.changePassword(oldPassword, newPassword, confirmPassword)
+      const response = await authApi.changePassword(oldPassword, newPassword, confirmPassword)
+      // 變更密碼會使其他裝置登出，目前裝置改用新的 token
+      if (response.data.token) {
+        setTokens(response.data.token, response.data.refresh_token)
+      }
       return { success: true }
     } catch (error) {
       return {
@@ -111,12 +137,14 @@ export const useAuthStore = defineStore('auth', () => {
 
   return {
     token,
+    refreshToken,
     user,
     isAuthenticated,
     userRole,
     isCustomer,
     isMerchant,
     setAuth,
+    setTokens,
     clearAuth,
     login,
     register,